@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import errno
+import hashlib
+import json
 import multiprocessing as mp
+import os
 import nibabel as nib
 import numpy as np
 from copy import deepcopy
@@ -8,17 +11,96 @@ from joblib import Parallel, delayed
 from nilearn.connectome import ConnectivityMeasure
 from nilearn.input_data import NiftiLabelsMasker, NiftiMasker
 from nipype.interfaces import fsl
+from sklearn.base import clone
 from os import path, makedirs
 import pandas as pd
 import scipy
 import scipy.cluster.hierarchy as hier_clustering
 import pylab
 from numpy import genfromtxt
+from samri.report.cache import file_hash
+from samri.report.execution import estimate_memory, parallel_map
+
+PARCEL_TIMESERIES_CACHE_DIR = path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'samri', 'parcel_timeseries')
+
+def seed_indices(seeds, brain_mask):
+	"""Return, for each seed, the positions of its voxels in the time series extracted via a brain mask.
+	This allows seed signals to be derived from a single brain time series extraction, rather than from separate (and separately filtered) extractions.
+
+	Parameters
+	----------
+
+	seeds : list
+		Seed regions, each given as a `nilearn.input_data.NiftiMasker` object, a path to a binary mask, a NIfTI image object, or an array of precomputed positions (which is returned unchanged).
+	brain_mask : str or nibabel.nifti1.Nifti1Image
+		Brain mask (e.g. the `mask_img_` attribute of a fitted `nilearn.input_data.NiftiMasker`) in which the time series are extracted.
+		Seed masks on other grids are resampled onto this grid.
+
+	Returns
+	-------
+
+	list of numpy.ndarray
+		Positions of the seed voxels along the voxel axis of the masked brain time series.
+	"""
+
+	if isinstance(brain_mask, str):
+		brain_mask = nib.load(path.abspath(path.expanduser(brain_mask)))
+	brain = np.asanyarray(brain_mask.dataobj).astype(bool)
+	# Masked time series list voxels in C-order, as does `numpy.flatnonzero`.
+	positions = np.cumsum(brain.ravel()) - 1
+	indices = []
+	for seed in seeds:
+		if isinstance(seed, np.ndarray):
+			indices.append(seed)
+			continue
+		if isinstance(seed, NiftiMasker):
+			seed = seed.mask_img
+		if isinstance(seed, str):
+			seed = nib.load(path.abspath(path.expanduser(seed)))
+		if seed.shape[:3] != brain.shape or not np.allclose(seed.affine, brain_mask.affine):
+			from nibabel import processing
+			seed = processing.resample_from_to(seed, brain_mask, order=0)
+		selection = np.asanyarray(seed.dataobj).astype(bool).ravel() & brain.ravel()
+		if not selection.any():
+			raise ValueError("The seed region does not overlap with the brain mask.")
+		indices.append(positions[selection])
+	return indices
+
+def shared_seed_correlations(data_path, seeds, brain_masker):
+	"""Extract and filter the brain time series of a 4D file once, derive the mean time series of all seeds from it by indexing, and return the correlations of all brain voxels with all seeds, computed in one matrix product.
+
+	Parameters
+	----------
+
+	data_path : str
+		Path to 4D data for which to estimate functional connectivity.
+	seeds : list
+		Seed regions, as accepted by `samri.analysis.fc.seed_indices()`.
+	brain_masker : nilearn.input_data.NiftiMasker
+		A `nilearn.input_data.NiftiMasker` object delineating the region in which to calculate voxelwise FC scores.
+		If it is already fitted, it is only used to transform the data, so that it can be shared between threads.
+
+	Returns
+	-------
+
+	numpy.ndarray
+		Array of shape (seeds, voxels) containing the seed-based correlations.
+	"""
+
+	if hasattr(brain_masker, 'mask_img_'):
+		brain_time_series = brain_masker.transform(data_path,)
+	else:
+		brain_time_series = brain_masker.fit_transform(data_path,)
+	indices = seed_indices(seeds, brain_masker.mask_img_)
+	seed_time_series = np.column_stack([brain_time_series[:,i].mean(axis=1) for i in indices])
+	seed_based_correlations = np.dot(seed_time_series.T, brain_time_series) / seed_time_series.shape[0]
+	return seed_based_correlations
 
 def add_fc_roi_data(data_path, seed_masker, brain_masker,
 	dictionary_return=False,
 	save_as="",
 	substitution={},
+	shared_filter=False,
 	):
 	"""Return a volumetric image of the seed-based functional connectivity (FC) with respect to the `seed_masker` inside the `brain_masker`.
 
@@ -40,6 +122,10 @@ def add_fc_roi_data(data_path, seed_masker, brain_masker,
 		It can be a formattable string containing key references from the `substitutions` dictionary.
 	substitution : dict, optional
 		Dictionary containing keys corresponding to the formattable fields in `data_path` and/or `save_as`. If `dictionary_return` is `True`, the resulting FC NIfTI will be appended to this dictionary under the `'result'` key.
+	shared_filter : bool, optional
+		Whether to load and filter the data only once, via `brain_masker`, and derive the seed signal from the brain time series (see `samri.analysis.fc.shared_seed_correlations()`).
+		Seed voxels outside of the brain mask are ignored in this mode.
+		If this is set, `seed_masker` may also be a list of seeds, as accepted by `samri.analysis.fc.seed_indices()`, in which case the result is a 4D image with one FC volume per seed.
 
 	Returns
 	-------
@@ -65,12 +151,20 @@ def add_fc_roi_data(data_path, seed_masker, brain_masker,
 			result["result"] = None
 			return result
 
-	seed_time_series = seed_masker.fit_transform(data_path,).T
-	seed_time_series = np.mean(seed_time_series, axis=0)
-	brain_time_series = brain_masker.fit_transform(data_path,)
-	seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
-	seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
-	seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
+	if shared_filter:
+		if isinstance(seed_masker, (list, tuple)):
+			seed_based_correlations = shared_seed_correlations(data_path, seed_masker, brain_masker)
+		else:
+			seed_based_correlations = shared_seed_correlations(data_path, [seed_masker], brain_masker)[0]
+		seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
+		seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z)
+	else:
+		seed_time_series = seed_masker.fit_transform(data_path,).T
+		seed_time_series = np.mean(seed_time_series, axis=0)
+		brain_time_series = brain_masker.fit_transform(data_path,)
+		seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
+		seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
+		seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
 
 	if save_as:
 		if substitution:
@@ -107,6 +201,7 @@ def seed_based(substitutions, seed, roi,
 	save_results="",
 	n_procs=2,
 	cachedir='',
+	shared_filter=False,
 	):
 	"""Plot a ROI t-values over the session timecourse
 
@@ -118,6 +213,10 @@ def seed_based(substitutions, seed, roi,
 
 	roi_mask_normalize : str
 	Path to a ROI mask by the mean of whose t-values to normalite the t-values in roi_mask.
+
+	shared_filter : bool, optional
+	Whether to read and filter each 4D file only once, deriving the seed signals from the brain time series.
+	In this mode `seed` may also be a list of seed mask paths, and each result is a 4D image with one FC volume per seed.
 	"""
 
 	if isinstance(roi,str):
@@ -125,16 +224,6 @@ def seed_based(substitutions, seed, roi,
 	if isinstance(seed,str):
 		seed_mask = path.abspath(path.expanduser(seed))
 
-	seed_masker = NiftiMasker(
-			mask_img=seed_mask,
-			smoothing_fwhm=smoothing_fwhm,
-			detrend=detrend,
-			standardize=standardize,
-			low_pass=low_pass,
-			high_pass=high_pass,
-			t_r=tr,
-			memory=cachedir, memory_level=1, verbose=0
-			)
 	brain_masker = NiftiMasker(
 			mask_img=roi_mask,
 			smoothing_fwhm=smoothing_fwhm,
@@ -146,25 +235,175 @@ def seed_based(substitutions, seed, roi,
 			memory=cachedir, memory_level=1, verbose=0
 			)
 
+	if shared_filter:
+		# The brain masker is fitted once here, so that the jobs only call its (non-mutating) `transform()` method.
+		brain_masker.fit()
+		# Seed positions are computed once, and reused for all files.
+		if isinstance(seed, (list, tuple)):
+			seeds = seed_indices([path.abspath(path.expanduser(i)) if isinstance(i,str) else i for i in seed], brain_masker.mask_img_)
+		else:
+			seeds = seed_indices([seed_mask if isinstance(seed,str) else seed], brain_masker.mask_img_)[0]
+		seed_maskers = [seeds]*len(substitutions)
+		brain_maskers = [brain_masker]*len(substitutions)
+	else:
+		seed_masker = NiftiMasker(
+				mask_img=seed_mask,
+				smoothing_fwhm=smoothing_fwhm,
+				detrend=detrend,
+				standardize=standardize,
+				low_pass=low_pass,
+				high_pass=high_pass,
+				t_r=tr,
+				memory=cachedir, memory_level=1, verbose=0
+				)
+		# Maskers are fitted by each job, which thus needs its own instances.
+		seed_maskers = [clone(seed_masker) for i in substitutions]
+		brain_maskers = [clone(brain_masker) for i in substitutions]
 
 	fc_maps = Parallel(n_jobs=n_procs, verbose=0, backend="threading")(map(delayed(add_fc_roi_data),
 		[ts_file_template]*len(substitutions),
-		[seed_masker]*len(substitutions),
-		[brain_masker]*len(substitutions),
+		seed_maskers,
+		brain_maskers,
 		[True]*len(substitutions),
 		[save_results]*len(substitutions),
 		substitutions,
+		[shared_filter]*len(substitutions),
 		))
 
 	return fc_maps
 
+def _load_masked(ts_file, mask):
+	"""Return the time series of a 4D NIfTI file within a boolean mask, as an array of shape (time points, voxels)."""
+	img = nib.load(ts_file)
+	data = np.asanyarray(img.dataobj)
+	return data[mask].T.astype(np.float32)
+
+def migp(ts_files, mask,
+	dimension=200,
+	):
+	"""Reduce the time series of a cohort to a small number of spatial eigenvectors via MELODIC's Incremental Group-PCA (MIGP), streaming one subject at a time.
+	Memory use is bounded by (`dimension` + time points of one subject) times the number of voxels, irrespective of cohort size.
+
+	Parameters
+	----------
+
+	ts_files : list of str
+		Paths to the 4D NIfTI timeseries files.
+	mask : numpy.ndarray
+		Boolean 3D array selecting the voxels to analyze.
+	dimension : int, optional
+		Internal dimension of the reduction, i.e. number of rows of the returned matrix; this should be well above the number of ICA components.
+
+	Returns
+	-------
+
+	numpy.ndarray
+		Array of shape (dimension, voxels).
+
+	Notes
+	-----
+
+	Smith et al. (2014), Group-PCA for very large fMRI datasets, NeuroImage 101.
+	"""
+
+	reduced = None
+	for ts_file in ts_files:
+		data = _load_masked(ts_file, mask)
+		data -= data.mean(axis=0)
+		std = data.std(axis=0)
+		std[std == 0] = 1
+		data /= std
+		if reduced is None:
+			reduced = data
+		else:
+			reduced = np.concatenate([reduced, data])
+		if reduced.shape[0] > dimension:
+			# Eigenvectors of the (small) temporal covariance yield the top spatial eigenvectors as projections.
+			values, vectors = np.linalg.eigh(np.dot(reduced, reduced.T))
+			vectors = vectors[:,::-1][:,:dimension]
+			reduced = np.dot(vectors.T, reduced)
+	return reduced
+
+def dual_regression_stages(ts_file, group_maps, mask, out_file, timecourses_file):
+	"""Run the two dual regression stages for one subject, and save the subject-specific spatial maps and timecourses.
+
+	Stage 1 regresses the (spatially demeaned) group maps against the data, yielding one timecourse per component.
+	Stage 2 regresses the demeaned and variance-normalized timecourses against the (temporally demeaned) data, yielding one spatial map per component.
+
+	Parameters
+	----------
+
+	ts_file : str
+		Path to the 4D NIfTI timeseries file.
+	group_maps : numpy.ndarray
+		Group component maps, as an array of shape (components, voxels).
+	mask : numpy.ndarray
+		Boolean 3D array selecting the voxels at which `group_maps` are defined.
+	out_file : str
+		Path under which to save the 4D NIfTI of subject-specific spatial maps.
+	timecourses_file : str
+		Path under which to save the text file of subject-specific timecourses.
+
+	Returns
+	-------
+
+	str
+		Path to the subject-specific spatial maps.
+	"""
+
+	img = nib.load(ts_file)
+	data = _load_masked(ts_file, mask)
+
+	design = (group_maps - group_maps.mean(axis=1, keepdims=True)).T
+	timecourses = np.dot(np.linalg.pinv(design), (data - data.mean(axis=1, keepdims=True)).T).T
+
+	design = timecourses - timecourses.mean(axis=0)
+	std = design.std(axis=0)
+	std[std == 0] = 1
+	design /= std
+	maps = np.dot(np.linalg.pinv(design), data - data.mean(axis=0))
+
+	out_data = np.zeros(mask.shape+(maps.shape[0],), dtype=np.float32)
+	out_data[mask] = maps.T
+	for file_path in [out_file, timecourses_file]:
+		file_dir = path.dirname(file_path)
+		if not path.isdir(file_dir):
+			makedirs(file_dir)
+	nib.save(nib.Nifti1Image(out_data, img.affine, img.header), out_file)
+	np.savetxt(timecourses_file, timecourses)
+	return out_file
+
 def dual_regression(substitutions_a, substitutions_b,
 	all_merged_path="~/all_merged.nii.gz",
 	components=9,
 	group_level="concat",
 	tr=1,
 	ts_file_template="{data_dir}/preprocessing/{preprocessing_dir}/sub-{subject}/ses-{session}/func/sub-{subject}_ses-{session}_task-{scan}.nii.gz",
+	mask='',
+	migp_dimension=200,
+	out_dir='',
+	n_jobs=False,
 	):
+	"""Run a group ICA on the time series of two sets of scans, and optionally dual regression, to obtain subject-specific component maps.
+
+	Parameters
+	----------
+
+	all_merged_path : str, optional
+		Path under which to save the group-level ICA input: the merged time series for `group_level="concat"`, or the reduced MIGP eigenvectors for `group_level="stream"`.
+	group_level : {'concat', 'migp', 'stream'}, optional
+		How to construct the group-level ICA input.
+		'concat' temporally concatenates all time series in memory, 'migp' uses MELODIC's own MIGP implementation, and 'stream' performs an in-process MIGP reduction (see `samri.analysis.fc.migp()`), reading one time series at a time.
+	mask : str, optional
+		Path to a binary mask selecting the voxels for the 'stream' reduction and for dual regression; if unspecified, voxels which are nonzero in the first volume of the first time series are used.
+	migp_dimension : int, optional
+		Internal dimension of the 'stream' MIGP reduction.
+	out_dir : str, optional
+		Directory in which to save the MELODIC output, as well as the subject-specific dual regression maps (`<scan>_dr.nii.gz`) and timecourses (`<scan>_dr.txt`).
+		If unspecified, MELODIC writes to the working directory, and no dual regression is performed.
+	n_jobs : int, optional
+		Number of processes over which to distribute the per-subject dual regression.
+	"""
 
 	all_merged_path = path.abspath(path.expanduser(all_merged_path))
 
@@ -176,9 +415,22 @@ def dual_regression(substitutions_a, substitutions_b,
 		ts_b.append(path.abspath(path.expanduser(ts_file_template.format(**substitution))))
 
 	ts_all = ts_a + ts_b
+
+	if group_level == "stream" or out_dir:
+		reference = nib.load(ts_all[0])
+		if mask:
+			mask = np.asanyarray(nib.load(path.abspath(path.expanduser(mask))).dataobj).astype(bool)
+		else:
+			mask = np.asanyarray(reference.dataobj[...,0]) != 0
+
 	if group_level == "concat" and not path.isfile(all_merged_path):
 		ts_all_merged = nib.concat_images(ts_all, axis=3)
 		ts_all_merged.to_filename(all_merged_path)
+	elif group_level == "stream":
+		reduced = migp(ts_all, mask, dimension=migp_dimension)
+		reduced_data = np.zeros(mask.shape+(reduced.shape[0],), dtype=np.float32)
+		reduced_data[mask] = reduced.T
+		nib.save(nib.Nifti1Image(reduced_data, reference.affine, reference.header), all_merged_path)
 
 	ica = fsl.model.MELODIC()
 	ica.inputs.report = True
@@ -188,15 +440,33 @@ def dual_regression(substitutions_a, substitutions_b,
 	ica.inputs.sep_vn = True
 	if components:
 		ica.inputs.dim = int(components)
+	if out_dir:
+		out_dir = path.abspath(path.expanduser(out_dir))
+		ica.inputs.out_dir = path.join(out_dir, 'melodic')
 	if group_level == "migp":
 		ica.inputs.in_files = ts_all
 		ica._cmd = 'melodic --migp'
-	elif group_level == "concat":
+	elif group_level in ["concat", "stream"]:
 		ica.inputs.approach = "concat"
 		ica.inputs.in_files = all_merged_path
 	print(ica.cmdline)
 	ica_run = ica.run()
 
+	if out_dir:
+		group_maps = nib.load(path.join(out_dir, 'melodic', 'melodic_IC.nii.gz'))
+		group_maps = np.asanyarray(group_maps.dataobj)[mask].T
+		names = [path.basename(i).split('.')[0] for i in ts_all]
+		return parallel_map(dual_regression_stages,
+			ts_all,
+			[group_maps]*len(ts_all),
+			[mask]*len(ts_all),
+			[path.join(out_dir, i+'_dr.nii.gz') for i in names],
+			[path.join(out_dir, i+'_dr.txt') for i in names],
+			backend='multiprocessing',
+			n_jobs=n_jobs,
+			memory_estimates=[estimate_memory(i) for i in ts_all],
+			)
+
 def get_signal(substitutions_a, substitutions_b,
 	functional_file_template="~/ni_data/ofM.dr/preprocessing/{preprocessing_dir}/sub-{subject}/ses-{session}/func/sub-{subject}_ses-{session}_task-{scan}.nii.gz",
 	mask="~/ni_data/templates/DSURQEc_200micron_bin.nii.gz",
@@ -242,6 +512,7 @@ def seed_based_connectivity(ts, seed_mask,
 	high_pass=0.004,
 	tr=1.,
 	save_as="",
+	shared_filter=False,
 	):
 	"""Return a NIfTI containing z scores for connectivity to a defined seed region
 
@@ -275,6 +546,10 @@ def seed_based_connectivity(ts, seed_mask,
 	save_as : string, optional
 	Path to save a NIfTI of the functional connectivity zstatistic to.
 
+	shared_filter : bool, optional
+	Whether to read and filter the time series only once, deriving the seed signal from the brain time series.
+	Seed voxels outside of the brain mask are ignored in this mode.
+
 	Notes
 	-----
 
@@ -307,11 +582,13 @@ def seed_based_connectivity(ts, seed_mask,
 		t_r=tr,
 		memory='nilearn_cache', memory_level=1, verbose=0
 		)
-	seed_time_series = seed_masker.fit_transform(ts,).T
-	seed_time_series = np.mean(seed_time_series, axis=0)
-	brain_time_series = brain_masker.fit_transform(ts,)
-
-	seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
+	if shared_filter:
+		seed_based_correlations = shared_seed_correlations(ts, [seed_mask], brain_masker)[0]
+	else:
+		seed_time_series = seed_masker.fit_transform(ts,).T
+		seed_time_series = np.mean(seed_time_series, axis=0)
+		brain_time_series = brain_masker.fit_transform(ts,)
+		seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0]
 	try:
 		print("seed-based correlation shape: (%s, %s)" % seed_based_correlations.shape)
 	except TypeError:
@@ -328,65 +605,225 @@ def seed_based_connectivity(ts, seed_mask,
 
 	return seed_based_correlation_img
 
-def correlation_matrix(ts,atlas,
+def parcel_timeseries_key(ts, atlas,
 	confounds=None,
 	mask=None,
-	loud=False,
-	structure_names=[],
-	save_as='',
 	low_pass=0.25,
 	high_pass=0.004,
 	smoothing_fwhm=.3,
+	tr=None,
 	):
-	"""Return a CSV file containing correlations between ROIs.
+	"""Return a key identifying a parcel time series extraction by the contents of all input files (or arrays), and by the filter settings."""
+	if confounds is None:
+		confounds_key = ''
+	elif isinstance(confounds, str):
+		confounds_key = file_hash(confounds)
+	else:
+		confounds_key = hashlib.sha1(np.ascontiguousarray(confounds, dtype=np.float64).tobytes()).hexdigest()
+	parameters = [
+		file_hash(ts),
+		file_hash(atlas),
+		file_hash(mask) if mask else '',
+		confounds_key,
+		low_pass,
+		high_pass,
+		smoothing_fwhm,
+		float(tr) if tr is not None else None,
+		]
+	return hashlib.sha1(json.dumps(parameters).encode('utf-8')).hexdigest()
+
+def parcel_timeseries(ts, atlas,
+	confounds=None,
+	mask=None,
+	low_pass=0.25,
+	high_pass=0.004,
+	smoothing_fwhm=.3,
+	cache=True,
+	):
+	"""Return the standardized and filtered mean time series of all atlas parcels for a 4D NIfTI file, reading them from the parcel time series store if they were already extracted.
 
 	Parameters
 	----------
 	ts : str
-		Path to the 4D NIfTI timeseries file on which to perform the connectivity analysis.
-	confounds : 2D array OR path to CSV file
-		Array/CSV file containing confounding time-series to be regressed out before FC analysis.
-	atlas : str, optional
-		Path to a 3D NIfTI-like binary label file designating ROIs.
-	structure_names : list, optional
-		Ordered list of all structure names in atlas (length N).
-	save_as : str
-		Path under which to save the Pandas DataFrame conttaining the NxN correlation matrix.
+		Path to the 4D NIfTI timeseries file.
+	atlas : str
+		Path to a 3D NIfTI-like label file designating ROIs.
+	confounds : 2D array OR path to CSV file, optional
+		Array/CSV file containing confounding time-series to be regressed out.
+	mask : str, optional
+		Path to a 3D NIfTI-like binary mask restricting the parcels.
+	low_pass : float, optional
+		Low-pass cut-off, passed to the NiftiLabelsMasker.
+	high_pass : float, optional
+		High-pass cut-off, passed to the NiftiLabelsMasker.
+	smoothing_fwhm : float, optional
+		Spatial smoothing kernel, passed to the NiftiLabelsMasker.
+	cache : bool or str, optional
+		Whether to use the parcel time series store, or path to the store directory (by default `samri.analysis.fc.PARCEL_TIMESERIES_CACHE_DIR`).
+		Entries are keyed by the contents of the timeseries, atlas, mask, and confounds, and by the filter settings, and are thus never stale.
+
+	Returns
+	-------
+	timeseries : numpy.ndarray
+		Array of shape (time points, parcels).
+	labels : list
+		Atlas label of each parcel (column), or an empty list if the masker does not report labels.
 	"""
 	ts = path.abspath(path.expanduser(ts))
-	if isinstance(atlas,str):
-		atlas = path.abspath(path.expanduser(atlas))
+	atlas = path.abspath(path.expanduser(atlas))
 	if mask:
 		mask = path.abspath(path.expanduser(mask))
+	if isinstance(confounds, str):
+		confounds = path.abspath(path.expanduser(confounds))
 	tr = nib.load(ts).header['pixdim'][0]
+
+	if cache:
+		if cache is True:
+			cache = PARCEL_TIMESERIES_CACHE_DIR
+		cache = path.abspath(path.expanduser(cache))
+		os.makedirs(cache, exist_ok=True)
+		key = parcel_timeseries_key(ts, atlas,
+			confounds=confounds,
+			mask=mask,
+			low_pass=low_pass,
+			high_pass=high_pass,
+			smoothing_fwhm=smoothing_fwhm,
+			tr=tr,
+			)
+		store_file = path.join(cache, key+'.npz')
+		try:
+			with np.load(store_file) as stored:
+				return stored['timeseries'], stored['labels'].tolist()
+		except (IOError, ValueError, KeyError):
+			pass
+
 	labels_masker = NiftiLabelsMasker(
 		labels_img=atlas,
 		mask_img=mask,
 		standardize=True,
-		memory='nilearn_cache',
-		verbose=5,
+		memory='' if cache else 'nilearn_cache',
+		verbose=0 if cache else 5,
 		low_pass=low_pass,
 		high_pass = high_pass,
 		smoothing_fwhm=smoothing_fwhm,
 		t_r=tr,
 		)
 	#TODO: test confounds with physiological signals
-	if(confounds):
-		confounds = path.abspath(path.expanduser(confounds))
+	if confounds is not None:
 		timeseries = labels_masker.fit_transform(ts, confounds=confounds)
 	else:
 		timeseries = labels_masker.fit_transform(ts)
-	correlation_measure = ConnectivityMeasure(kind='correlation')
+	labels = [i for i in getattr(labels_masker, 'labels_', []) if i != labels_masker.background_label]
+
+	if cache:
+		# Time series are stored column-wise (one column per parcel) in single precision.
+		timeseries = timeseries.astype(np.float32)
+		temp_file = '{}.{}.tmp.npz'.format(store_file[:-4], os.getpid())
+		np.savez_compressed(temp_file, timeseries=timeseries, labels=np.array(labels))
+		os.replace(temp_file, store_file)
+	return timeseries, labels
+
+def connectivity_matrices(ts, atlas,
+	kind='correlation',
+	confounds=None,
+	mask=None,
+	low_pass=0.25,
+	high_pass=0.004,
+	smoothing_fwhm=.3,
+	cache=True,
+	n_jobs=False,
+	memory_budget=None,
+	):
+	"""Return the connectivity matrices of a cohort of scans, computed in batch from their parcel time series.
+	Time series already present in the parcel time series store (see `samri.analysis.fc.parcel_timeseries()`) are not re-extracted, so that only the connectivity estimation is recomputed if e.g. `kind` is changed.
+
+	Parameters
+	----------
+	ts : list of str
+		Paths to the 4D NIfTI timeseries files.
+	atlas : str
+		Path to a 3D NIfTI-like label file designating ROIs.
+	kind : {'correlation', 'partial correlation', 'tangent', 'covariance', 'precision'}, optional
+		Connectivity measure, as accepted by `nilearn.connectome.ConnectivityMeasure`.
+		Group-dependent measures (i.e. 'tangent') are fitted on all scans jointly.
+	confounds : list, optional
+		Confounds (2D arrays or paths to CSV files) for each of the timeseries files.
+
+	Returns
+	-------
+	numpy.ndarray
+		Array of shape (scans, parcels, parcels).
+	"""
+	if confounds is None:
+		confounds = [None]*len(ts)
+	extracted = parallel_map(parcel_timeseries,
+		ts,
+		[atlas]*len(ts),
+		confounds,
+		[mask]*len(ts),
+		[low_pass]*len(ts),
+		[high_pass]*len(ts),
+		[smoothing_fwhm]*len(ts),
+		[cache]*len(ts),
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(i) for i in ts],
+		memory_budget=memory_budget,
+		)
+	connectivity_measure = ConnectivityMeasure(kind=kind)
+	return connectivity_measure.fit_transform([timeseries for timeseries, _ in extracted])
+
+def correlation_matrix(ts,atlas,
+	confounds=None,
+	mask=None,
+	loud=False,
+	structure_names=[],
+	save_as='',
+	low_pass=0.25,
+	high_pass=0.004,
+	smoothing_fwhm=.3,
+	kind='correlation',
+	cache=True,
+	):
+	"""Return a Pandas DataFrame (optionally saveable as CSV) containing correlations between ROIs.
+
+	Parameters
+	----------
+	ts : str
+		Path to the 4D NIfTI timeseries file on which to perform the connectivity analysis.
+	confounds : 2D array OR path to CSV file
+		Array/CSV file containing confounding time-series to be regressed out before FC analysis.
+	atlas : str, optional
+		Path to a 3D NIfTI-like binary label file designating ROIs.
+	structure_names : list, optional
+		Ordered list of all structure names in atlas (length N).
+	save_as : str
+		Path under which to save the Pandas DataFrame conttaining the NxN correlation matrix.
+	kind : str, optional
+		Connectivity measure, as accepted by `nilearn.connectome.ConnectivityMeasure`.
+	cache : bool or str, optional
+		Whether to read and write the parcel time series from the store (see `samri.analysis.fc.parcel_timeseries()`), or path to the store directory.
+	"""
+	timeseries, _ = parcel_timeseries(ts, atlas,
+		confounds=confounds,
+		mask=mask,
+		low_pass=low_pass,
+		high_pass=high_pass,
+		smoothing_fwhm=smoothing_fwhm,
+		cache=cache,
+		)
+	correlation_measure = ConnectivityMeasure(kind=kind)
 	correlation_matrix = correlation_measure.fit_transform([timeseries])[0]
 	if structure_names:
 		df = pd.DataFrame(columns=structure_names, index=structure_names, data=correlation_matrix)
 	else:
 		df = pd.DataFrame(data=correlation_matrix)
 	if save_as:
+		save_as = path.abspath(path.expanduser(save_as))
 		save_dir = path.dirname(save_as)
 		if not path.exists(save_dir):
 			makedirs(save_dir)
 		df.to_csv(save_as)
+	return df
 
 
 def dendogram(correlation_matrix,
@@ -1,6 +1,12 @@
 import nibabel as nib
 import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+from os import path
 from sklearn.mixture import GaussianMixture
+from samri.report.execution import parallel_map
 
 def assign_gaussian(data, n_components, covariance_type,
 	init_params='kmeans',
@@ -18,6 +24,163 @@ def assign_gaussian(data, n_components, covariance_type,
 	assignment = classifier.predict(data)
 	return assignment, classifier, aic, bic
 
+def voxel_stack(path_list, mask, stack_file):
+	"""Write the masked voxel values of a list of NIfTI files to a memory-mappable `.npy` stack of shape (voxels, files), reading one file at a time.
+
+	Parameters
+	----------
+
+	path_list : list
+		List of strings which are paths to existing NIfTI files.
+	mask : numpy.ndarray
+		Flat boolean array selecting the voxels to stack.
+	stack_file : str
+		Path under which to save the stack.
+
+	Returns
+	-------
+
+	numpy.memmap
+		Read-only memory map of the stack.
+	"""
+	stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=np.float32, shape=(int(mask.sum()), len(path_list)))
+	for ix, i in enumerate(path_list):
+		img = nib.load(i)
+		stack[:,ix] = np.asanyarray(img.dataobj).flatten()[mask]
+	stack.flush()
+	del stack
+	return np.load(stack_file, mmap_mode='r')
+
+def stratified_sample(data, n_samples,
+	strata=10,
+	random_state=None,
+	):
+	"""Return sorted indices of a voxel subsample, drawn proportionally from quantile strata of the mean voxel value across inputs, so that the tails of the distribution are represented.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		Array of shape (voxels, features).
+	n_samples : int or float
+		Number of voxels to sample, or fraction of voxels if smaller than 1.
+	strata : int, optional
+		Number of quantile strata.
+	random_state : int, optional
+		Seed of the random number generator.
+	"""
+	n_voxels = data.shape[0]
+	if n_samples < 1:
+		n_samples = int(round(n_samples*n_voxels))
+	n_samples = int(n_samples)
+	if n_samples >= n_voxels:
+		return np.arange(n_voxels)
+	rng = np.random.default_rng(random_state)
+	means = np.asarray(data.mean(axis=1))
+	edges = np.quantile(means, np.linspace(0,1,strata+1)[1:-1])
+	stratum = np.searchsorted(edges, means)
+	indices = []
+	for i in np.unique(stratum):
+		members = np.flatnonzero(stratum == i)
+		n = int(round(n_samples*len(members)/float(n_voxels)))
+		indices.append(rng.choice(members, min(n, len(members)), replace=False))
+	return np.sort(np.concatenate(indices))
+
+def _fit_mixture(stack_file, sample, n_components, covariance_type, init_params, random_state):
+	# Module-level, so that it can be dispatched to worker processes, which read the shared stack via memory mapping.
+	data = np.load(stack_file, mmap_mode='r')
+	if sample is not None:
+		data = data[sample]
+	classifier = GaussianMixture(
+		n_components=n_components,
+		covariance_type=covariance_type,
+		init_params=init_params,
+		n_init=1,
+		random_state=random_state,
+		)
+	classifier.fit(np.asarray(data, dtype=np.float64))
+	return classifier
+
+def n_parameters(n_components, covariance_type, n_features):
+	"""Return the number of free parameters of a Gaussian mixture model, as counted by `sklearn.mixture.GaussianMixture` for its information criteria."""
+	if covariance_type == 'full':
+		covariance_parameters = n_components * n_features * (n_features + 1) / 2.
+	elif covariance_type == 'diag':
+		covariance_parameters = n_components * n_features
+	elif covariance_type == 'tied':
+		covariance_parameters = n_features * (n_features + 1) / 2.
+	elif covariance_type == 'spherical':
+		covariance_parameters = n_components
+	else:
+		raise ValueError("The `covariance_type` parameter must be one of: 'spherical', 'diag', 'tied', 'full'.")
+	mean_parameters = n_features * n_components
+	return int(covariance_parameters + mean_parameters + n_components - 1)
+
+def _predict(classifier, data,
+	block_size=2**18,
+	):
+	"""Return assignments, AIC, and BIC of a fitted classifier over all rows of a (memory-mapped) array, evaluated in blocks."""
+	assignment = np.empty(data.shape[0], dtype=int)
+	log_likelihood = 0.
+	for start in range(0, data.shape[0], block_size):
+		block = np.asarray(data[start:start+block_size], dtype=np.float64)
+		assignment[start:start+block_size] = classifier.predict(block)
+		log_likelihood += classifier.score_samples(block).sum()
+	parameters = n_parameters(classifier.n_components, classifier.covariance_type, classifier.means_.shape[1])
+	aic = -2 * log_likelihood + 2 * parameters
+	bic = -2 * log_likelihood + parameters * np.log(data.shape[0])
+	return assignment, aic, bic
+
+def fit_gaussians(stack_file, models,
+	sample=None,
+	n_init=50,
+	init_params='kmeans',
+	n_jobs=False,
+	random_state=0,
+	):
+	"""Fit several Gaussian mixture models to a memory-mapped voxel stack, distributing all initializations of all models over one pool of worker processes.
+	As in `sklearn.mixture.GaussianMixture`, the initialization with the highest lower bound is kept for each model.
+
+	Parameters
+	----------
+
+	stack_file : str
+		Path to a `.npy` stack of shape (voxels, features), as written by `samri.analysis.segmentation.voxel_stack()`.
+	models : list of tuple
+		(n_components, covariance_type) tuple for each model to fit.
+	sample : numpy.ndarray, optional
+		Indices of the voxels on which to fit; all voxels are used if unspecified.
+	n_init : int, optional
+		Number of initializations per model.
+	n_jobs : int, optional
+		Number of worker processes.
+	random_state : int, optional
+		Seed from which the seeds of the individual initializations are derived.
+
+	Returns
+	-------
+
+	list of sklearn.mixture.GaussianMixture
+		Best fitted classifier for each model.
+	"""
+	seeds = np.random.SeedSequence(random_state).generate_state(len(models)*n_init)
+	jobs = [(n_components, covariance_type, int(seed)) for (n_components, covariance_type), seed in zip([i for i in models for _ in range(n_init)], seeds)]
+	classifiers = parallel_map(_fit_mixture,
+		[stack_file]*len(jobs),
+		[sample]*len(jobs),
+		[i[0] for i in jobs],
+		[i[1] for i in jobs],
+		[init_params]*len(jobs),
+		[i[2] for i in jobs],
+		backend='loky',
+		n_jobs=n_jobs,
+		)
+	best = []
+	for ix in range(len(models)):
+		candidates = classifiers[ix*n_init:(ix+1)*n_init]
+		best.append(max(candidates, key=lambda x: x.lower_bound_))
+	return best
+
 def sort_by_occurence(assignments):
 	"""Change unique values in array to ordinal integers based on the number of occurrences.
 	Parameters
@@ -37,11 +200,22 @@ def sort_by_occurence(assignments):
 	assignments = np.array([convert[x] for x in keys])[inv].reshape(assignments.shape)
 	return assignments
 
+def _mask_and_stack(path_list, mask, stack_dir):
+	mask = nib.load(path.abspath(path.expanduser(mask)))
+	mask_data = np.asanyarray(mask.dataobj).flatten().astype(bool)
+	stack_file = path.join(stack_dir, 'stack.npy')
+	stack = voxel_stack([path.abspath(path.expanduser(i)) for i in path_list], mask_data, stack_file)
+	return mask, mask_data, stack_file, stack
+
 def assignment_from_paths(path_list,
 	components=4,
 	covariance='spherical',
 	mask='/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii',
 	save_as='',
+	sample=None,
+	n_init=50,
+	n_jobs=1,
+	random_state=None,
 	):
 	"""Segment list of paths into Gaussian mixtures
 	Parameters
@@ -55,6 +229,17 @@ def assignment_from_paths(path_list,
 		Covariance model to use for the gaussian mixture model.
 	mask : str, optional
 		Path to a mask in which to segment data.
+	sample : int or float, optional
+		Number (or fraction, if smaller than 1) of voxels on which to fit the models, drawn via `samri.analysis.segmentation.stratified_sample()`.
+		All voxels are then assigned via the fitted models.
+		If unspecified, the models are fitted on all voxels.
+	n_init : int, optional
+		Number of initializations of each of the two (assignment and retest) fits.
+	n_jobs : int, optional
+		Number of worker processes over which to distribute the initializations of both fits.
+		If 1 (and `sample` is unspecified), the fits are run serially on the in-memory data.
+	random_state : int, optional
+		Seed for the subsampling and the initializations of the parallel mode.
 
 	Returns
 	-------
@@ -64,26 +249,32 @@ def assignment_from_paths(path_list,
 	retest_accuracy : float
 		Accuracy of single retest (percentage of assignments which overlap)
 	"""
-	mask = nib.load(mask)
-	data = []
-	affine = mask.affine
-	header = mask.header
-	mask_data = mask.get_data()
-	shape = mask.shape
-	mask_data = mask_data.flatten()
-	mask_data = mask_data.astype(bool)
-	all_data = []
-	for i in path_list:
-		img = nib.load(i)
-		data = img.get_data()
-		data = data.flatten()
-		data = data[mask_data]
-		all_data.append(data)
-	all_data = np.array(all_data)
-	assignments, classifier, aic, bic= assign_gaussian(all_data.T,components,covariance)
+	stack_dir = tempfile.mkdtemp()
+	try:
+		mask, mask_data, stack_file, all_data = _mask_and_stack(path_list, mask, stack_dir)
+		affine = mask.affine
+		header = mask.header
+		shape = mask.shape
+		if n_jobs == 1 and sample is None:
+			all_data = np.asarray(all_data)
+			assignments, classifier, aic, bic= assign_gaussian(all_data,components,covariance, n_init=n_init)
+			assignments_, classifier, aic_, bic_ = assign_gaussian(all_data,components,covariance, n_init=n_init)
+		else:
+			if sample is not None:
+				sample = stratified_sample(all_data, sample, random_state=random_state)
+			# The retest fit is the second model, so that its initializations share the worker pool.
+			classifiers = fit_gaussians(stack_file, [(components, covariance)]*2,
+				sample=sample,
+				n_init=n_init,
+				n_jobs=n_jobs,
+				random_state=random_state,
+				)
+			assignments, aic, bic = _predict(classifiers[0], all_data)
+			assignments_, aic_, bic_ = _predict(classifiers[1], all_data)
+		del all_data
+	finally:
+		shutil.rmtree(stack_dir)
 	assignments = sort_by_occurence(assignments)
-
-	assignments_, classifier, aic_, bic_ = assign_gaussian(all_data.T,components,covariance)
 	assignments_ = sort_by_occurence(assignments_)
 	retest_accuracy = np.mean(assignments_.ravel() == assignments.ravel()) * 100
 
@@ -97,3 +288,73 @@ def assignment_from_paths(path_list,
 		nib.save(assignment_img, save_as)
 
 	return assignment_img, retest_accuracy, aic, aic_, bic, bic_
+
+def information_criteria(path_list,
+	components=range(2,11),
+	covariance='spherical',
+	mask='/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii',
+	sample=None,
+	n_init=10,
+	n_jobs=False,
+	random_state=None,
+	save_as='',
+	):
+	"""Return the AIC and BIC curves of Gaussian mixture segmentations over a range of component numbers, fitting all models in one pool of worker processes.
+
+	Parameters
+	----------
+
+	path_list : list
+		List of strings which are paths to existing NIfTI files.
+	components : list of int, optional
+		Numbers of components for which to fit models.
+	covariance : {'spherical', 'diag', 'tied', 'full'}, optional
+		Covariance model to use for the gaussian mixture model.
+	mask : str, optional
+		Path to a mask in which to segment data.
+	sample : int or float, optional
+		Number (or fraction, if smaller than 1) of voxels on which to fit the models; the criteria are always evaluated on all voxels.
+	n_init : int, optional
+		Number of initializations per model.
+	n_jobs : int, optional
+		Number of worker processes.
+	random_state : int, optional
+		Seed for the subsampling and the initializations.
+	save_as : str, optional
+		Path to which to save the Pandas DataFrame.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+		Pandas DataFrame with columns named 'components', 'AIC', and 'BIC'.
+	"""
+	components = list(components)
+	stack_dir = tempfile.mkdtemp()
+	try:
+		_, _, stack_file, all_data = _mask_and_stack(path_list, mask, stack_dir)
+		if sample is not None:
+			sample = stratified_sample(all_data, sample, random_state=random_state)
+		classifiers = fit_gaussians(stack_file, [(i, covariance) for i in components],
+			sample=sample,
+			n_init=n_init,
+			n_jobs=n_jobs,
+			random_state=random_state,
+			)
+		criteria = [_predict(i, all_data)[1:] for i in classifiers]
+		del all_data
+	finally:
+		shutil.rmtree(stack_dir)
+	df = pd.DataFrame({
+		'components':components,
+		'AIC':[i[0] for i in criteria],
+		'BIC':[i[1] for i in criteria],
+		})
+
+	if save_as:
+		save_as = path.abspath(path.expanduser(save_as))
+		if save_as.lower().endswith('.csv'):
+			df.to_csv(save_as)
+		else:
+			raise ValueError("Please specify an output path ending in any one of "+",".join((".csv",))+".")
+	return df
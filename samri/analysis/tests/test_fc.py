@@ -0,0 +1,167 @@
+import nibabel as nib
+import numpy as np
+
+def _timeseries(tmp_path, shape=(6,5,4), n_volumes=80, n_files=2, random_state=0):
+	"""Write 4D files of noise with a shared signal in two regions, and return their paths."""
+	rng = np.random.RandomState(random_state)
+	paths = []
+	for i in range(n_files):
+		data = rng.normal(size=shape+(n_volumes,))
+		signal = rng.normal(size=n_volumes)
+		data[:3,:2] += signal
+		data[3:,3:] -= 0.5*signal
+		ts_path = str(tmp_path/'sub-{}_task-rest.nii.gz'.format(i))
+		nib.save(nib.Nifti1Image((100+10*data).astype(np.float32), np.eye(4)), ts_path)
+		paths.append(ts_path)
+	return paths
+
+def _mask(tmp_path, name, selection, shape=(6,5,4)):
+	data = np.zeros(shape, dtype=np.uint8)
+	data[selection] = 1
+	mask_path = str(tmp_path/'{}.nii.gz'.format(name))
+	nib.save(nib.Nifti1Image(data, np.eye(4)), mask_path)
+	return mask_path
+
+def test_seed_based(tmp_path):
+	from samri.analysis.fc import add_fc_roi_data, seed_based, shared_seed_correlations
+	from nilearn.input_data import NiftiMasker
+
+	ts_paths = _timeseries(tmp_path)
+	brain = _mask(tmp_path, 'brain', np.s_[:,:,:3])
+	seeds = [_mask(tmp_path, 'seed_a', np.s_[:2,:2,:2]), _mask(tmp_path, 'seed_b', np.s_[4:,3:,1:3])]
+	parameters = dict(smoothing_fwhm=None, detrend=True, standardize=True, low_pass=0.25, high_pass=0.004, t_r=1.)
+
+	# Serial computation, filtering seed and brain time series separately.
+	serial = []
+	for seed in seeds:
+		img = add_fc_roi_data(ts_paths[0], NiftiMasker(mask_img=seed, **parameters), NiftiMasker(mask_img=brain, **parameters))
+		serial.append(np.asanyarray(img.dataobj))
+	brain_masker = NiftiMasker(mask_img=brain, **parameters).fit()
+	shared = shared_seed_correlations(ts_paths[0], seeds, brain_masker)
+	for ix, serial_map in enumerate(serial):
+		assert np.allclose(np.tanh(serial_map[:,:,:3]).reshape(-1), shared[ix], atol=1e-5)
+	shared_img = add_fc_roi_data(ts_paths[0], seeds, brain_masker, shared_filter=True)
+	assert shared_img.shape == (6,5,4,2)
+	assert np.allclose(np.asanyarray(shared_img.dataobj)[...,1], serial[1], atol=1e-4)
+
+	substitutions = [{'subject':str(i)} for i in range(len(ts_paths))]
+	ts_file_template = str(tmp_path/'sub-{subject}_task-rest.nii.gz')
+	results = {}
+	for shared_filter in [False, True]:
+		fc_maps = seed_based(substitutions, seeds[0], brain,
+			ts_file_template=ts_file_template,
+			smoothing_fwhm=None,
+			n_procs=2,
+			cachedir=str(tmp_path/'cache'),
+			shared_filter=shared_filter,
+			)
+		results[shared_filter] = [np.asanyarray(i['result'].dataobj) for i in fc_maps]
+	for serial_map, shared_map in zip(results[False], results[True]):
+		assert np.allclose(serial_map, shared_map, atol=1e-4)
+	assert np.allclose(results[False][0], serial[0], atol=1e-4)
+
+def _serial_parcel_timeseries(ts, atlas):
+	"""Reference implementation, as previously used in `samri.analysis.fc.correlation_matrix()`."""
+	from nilearn.input_data import NiftiLabelsMasker
+
+	labels_masker = NiftiLabelsMasker(
+		labels_img=atlas,
+		standardize=True,
+		low_pass=0.25,
+		high_pass=0.004,
+		smoothing_fwhm=.3,
+		t_r=nib.load(ts).header['pixdim'][0],
+		)
+	return labels_masker.fit_transform(ts)
+
+def test_connectivity_matrices(tmp_path, monkeypatch):
+	from nilearn.connectome import ConnectivityMeasure
+	from samri.analysis.fc import connectivity_matrices, correlation_matrix, parcel_timeseries
+
+	# Uncached extraction uses a nilearn cache in the working directory.
+	monkeypatch.chdir(tmp_path)
+	ts_paths = _timeseries(tmp_path, n_files=3)
+	atlas_data = np.zeros((6,5,4), dtype=np.int16)
+	atlas_data[:3,:2] = 1
+	atlas_data[3:,3:] = 2
+	atlas_data[:,2,:] = 3
+	atlas = str(tmp_path/'atlas.nii.gz')
+	nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas)
+	cache = str(tmp_path/'cache')
+
+	serial = [_serial_parcel_timeseries(i, atlas) for i in ts_paths]
+	for ts, reference in zip(ts_paths, serial):
+		timeseries, labels = parcel_timeseries(ts, atlas, cache=False)
+		assert np.allclose(timeseries, reference)
+		timeseries, _ = parcel_timeseries(ts, atlas, cache=cache)
+		assert np.allclose(timeseries, reference, atol=1e-5)
+		# The second read is served from the store.
+		stored, stored_labels = parcel_timeseries(ts, atlas, cache=cache)
+		assert np.array_equal(stored, timeseries)
+		assert stored_labels == labels
+	assert len(list((tmp_path/'cache').iterdir())) == len(ts_paths)
+
+	for kind in ['correlation', 'tangent']:
+		matrices = connectivity_matrices(ts_paths, atlas, kind=kind, cache=cache, n_jobs=2)
+		assert np.allclose(matrices, ConnectivityMeasure(kind=kind).fit_transform(serial), atol=1e-4)
+
+	df = correlation_matrix(ts_paths[0], atlas,
+		structure_names=['a', 'b', 'c'],
+		cache=cache,
+		save_as=str(tmp_path/'matrix'/'correlation.csv'),
+		)
+	assert list(df.columns) == list(df.index) == ['a', 'b', 'c']
+	assert np.allclose(df.values, ConnectivityMeasure(kind='correlation').fit_transform([serial[0]])[0], atol=1e-4)
+	assert (tmp_path/'matrix'/'correlation.csv').exists()
+
+def _normalized(ts_path, mask):
+	data = np.asanyarray(nib.load(ts_path).dataobj)[mask].T.astype(np.float64)
+	data -= data.mean(axis=0)
+	return data/data.std(axis=0)
+
+def test_migp(tmp_path):
+	from samri.analysis.fc import migp
+
+	ts_paths = _timeseries(tmp_path, n_volumes=40, n_files=3)
+	mask = np.ones((6,5,4), dtype=bool)
+	mask[0,0,0] = False
+	concatenated = np.concatenate([_normalized(i, mask) for i in ts_paths])
+
+	# Without reduction, the temporally concatenated data is returned.
+	assert np.allclose(migp(ts_paths, mask, dimension=120), concatenated, atol=1e-4)
+
+	# With reduction, the leading spatial eigenvectors are those of the concatenated data.
+	reduced = migp(ts_paths, mask, dimension=30)
+	assert reduced.shape == (30, mask.sum())
+	_, _, reference = np.linalg.svd(concatenated, full_matrices=False)
+	_, _, streamed = np.linalg.svd(reduced, full_matrices=False)
+	assert abs(np.dot(reference[0], streamed[0])) > 0.99
+	# The leading eigenvectors (one signal per subject) lie within the span of the reduction.
+	for i in range(3):
+		assert np.linalg.norm(np.dot(streamed, reference[i])) > 0.99
+
+def test_dual_regression_stages(tmp_path):
+	from samri.analysis.fc import dual_regression_stages
+
+	ts_path = _timeseries(tmp_path, n_files=1)[0]
+	mask = np.ones((6,5,4), dtype=bool)
+	mask[:,:,3] = False
+	rng = np.random.RandomState(1)
+	group_maps = rng.normal(size=(3, mask.sum()))
+	out_file = str(tmp_path/'dr'/'sub-0_dr.nii.gz')
+	timecourses_file = str(tmp_path/'dr'/'sub-0_dr.txt')
+	assert dual_regression_stages(ts_path, group_maps, mask, out_file, timecourses_file) == out_file
+
+	# Reference as computed by `fsl_glm` in FSL's `dual_regression` script.
+	data = np.asanyarray(nib.load(ts_path).dataobj)[mask].T.astype(np.float64)
+	design = (group_maps - group_maps.mean(axis=1, keepdims=True)).T
+	timecourses = np.linalg.lstsq(design, (data - data.mean(axis=1, keepdims=True)).T, rcond=None)[0].T
+	design = timecourses - timecourses.mean(axis=0)
+	design /= design.std(axis=0)
+	maps = np.linalg.lstsq(design, data - data.mean(axis=0), rcond=None)[0]
+
+	assert np.allclose(np.loadtxt(timecourses_file), timecourses, rtol=1e-4, atol=1e-6)
+	out_data = np.asanyarray(nib.load(out_file).dataobj)
+	assert out_data.shape == (6,5,4,3)
+	assert np.allclose(out_data[mask], maps.T, rtol=1e-3, atol=1e-4)
+	assert not out_data[~mask].any()
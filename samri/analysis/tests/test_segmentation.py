@@ -0,0 +1,52 @@
+import nibabel as nib
+import numpy as np
+
+def _clustered_data(n_voxels=600, random_state=0):
+	"""Voxel values of two features, drawn from three well separated clusters of distinct sizes."""
+	rng = np.random.RandomState(random_state)
+	sizes = [300, 200, 100]
+	centers = [[0,0], [10,10], [-10,10]]
+	data = np.concatenate([rng.normal(center, 1, size=(size,2)) for center, size in zip(centers, sizes)])
+	return data[rng.permutation(n_voxels)]
+
+def test_predict():
+	from sklearn.mixture import GaussianMixture
+	from samri.analysis.segmentation import _predict
+
+	data = _clustered_data()
+	for covariance_type in ['spherical', 'diag', 'tied', 'full']:
+		classifier = GaussianMixture(n_components=3, covariance_type=covariance_type, random_state=0).fit(data)
+		assignment, aic, bic = _predict(classifier, data, block_size=64)
+		assert np.array_equal(assignment, classifier.predict(data))
+		assert np.isclose(aic, classifier.aic(data))
+		assert np.isclose(bic, classifier.bic(data))
+
+def test_assignment_from_paths(tmp_path):
+	from samri.analysis.segmentation import assignment_from_paths
+
+	data = _clustered_data()
+	shape = (10,6,10)
+	mask = str(tmp_path/'mask.nii.gz')
+	nib.save(nib.Nifti1Image(np.ones(shape, dtype=np.uint8), np.eye(4)), mask)
+	path_list = []
+	for i in range(2):
+		path_list.append(str(tmp_path/'feature{}.nii.gz'.format(i)))
+		nib.save(nib.Nifti1Image(data[:,i].reshape(shape).astype(np.float32), np.eye(4)), path_list[-1])
+
+	serial_img, serial_accuracy, _, _, serial_bic, _ = assignment_from_paths(path_list,
+		components=3,
+		mask=mask,
+		n_init=2,
+		)
+	subsampled_img, subsampled_accuracy, _, _, subsampled_bic, _ = assignment_from_paths(path_list,
+		components=3,
+		mask=mask,
+		sample=0.3,
+		n_init=2,
+		n_jobs=2,
+		random_state=0,
+		)
+	assert serial_accuracy == subsampled_accuracy == 100
+	assert np.array_equal(np.asanyarray(serial_img.dataobj), np.asanyarray(subsampled_img.dataobj))
+	# Models fitted on the subsample are close to, if not as likely as, the model fitted on all voxels.
+	assert np.isclose(serial_bic, subsampled_bic, rtol=1e-2)
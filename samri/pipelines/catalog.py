@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import sqlite3
+import pandas as pd
+from os import path
+
+# Top-level directories which are not indexed (as per the PyBIDS defaults).
+IGNORE_TOPLEVEL = ('code', 'derivatives', 'sourcedata', 'stimuli')
+CATALOG_DIR = path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'samri', 'catalogs')
+
+SCHEMA = '''
+	CREATE TABLE IF NOT EXISTS directories (
+		path TEXT PRIMARY KEY,
+		parent TEXT,
+		mtime INTEGER
+		);
+	CREATE TABLE IF NOT EXISTS files (
+		path TEXT PRIMARY KEY,
+		directory TEXT,
+		entities TEXT
+		);
+	CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+	CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+	'''
+
+def catalog_path(base):
+	"""Return the path of the catalog file for a BIDS directory.
+
+	Catalogs are stored in the user cache directory (`samri.pipelines.catalog.CATALOG_DIR`), keyed by the path of the BIDS directory, so that the BIDS directory itself is never written to.
+	"""
+	base = path.abspath(path.expanduser(base))
+	os.makedirs(CATALOG_DIR, exist_ok=True)
+	base_hash = hashlib.sha1(base.encode('utf-8')).hexdigest()
+	return path.join(CATALOG_DIR, base_hash+'.sqlite')
+
+def _parse_entities(file_path):
+	try:
+		from bids.layout import parse_file_entities
+	except ImportError:
+		from bids.layout.layout import parse_file_entities
+	entities = parse_file_entities(file_path)
+	# PyBIDS may return `int` subclasses (e.g. for zero-padded runs), which we store as plain values.
+	return {key: (int(value) if isinstance(value, int) else value) for key, value in entities.items()}
+
+def _index_directory(connection, base, directory, mtime, parent):
+	"""(Re)index the entries of one directory, returning the paths of its subdirectories."""
+	subdirectories = []
+	files = []
+	for entry in os.scandir(directory):
+		if entry.name.startswith('.'):
+			continue
+		if directory == base and entry.name in IGNORE_TOPLEVEL:
+			continue
+		if entry.is_dir():
+			subdirectories.append(entry.path)
+		else:
+			files.append((entry.path, directory, json.dumps(_parse_entities(entry.path))))
+	connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+	connection.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?)', files)
+	# Subdirectories which no longer exist are removed recursively.
+	stale = [i for (i,) in connection.execute('SELECT path FROM directories WHERE parent = ?', (directory,)) if i not in subdirectories]
+	for stale_directory in stale:
+		_drop_directory(connection, stale_directory)
+	connection.execute('INSERT OR REPLACE INTO directories VALUES (?,?,?)', (directory, parent, mtime))
+	return subdirectories
+
+def _drop_directory(connection, directory):
+	for (subdirectory,) in list(connection.execute('SELECT path FROM directories WHERE parent = ?', (directory,))):
+		_drop_directory(connection, subdirectory)
+	connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+	connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+
+def update_catalog(base,
+	catalog=None,
+	):
+	"""
+	Create or incrementally update the on-disk file catalog of a BIDS directory.
+	Only directories whose modification time has changed since the last update are listed and have their file names parsed.
+
+	Parameters
+	----------
+
+	base : str
+		Path to the root of the BIDS directory.
+	catalog : str, optional
+		Path to the SQLite catalog file, by default determined via `samri.pipelines.catalog.catalog_path()`.
+
+	Returns
+	-------
+
+	str
+		Path to the catalog file.
+	"""
+
+	base = path.abspath(path.expanduser(base))
+	if not catalog:
+		catalog = catalog_path(base)
+	connection = sqlite3.connect(catalog)
+	try:
+		connection.executescript(SCHEMA)
+		mtimes = dict(connection.execute('SELECT path, mtime FROM directories'))
+		queue = [(base, None)]
+		while queue:
+			directory, parent = queue.pop()
+			mtime = os.stat(directory).st_mtime_ns
+			if mtimes.get(directory) == mtime:
+				subdirectories = [i for (i,) in connection.execute('SELECT path FROM directories WHERE parent = ?', (directory,))]
+			else:
+				subdirectories = _index_directory(connection, base, directory, mtime, parent)
+			queue.extend([(i, directory) for i in subdirectories])
+		connection.commit()
+	finally:
+		connection.close()
+	return catalog
+
+def catalog_df(base,
+	catalog=None,
+	update=True,
+	):
+	"""
+	Return a BIDS-Information Pandas DataFrame (equivalent to `bids.BIDSLayout(base, validate=False).to_df()`) from the on-disk catalog of a BIDS directory.
+
+	Parameters
+	----------
+
+	base : str
+		Path to the root of the BIDS directory.
+	catalog : str, optional
+		Path to the SQLite catalog file, by default determined via `samri.pipelines.catalog.catalog_path()`.
+	update : bool, optional
+		Whether to incrementally update the catalog before querying it.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+		A Pandas DataFrame with a 'path' column, and a column for each BIDS entity present in the directory.
+	"""
+
+	base = path.abspath(path.expanduser(base))
+	if update:
+		catalog = update_catalog(base, catalog)
+	elif not catalog:
+		catalog = catalog_path(base)
+	connection = sqlite3.connect(catalog)
+	try:
+		records = []
+		for file_path, entities in connection.execute('SELECT path, entities FROM files ORDER BY path'):
+			record = {'path':file_path}
+			record.update(json.loads(entities))
+			records.append(record)
+	finally:
+		connection.close()
+	df = pd.DataFrame.from_records(records)
+	if df.empty:
+		df = pd.DataFrame(columns=['path'])
+	df = df[['path'] + sorted([i for i in df.columns if i != 'path'])]
+	return df
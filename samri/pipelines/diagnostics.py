@@ -16,6 +16,7 @@ import pandas as pd
 from nipype.interfaces import fsl, nipy, bru2nii
 
 from samri.pipelines.extra_functions import force_dummy_scans, get_tr
+from samri.pipelines.resources import plan_resources
 from samri.pipelines.utils import out_path, container
 from samri.utilities import N_PROCS
 
@@ -38,6 +39,7 @@ def diagnose(bids_base,
 	keep_crashdump=False,
 	keep_work=False,
 	match_regex='.+/sub-(?P<sub>[a-zA-Z0-9]+)/ses-(?P<ses>[a-zA-Z0-9]+)/.*?_task-(?P<task>[a-zA-Z0-9]+)_acq-(?P<acq>[a-zA-Z0-9]+)_run-(?P<run>[a-zA-Z0-9]+)_(?P<mod>[a-zA-Z0-9]+).(?:nii|nii\.gz)',
+	memory_budget=None,
 	n_procs=N_PROCS,
 	realign="time",
 	tr=None,
@@ -68,6 +70,8 @@ def diagnose(bids_base,
 		This is useful for debugging and quality control.
 	match_regex : str, optional
 		Regex matching pattern by which to select input files. Has to contain groups named "sub", "ses", "acq", "task", and "mod".
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_procs : int, optional
 		Maximum number of processes which to simultaneously spawn for the workflow.
 		If not explicitly defined, this is automatically calculated from the number of available cores and under the assumption that the workflow will be the main process running for the duration that it is running.
@@ -206,13 +210,17 @@ def diagnose(bids_base,
 	workflow.config = workflow_config
 	workflow.write_graph(dotfilename=path.join(workflow.base_dir,workdir_name,"graph.dot"), graph2use="hierarchical", format="png")
 
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_procs,
+		memory_budget=memory_budget,
+		)
 	if not keep_work or not keep_crashdump:
 		try:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+			workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 		except RuntimeError:
 			pass
 	else:
-		workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+		workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	if not keep_work:
 		shutil.rmtree(path.join(workflow.base_dir,workdir_name))
 	if not keep_crashdump:
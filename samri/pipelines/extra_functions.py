@@ -112,10 +112,50 @@ def extract_volume(in_file, volume,
 	img_ = nib.Nifti1Image(extracted_data, img.affine, img.header)
 	nib.save(img_,out_file)
 
+def background_modes(data,
+	restriction_range='auto',
+	):
+	"""
+	Return the mode (the smallest of the most frequent values) of each volume of a 4D array, for all volumes at once.
+	Values are counted jointly via `numpy.bincount` over (volume, value) pairs, rather than per volume.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		4D array of volumes.
+	restriction_range : int or string, optional
+		Edge length of the corner bounding box on which the modes are determined.
+		If auto, the size of the smallest spatial axis is used, and if the variable evaluates as false, the whole volumes are used.
+
+	Returns
+	-------
+
+	numpy.ndarray
+		Mode of each volume.
+	"""
+
+	import numpy as np
+
+	if restriction_range == 'auto':
+		restriction_range = min(np.shape(data)[:3])
+	if restriction_range:
+		data = data[:restriction_range,:restriction_range,:restriction_range]
+	values = np.reshape(data, (-1, np.shape(data)[3]))
+	unique_values, inverse = np.unique(values, return_inverse=True)
+	inverse = np.reshape(inverse, values.shape)
+	counts = np.bincount((inverse + np.arange(values.shape[1])*len(unique_values)).ravel(order='F'),
+		minlength=len(unique_values)*values.shape[1],
+		)
+	counts = counts.reshape((values.shape[1], len(unique_values)))
+	# `argmax` returns the first maximum, i.e. the smallest value, as does `scipy.stats.mode`.
+	return unique_values[np.argmax(counts, axis=1)]
+
 def reset_background(in_file,
 	bg_value=0,
 	out_file='background_reset_complete.nii.gz',
 	restriction_range='auto',
+	chunk_size=2**28,
 	):
 	"""
 	Set the background voxel value of a 4D NIfTI time series to a given value.
@@ -136,26 +176,45 @@ def reset_background(in_file,
 		What restricted range (if any) to use as the bounding box for the image area on which the mode is actually determined.
 		If auto, the mode is determined on a bounding box the size of the smallest spatial axis.
 		If the variable evaluates as false, no restriction will be used and the mode will be calculated given all spatial data --- which can be extremely time-consuming.
+	chunk_size : int, optional
+		Approximate number of bytes of data to process at a time.
+		The data is read in chunks of whole volumes, and written via a memory map, so that the time series is never fully held in memory.
 	"""
 
 	import nibabel as nib
 	import numpy as np
-	from scipy import stats
+	import os
+	import tempfile
+	from os import path
+	from samri.pipelines.extra_functions import background_modes
 
-	img = nib.load(in_file)
-	data = img.get_data()
-	number_of_slices = np.shape(data)[3]
-	if restriction_range == 'auto':
-		restriction_range = min(np.shape(data)[:3])
-	for i in range(number_of_slices):
-		if not restriction_range:
-			old_bg_value = stats.mode(data[:,:,:,i])
-		else:
-			old_bg_value = stats.mode(data[:restriction_range,:restriction_range,:restriction_range,i].flatten())
-		old_bg_value = old_bg_value.mode[0]
-		data[:,:,:,i][data[:,:,:,i]==old_bg_value] = bg_value
-	img_ = nib.Nifti1Image(data, img.affine, img.header)
-	nib.save(img_,out_file)
+	in_file = path.abspath(path.expanduser(in_file))
+	out_file = path.abspath(path.expanduser(out_file))
+	img = nib.load(in_file, keep_file_open=True)
+	shape = img.shape
+	volume_size = int(np.prod(shape[:3]))*np.dtype(img.get_data_dtype()).itemsize
+	chunk_volumes = max(1, int(chunk_size//max(volume_size, 1)))
+
+	temp_file = tempfile.NamedTemporaryFile(dir=path.dirname(out_file), suffix='.dat', delete=False)
+	temp_file.close()
+	try:
+		data = None
+		# Volumes are read in order, so that compressed files are decompressed only once.
+		for start in range(0, shape[3], chunk_volumes):
+			stop = min(start+chunk_volumes, shape[3])
+			chunk = np.asanyarray(img.dataobj[...,start:stop])
+			if data is None:
+				data = np.memmap(temp_file.name, dtype=chunk.dtype, mode='w+', shape=shape, order='F')
+			modes = background_modes(chunk, restriction_range)
+			data[...,start:stop] = chunk
+			data[...,start:stop][chunk == modes] = bg_value
+		img_ = nib.Nifti1Image(data, img.affine, img.header)
+		nib.save(img_,out_file)
+		del data, img_
+	finally:
+		os.remove(temp_file.name)
+
+	return out_file
 
 def force_dummy_scans(in_file,
 	desired_dummy_scans=10,
@@ -201,6 +260,109 @@ def force_dummy_scans(in_file,
 
 	return out_file, deleted_scans
 
+def fused_dummy_scans(in_file,
+	desired_dummy_scans=10,
+	out_file="forced_dummy_scans_file.nii.gz",
+	mean_file="temporal_mean.nii.gz",
+	background_value=None,
+	restriction_range='auto',
+	chunk_size=2**28,
+	):
+	"""Crop initial timepoints (as `samri.pipelines.extra_functions.force_dummy_scans()`), optionally reset the background (as `samri.pipelines.extra_functions.reset_background()`), and compute the temporal mean, in a single chunked pass over the input file.
+	The cropped time series is written only once, and if it is identical to the input, the input file is copied without being recompressed.
+
+	in_file : string
+	BIDS-compliant path to the 4D NIfTI file for which to force dummy scans.
+
+	desired_dummy_scans : int , optional
+	Desired timepoints dummy scans.
+
+	out_file : string, optional
+	Path where the cropped NIfTI time series will be written.
+
+	mean_file : string, optional
+	Path where the (single-precision) temporal mean NIfTI image of the cropped time series will be written.
+
+	background_value : float, optional
+	What value to insert in voxels identified as background; if `None`, the background is not reset.
+
+	restriction_range : int or string, optional
+	Bounding box on which the background value is determined, as accepted by `samri.pipelines.extra_functions.reset_background()`.
+
+	chunk_size : int, optional
+	Approximate number of bytes of data to process at a time.
+	"""
+
+	import json
+	import nibabel as nib
+	import numpy as np
+	import os
+	import shutil
+	import tempfile
+	from os import path
+	from samri.pipelines.extra_functions import background_modes
+
+	out_file = path.abspath(path.expanduser(out_file))
+	mean_file = path.abspath(path.expanduser(mean_file))
+	in_file = path.abspath(path.expanduser(in_file))
+	in_file_dir = path.dirname(in_file)
+	in_file_name = path.basename(in_file)
+	in_file_noext = in_file_name.split('.', 1)[0]
+	metadata_file = path.join(in_file_dir, in_file_noext+'.json')
+
+	metadata = json.load(open(metadata_file))
+
+	dummy_scans = 0
+	try:
+		dummy_scans = metadata['NumberOfVolumesDiscardedByScanner']
+	except:
+		pass
+
+	delete_scans = desired_dummy_scans - dummy_scans
+	start_volume = max(delete_scans, 0)
+
+	img = nib.load(in_file, keep_file_open=True)
+	shape = img.shape
+	out_shape = shape[:3]+(shape[3]-start_volume,)
+	volume_size = int(np.prod(shape[:3]))*np.dtype(img.get_data_dtype()).itemsize
+	chunk_volumes = max(1, int(chunk_size//max(volume_size, 1)))
+	# Without changes to the data, the compressed input can be reused as-is.
+	copy_input = start_volume == 0 and background_value is None and in_file_name.split('.', 1)[-1] == path.basename(out_file).split('.', 1)[-1]
+
+	temp_file = tempfile.NamedTemporaryFile(dir=path.dirname(out_file), suffix='.dat', delete=False)
+	temp_file.close()
+	try:
+		data = None
+		total = np.zeros(shape[:3], dtype=np.float64)
+		for start in range(start_volume, shape[3], chunk_volumes):
+			stop = min(start+chunk_volumes, shape[3])
+			chunk = np.asanyarray(img.dataobj[...,start:stop])
+			if background_value is not None:
+				modes = background_modes(chunk, restriction_range)
+				chunk = np.where(chunk == modes, np.asarray(background_value, dtype=chunk.dtype), chunk)
+			total += chunk.sum(axis=3, dtype=np.float64)
+			if copy_input:
+				continue
+			if data is None:
+				data = np.memmap(temp_file.name, dtype=chunk.dtype, mode='w+', shape=out_shape, order='F')
+			data[...,start-start_volume:stop-start_volume] = chunk
+		if copy_input:
+			shutil.copyfile(in_file, out_file)
+		else:
+			img_ = nib.Nifti1Image(data, img.affine, img.header)
+			nib.save(img_,out_file)
+			del data, img_
+	finally:
+		os.remove(temp_file.name)
+
+	header = img.header.copy()
+	header.set_data_dtype(np.float32)
+	mean = (total/out_shape[3]).astype(np.float32)
+	nib.save(nib.Nifti1Image(mean, img.affine, header), mean_file)
+	deleted_scans = delete_scans
+
+	return out_file, deleted_scans, mean_file
+
 def get_tr(in_file,
 	ndim=4,
 	):
@@ -807,6 +969,254 @@ def match_exclude_ss(entry, match, exclude, record, key):
 	else:
 		return False
 
+SCAN_PROGRAM_LINE = re.compile(r'^[ \t]+<displayName>[a-zA-Z0-9-_]+? \(E\d+\)</displayName>[\r\n]+')
+SCAN_PROGRAM_SCAN = re.compile(r'^[ \t]+<displayName>(?P<scan_type>.+?) \(E(?P<number>\d+)\)</displayName>[\r\n]+')
+ACQP_LINE = re.compile(r'^(?!/)<[a-zA-Z0-9-_]+?-[a-zA-Z0-9-_]+?>[\r\n]+')
+ACQP_SCAN = re.compile(r'^(?!/)<(?P<scan_type>.+?)>[\r\n]+')
+SUBJECT_POSITION = re.compile(r'^##\$SUBJECT_position=SUBJ_POS_(?P<position>.+?)$')
+SUBJECT_VALUE = re.compile(r'[<>\n]')
+
+def measurement_cache_path(workflow_base):
+	"""Return the path of the parsed measurement cache for a Bruker measurement base directory, which is stored in the user cache directory."""
+	import hashlib
+
+	workflow_base = os.path.abspath(os.path.expanduser(workflow_base))
+	cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'samri', 'bruker')
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	base_hash = hashlib.sha1(workflow_base.encode('utf-8')).hexdigest()
+	return os.path.join(cache_dir, base_hash+'.json')
+
+def _mtime(file_path):
+	try:
+		return os.stat(file_path).st_mtime_ns
+	except OSError:
+		return None
+
+def _measurement_key(measurement_path):
+	return [_mtime(measurement_path), _mtime(os.path.join(measurement_path,'subject')), _mtime(os.path.join(measurement_path,'ScanProgram.scanProgram'))]
+
+def _parse_measurement(measurement_path):
+	"""
+	Parse the subject information and the scan program of a Bruker measurement directory.
+	The per-scan `acqp` files are only parsed on demand, via `samri.pipelines.extra_functions._parse_acqp()`.
+	"""
+	record = {}
+	try:
+		with open(os.path.join(measurement_path,'subject'), 'r') as state_file:
+			for current_line in state_file:
+				if "##$SUBJECT_id=" in current_line:
+					record['subject'] = SUBJECT_VALUE.sub("", state_file.readline())
+				if "##$SUBJECT_study_name=" in current_line:
+					record['session'] = SUBJECT_VALUE.sub("", state_file.readline())
+				if "##$SUBJECT_position=SUBJ_POS_" in current_line:
+					record['PV_position'] = SUBJECT_POSITION.match(current_line).groupdict()['position']
+				if len(record) == 3:
+					break
+	except IOError:
+		return None
+	scans = None
+	try:
+		with open(os.path.join(measurement_path,'ScanProgram.scanProgram')) as search:
+			scans = []
+			for line in search:
+				if SCAN_PROGRAM_LINE.match(line):
+					m = SCAN_PROGRAM_SCAN.match(line)
+					number = str(int(m.groupdict()['number']))
+					scans.append([m.groupdict()['scan_type'], number, line, os.path.isdir(os.path.join(measurement_path,number))])
+	except IOError:
+		pass
+	record['scan_program'] = scans
+	record['acqp'] = None
+	return record
+
+def _parse_acqp(measurement_path):
+	"""Return the candidate scan types listed in the `acqp` file of each scan directory of a Bruker measurement directory."""
+	scans = []
+	for sub_sub_dir in os.listdir(measurement_path):
+		candidates = []
+		try:
+			with open(os.path.join(measurement_path,sub_sub_dir,'acqp'),'r') as search:
+				for line in search:
+					if ACQP_LINE.match(line):
+						candidates.append([ACQP_SCAN.match(line).groupdict()['scan_type'], line])
+		except IOError:
+			continue
+		scans.append([sub_sub_dir, candidates])
+	return scans
+
+def _scan_measurements(workflow_base, measurements, exclude_measurements, cache):
+	"""
+	Return `(measurement_path, record)` tuples for the Bruker measurement directories under a base directory, as well as the cache contents and cache path.
+	Records are keyed by the modification times of the measurement directory and of its `subject` and `ScanProgram.scanProgram` files, so that only new or changed measurements are parsed.
+	"""
+
+	workflow_base = os.path.abspath(os.path.expanduser(workflow_base))
+
+	if not measurements:
+		measurements = os.listdir(workflow_base)
+	measurement_path_list = [os.path.join(workflow_base,i) for i in measurements]
+
+	cache_file = None
+	cached = {}
+	if cache:
+		cache_file = cache if isinstance(cache, str) else measurement_cache_path(workflow_base)
+		try:
+			with open(cache_file, 'r') as f:
+				cached = json.load(f)
+		except (IOError, ValueError):
+			cached = {}
+
+	records = []
+	for sub_dir in measurement_path_list:
+		if sub_dir in exclude_measurements:
+			continue
+		key = _measurement_key(sub_dir)
+		try:
+			entry = cached[sub_dir]
+			if entry['key'] != key:
+				raise KeyError
+		except KeyError:
+			entry = {'key':key, 'record':_parse_measurement(sub_dir)}
+			cached[sub_dir] = entry
+		records.append((sub_dir, entry['record']))
+	return records, cached, cache_file
+
+def _save_measurement_cache(cached, cache_file):
+	# Write to a temporary file first, so that concurrent readers never see a partial cache.
+	temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+	try:
+		with open(temp_file, 'w') as f:
+			json.dump(cached, f)
+		os.replace(temp_file, cache_file)
+	except IOError:
+		pass
+
+def _scan_considered(bids_keys, match):
+	for key in match:
+		# Session and subject fields are not recorded in scan_type and are checked at the measurement level.
+		if key in ['session', 'subject']:
+			continue
+		try:
+			if bids_keys[key] not in match[key]:
+				return False
+		except KeyError:
+			return False
+	return True
+
+def _select_scans(measurement_path, record, match, exclude, fail_suffix, bids_entities):
+	"""Return the scan records of one parsed measurement which satisfy the match and exclude criteria."""
+	selected_measurement = {}
+	for key in ['subject', 'session']:
+		if key in record and not match_exclude_ss(record[key], match, exclude, selected_measurement, key):
+			return []
+	if 'PV_position' in record:
+		selected_measurement['PV_position'] = record['PV_position']
+	elif selected_measurement.get('subject') and selected_measurement.get('session'):
+		selected_measurement['PV_position'] = 'UDEFINED'
+	selected_measurement['measurement'] = measurement_path
+
+	selected_scans = []
+	run_counter = 0
+	if record['scan_program']:
+		fail_regex = re.compile(r'^.+?{} \(E\d+\)</displayName>[\r\n]+'.format(fail_suffix)) if fail_suffix else None
+		for scan_type, number, line, exists in record['scan_program']:
+			if fail_regex and fail_regex.match(line):
+				continue
+			bids_keys = bids_entities(scan_type)
+			if _scan_considered(bids_keys, match) and exists:
+				measurement_copy = deepcopy(selected_measurement)
+				measurement_copy['scan_type'] = str(scan_type).strip(' ')
+				measurement_copy['scan'] = number
+				measurement_copy['run'] = run_counter
+				scan_type, measurement_copy = assign_modality(scan_type, measurement_copy)
+				measurement_copy.update(bids_keys)
+				run_counter += 1
+				selected_scans.append(measurement_copy)
+	if not selected_scans:
+		if record['acqp'] is None:
+			record['acqp'] = _parse_acqp(measurement_path)
+		fail_regex = re.compile(r'^.+?{}$'.format(fail_suffix)) if fail_suffix else None
+		for number, candidates in record['acqp']:
+			for scan_type, line in candidates:
+				if fail_regex and fail_regex.match(line):
+					continue
+				bids_keys = bids_entities(scan_type)
+				if _scan_considered(bids_keys, match):
+					measurement_copy = deepcopy(selected_measurement)
+					measurement_copy['scan_type'] = str(scan_type).strip(' ')
+					measurement_copy['scan'] = str(int(number))
+					measurement_copy['run'] = run_counter
+					scan_type, measurement_copy = assign_modality(scan_type, measurement_copy)
+					measurement_copy.update(bids_keys)
+					run_counter += 1
+					selected_scans.append(measurement_copy)
+					break
+	return selected_scans
+
+def get_data_selections(workflow_base, matches,
+	exclude={},
+	measurements=[],
+	exclude_measurements=[],
+	fail_suffix='_failed',
+	cache=True,
+	):
+	"""
+	Return a list of `pandas.DataFrame` objects of the Bruker measurement directories located under a given base directory, and their respective scans, subjects, and tasks, one for each of a list of matching criteria.
+	Measurement directories are parsed only once for all matching criteria, and (if `cache` is enabled) only if they have changed since the last call.
+
+	Parameters
+	----------
+	workflow_base : str
+		The path in which to query for Bruker measurement directories.
+	matches : list of dict
+		A list of matching criteria dictionaries, as accepted by the `match` parameter of `samri.pipelines.extra_functions.get_data_selection()`.
+	exclude : dict, optional
+		A dictionary of exclusion criteria.
+		The keys of this dictionary must be full BIDS key names (e.g. "task" or "acquisition"), and the values must be strings (e.g. "CogB") which, combined with the respective BIDS key, identify scans to be excluded(e.g. a scans, the names of which contain the string "task-CogB" - delimited on either side by an underscore or the limit of the string).
+	measurements : list of str, optional
+		A list of measurement directory names to be included exclusively (i.e. whitelist).
+		If the list is empty, all directories (unless explicitly excluded via `exclude_measurements`) will be queried.
+	exclude_measurements : list of str, optional
+		A list of measurement directory names to be excluded from querying (i.e. a blacklist).
+	fail_suffix : str, optional
+		Scan name suffix identifying failed scans, which are not selected.
+	cache : bool or str, optional
+		Whether to use the on-disk measurement cache, or path to the cache file (by default determined via `samri.pipelines.extra_functions.measurement_cache_path()`).
+
+	Returns
+	-------
+	list of pandas.DataFrame
+		A data selection for each item of `matches`.
+	"""
+	try:
+		from bids.layout import parse_file_entities
+	except ImportError:
+		from bids.layout.layout import parse_file_entities
+
+	records, cached, cache_file = _scan_measurements(workflow_base, measurements, exclude_measurements, cache)
+
+	entities = {}
+	def bids_entities(scan_type):
+		# The same scan types recur across measurements, so their BIDS entities are parsed only once.
+		if scan_type not in entities:
+			entities[scan_type] = parse_file_entities('/{}'.format(scan_type))
+		return dict(entities[scan_type])
+
+	data_selections = []
+	for match in matches:
+		selected_measurements = []
+		for measurement_path, record in records:
+			if record is None:
+				print('Could not open {}'.format(os.path.join(measurement_path,"subject")))
+				continue
+			selected_measurements.extend(_select_scans(measurement_path, record, match, exclude, fail_suffix, bids_entities))
+		data_selections.append(pd.DataFrame(selected_measurements))
+
+	if cache_file:
+		_save_measurement_cache(cached, cache_file)
+	return data_selections
+
 def get_data_selection(workflow_base,
 	match={},
 	exclude={},
@@ -814,6 +1224,7 @@ def get_data_selection(workflow_base,
 	exclude_measurements=[],
 	count_runs=False,
 	fail_suffix='_failed',
+	cache=True,
 	):
 	"""
 	Return a `pandas.DataFrame` object of the Bruker measurement directories located under a given base directory, and their respective scans, subjects, and tasks.
@@ -833,148 +1244,22 @@ def get_data_selection(workflow_base,
 		If the list is empty, all directories (unless explicitly excluded via `exclude_measurements`) will be queried.
 	exclude_measurements : list of str, optional
 		A list of measurement directory names to be excluded from querying (i.e. a blacklist).
+	cache : bool or str, optional
+		Whether to use the on-disk measurement cache, or path to the cache file (by default determined via `samri.pipelines.extra_functions.measurement_cache_path()`).
 
 	Notes
 	-----
 	This data selector function is robust to `ScanProgram.scanProgram` files which have been truncated before the first detected match, but not to files truncated after at least one match.
+	To query the same measurements for multiple matching criteria, use `samri.pipelines.extra_functions.get_data_selections()`, which parses each measurement only once.
 	"""
 
-	workflow_base = os.path.abspath(os.path.expanduser(workflow_base))
-
-	if not measurements:
-		measurements = os.listdir(workflow_base)
-	measurement_path_list = [os.path.join(workflow_base,i) for i in measurements]
-
-	selected_measurements=[]
-	# Create a dummy path for bidsgrabber to parse file names from.
-	# Ideally we could avoid this: https://github.com/bids-standard/pybids/issues/633
-	bids_temppath = '/var/tmp/samri_bids_temppaths/'
-	try:
-		os.mkdir(bids_temppath)
-	except FileExistsError:
-		pass
-	data = {}
-	data['Name'] = ''
-	data['BIDSVersion'] = ''
-	with open(os.path.join(bids_temppath,'dataset_description.json'), 'w') as outfile:
-		json.dump(data, outfile)
-	layout = BIDSLayout(bids_temppath)
-	#populate a list of lists with acceptable subject names, sessions, and sub_dir's
-	for sub_dir in measurement_path_list:
-		if sub_dir not in exclude_measurements:
-			run_counter = 0
-			selected_measurement = {}
-			try:
-				state_file = open(os.path.join(workflow_base,sub_dir,"subject"), "r")
-				read_variables=0 #count variables so that breaking takes place after both have been read
-				for current_line in state_file:
-					if "##$SUBJECT_id=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if not match_exclude_ss(entry, match, exclude, selected_measurement, 'subject'):
-							break
-						read_variables +=1 #count recorded variables
-					if "##$SUBJECT_study_name=" in current_line:
-						entry=re.sub("[<>\n]", "", state_file.readline())
-						if not match_exclude_ss(entry, match, exclude, selected_measurement, 'session'):
-							break
-						read_variables +=1 #count recorded variables
-					if "##$SUBJECT_position=SUBJ_POS_" in current_line:
-						m = re.match(r'^##\$SUBJECT_position=SUBJ_POS_(?P<position>.+?)$', current_line)
-						position = m.groupdict()['position']
-						read_variables +=1 #count recorded variables
-						selected_measurement['PV_position'] = position
-					if read_variables == 3:
-						break
-				selected_measurement['measurement'] = sub_dir
-				scan_program_file = os.path.join(workflow_base,sub_dir,"ScanProgram.scanProgram")
-				scan_dir_resolved = False
-				if selected_measurement.get('subject') and selected_measurement.get('session') and not selected_measurement.get('PV_position'):
-					selected_measurement['PV_position'] = 'UDEFINED'
-				try:
-					with open(scan_program_file) as search:
-						for line in search:
-							line_considered = True
-							measurement_copy = deepcopy(selected_measurement)
-							if re.match(r'^[ \t]+<displayName>[a-zA-Z0-9-_]+? \(E\d+\)</displayName>[\r\n]+', line):
-								if fail_suffix and re.match(r'^.+?{} \(E\d+\)</displayName>[\r\n]+'.format(fail_suffix), line):
-									continue
-								m = re.match(r'^[ \t]+<displayName>(?P<scan_type>.+?) \(E(?P<number>\d+)\)</displayName>[\r\n]+', line)
-								number = m.groupdict()['number']
-								scan_type = m.groupdict()['scan_type']
-								bids_keys = layout.parse_file_entities('{}/{}'.format(bids_temppath,scan_type))
-								for key in match:
-									# Session and subject fields are not recorded in scan_type and were already checked at this point.
-									if key in ['session', 'subject']:
-										continue
-									try:
-										if bids_keys[key] not in match[key]:
-											line_considered = False
-											break
-									except KeyError:
-										line_considered = False
-										break
-								if line_considered and os.path.isdir(os.path.join(sub_dir,str(int(number)))):
-									measurement_copy['scan_type'] = str(scan_type).strip(' ')
-									measurement_copy['scan'] = str(int(number))
-									measurement_copy['run'] = run_counter
-									scan_type, measurement_copy = assign_modality(scan_type, measurement_copy)
-									measurement_copy.update(bids_keys)
-									run_counter += 1
-									selected_measurements.append(measurement_copy)
-									scan_dir_resolved = True
-					if not scan_dir_resolved:
-						raise IOError()
-				except IOError:
-					for sub_sub_dir in os.listdir(os.path.join(workflow_base,sub_dir)):
-						measurement_copy = deepcopy(selected_measurement)
-						acqp_file_path = os.path.join(workflow_base,sub_dir,sub_sub_dir,"acqp")
-						scan_subdir_resolved = False
-						try:
-							with open(acqp_file_path,'r') as search:
-								for line in search:
-									line_considered = True
-									if scan_subdir_resolved:
-										break
-									if re.match(r'^(?!/)<[a-zA-Z0-9-_]+?-[a-zA-Z0-9-_]+?>[\r\n]+', line):
-										if fail_suffix and re.match(r'^.+?{}$'.format(fail_suffix), line):
-											continue
-										number = sub_sub_dir
-										m = re.match(r'^(?!/)<(?P<scan_type>.+?)>[\r\n]+', line)
-										scan_type = m.groupdict()['scan_type']
-										bids_keys = layout.parse_file_entities('{}/{}'.format(bids_temppath,scan_type))
-										for key in match:
-											# Session and subject fields are not recorded in scan_type and were already checked at this point.
-											if key in ['session', 'subject']:
-												continue
-											try:
-												if bids_keys[key] not in match[key]:
-													line_considered = False
-													break
-											except KeyError:
-												line_considered = False
-												break
-										if line_considered:
-											measurement_copy['scan_type'] = str(scan_type).strip(' ')
-											measurement_copy['scan'] = str(int(number))
-											measurement_copy['run'] = run_counter
-											scan_type, measurement_copy= assign_modality(scan_type, measurement_copy)
-											measurement_copy.update(bids_keys)
-											run_counter += 1
-											selected_measurements.append(measurement_copy)
-											scan_subdir_resolved = True
-								else:
-									pass
-						except IOError:
-							pass
-			except IOError:
-				print('Could not open {}'.format(os.path.join(workflow_base,sub_dir,"subject")))
-				pass
-	data_selection = pd.DataFrame(selected_measurements)
-	try:
-		shutil.rmtree(bids_temppath)
-	except (FileNotFoundError, PermissionError):
-		pass
-	return data_selection
+	return get_data_selections(workflow_base, [match],
+		exclude=exclude,
+		measurements=measurements,
+		exclude_measurements=exclude_measurements,
+		fail_suffix=fail_suffix,
+		cache=cache,
+		)[0]
 
 def select_from_datafind_df(df,
 	bids_dictionary=False,
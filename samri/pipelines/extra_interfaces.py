@@ -1,13 +1,17 @@
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, traits, File, Str, TraitedSpec, Directory, CommandLineInputSpec, CommandLine, InputMultiPath, isdefined, Bunch, OutputMultiPath
 from nipype.interfaces.ants.base import ANTSCommand, ANTSCommandInputSpec
+from nipype.interfaces.ants.registration import Registration, RegistrationInputSpec
 from nipype.interfaces.fsl.base import FSLCommandInputSpec, FSLCommand
 from nibabel import load
 
 import csv
+import hashlib
+import json
 import math
 import numpy as np
 import os
 import shutil
+import tempfile
 
 def scale_timings(timelist, input_units, output_units, time_repetition):
 	"""Scales timings given input and output units (scans/secs)
@@ -685,3 +689,87 @@ class CompositeTransformUtil(ANTSCommand):
 		outputs['displacement_field'] = os.path.abspath(
 			'01_'+self.inputs.output_prefix+'_DisplacementFieldTransform.nii.gz')
 		return outputs
+
+REGISTRATION_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'samri', 'registration')
+# Inputs which do not affect the resulting transforms.
+REGISTRATION_CACHE_IGNORE = ('cache_dir', 'environ', 'num_threads', 'output_transform_prefix', 'verbose')
+REGISTRATION_CACHE_FILES = ('Composite.h5', 'InverseComposite.h5')
+
+class CachedRegistrationInputSpec(RegistrationInputSpec):
+	cache_dir = Directory(nohash=True,
+		desc='Directory of the persistent transform cache; if undefined, no cache is used.',
+		)
+
+class CachedRegistration(Registration):
+	"""
+	ANTs registration, whose composite transforms are stored in a persistent, content-addressed cache.
+	Entries are keyed by the contents of all input files and by all parameters which affect the resulting transforms, so that reruns with identical inputs (e.g. of workflows whose work directory was deleted) skip the registration.
+	Caching applies only if `write_composite_transform` is set and no warped images are requested; otherwise the interface behaves exactly like `nipype.interfaces.ants.Registration`.
+
+	Examples
+	--------
+
+	>>> from samri.pipelines.extra_interfaces import CachedRegistration
+	>>> reg = CachedRegistration()
+	>>> reg.inputs.cache_dir = '~/.cache/samri/registration'
+	"""
+
+	input_spec = CachedRegistrationInputSpec
+
+	def _cacheable(self):
+		return isdefined(self.inputs.cache_dir) \
+			and self.inputs.write_composite_transform \
+			and not (isdefined(self.inputs.output_warped_image) and self.inputs.output_warped_image) \
+			and not (isdefined(self.inputs.output_inverse_warped_image) and self.inputs.output_inverse_warped_image)
+
+	def cache_key(self):
+		"""Return the key identifying the registration by the contents of its input files and by its parameters."""
+		from samri.report.cache import file_hash
+
+		def describe(name, value):
+			if isinstance(value, (list, tuple)):
+				return [describe(name, i) for i in value]
+			if isinstance(value, str) and os.path.isabs(value) and os.path.isfile(value):
+				return file_hash(value)
+			return value
+
+		parameters = {}
+		for name, value in sorted(self.inputs.get().items()):
+			if name in REGISTRATION_CACHE_IGNORE or not isdefined(value):
+				continue
+			parameters[name] = describe(name, value)
+		return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+	def _run_interface(self, runtime, correct_return_codes=(0,)):
+		if not self._cacheable():
+			return super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+		cache_dir = os.path.abspath(os.path.expanduser(self.inputs.cache_dir))
+		entry = os.path.join(cache_dir, self.cache_key())
+		outputs = [self.inputs.output_transform_prefix + i for i in REGISTRATION_CACHE_FILES]
+		try:
+			with open(os.path.join(entry, 'outputs.json')) as f:
+				profile = json.load(f)
+			for file_name, output in zip(REGISTRATION_CACHE_FILES, outputs):
+				shutil.copyfile(os.path.join(entry, file_name), os.path.join(runtime.cwd, output))
+		except (IOError, ValueError):
+			pass
+		else:
+			self._elapsed_time = profile['elapsed_time']
+			self._metric_value = profile['metric_value']
+			runtime.returncode = 0
+			return runtime
+
+		runtime = super(CachedRegistration, self)._run_interface(runtime, correct_return_codes)
+		# Entries are assembled in a temporary directory, so that concurrent readers never see partial entries.
+		os.makedirs(cache_dir, exist_ok=True)
+		temp_dir = tempfile.mkdtemp(dir=cache_dir)
+		try:
+			for file_name, output in zip(REGISTRATION_CACHE_FILES, outputs):
+				shutil.copyfile(os.path.join(runtime.cwd, output), os.path.join(temp_dir, file_name))
+			with open(os.path.join(temp_dir, 'outputs.json'), 'w') as f:
+				json.dump({'elapsed_time':self._elapsed_time, 'metric_value':self._metric_value}, f)
+			os.rename(temp_dir, entry)
+		except OSError:
+			# Another process has stored the same entry in the meantime.
+			shutil.rmtree(temp_dir, ignore_errors=True)
+		return runtime
@@ -17,6 +17,8 @@ from nipype.interfaces.fsl.model import Level1Design
 #from nipype.algorithms.modelgen import SpecifyModel
 
 from samri.pipelines.extra_interfaces import SpecifyModel
+from samri.pipelines.native import l1_glm_batch
+from samri.pipelines.resources import plan_resources
 from samri.pipelines.extra_functions import select_from_datafind_df, corresponding_eventfile, get_bids_scan, physiofile_ts, eventfile_add_habituation, regressor
 from samri.pipelines.utils import bids_dict_to_source, copy_bids_files, ss_to_path, iterfield_selector, datasource_exclude, bids_dict_to_dir
 from samri.report.roi import ts
@@ -34,6 +36,7 @@ def l1(preprocessing_dir,
 	lowpass_sigma=False,
 	include={},
 	keep_work=False,
+	memory_budget=None,
 	out_base="",
 	mask="",
 	match={},
@@ -44,6 +47,8 @@ def l1(preprocessing_dir,
 	n_jobs_percentage=1,
 	invert=False,
 	user_defined_contrasts=False,
+	engine='fsl',
+	prewhiten=False,
 	):
 	"""Calculate subject level GLM statistic scores.
 
@@ -61,6 +66,8 @@ def l1(preprocessing_dir,
 	debug : bool, optional
 		Whether to enable nipype debug mode.
 		This increases logging.
+	engine : {'fsl', 'numpy'}, optional
+		Whether to fit the model for each scan via the FSL `fsl_glm` command, or in-process for all scans at once via `samri.pipelines.native.fit_l1_files()`, which computes the design pseudo-inverse only once per distinct design.
 	habituation : {"", "confound", "separate_contrast", "in_main_contrast"}, optional
 		How the habituation regressor should be handled.
 		Anything which evaluates as False (though we recommend "") means no habituation regressor will be introduced.
@@ -80,8 +87,12 @@ def l1(preprocessing_dir,
 	mask : str, optional
 		Path to the brain mask which shall be used to define the brain volume in the analysis.
 		This has to point to an existing NIfTI file containing zero and one values only.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
+	prewhiten : bool, optional
+		Whether to fit the model after AR(1) prewhitening; only supported by the 'numpy' engine.
 	temporal_derivatives : int, optional
 		Whether to add temporal derivatives of the main regressors in the model. This only applies if the convolution parameter is set to 'dgamma' or 'gamma'.
 	tr : int, optional
@@ -92,6 +103,11 @@ def l1(preprocessing_dir,
 
 	from samri.pipelines.utils import bids_data_selection
 
+	if engine not in ['fsl', 'numpy']:
+		raise ValueError('The value you have provided for the `engine` parameter, namely "{}", is invalid. Please choose one of: {{"fsl","numpy"}}'.format(engine))
+	if prewhiten and engine != 'numpy':
+		raise ValueError('AR(1) prewhitening is only supported by the "numpy" engine.')
+
 	preprocessing_dir = path.abspath(path.expanduser(preprocessing_dir))
 	out_base = path.abspath(path.expanduser(out_base))
 
@@ -148,13 +164,21 @@ def l1(preprocessing_dir,
 
 	modelgen = pe.Node(interface=fsl.FEATModel(), name='modelgen')
 
-	glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
+	if engine == 'numpy':
+		# All scans are joined into a single node, which shares the design terms among scans and writes its outputs directly to the output directory.
+		glm_fields = ['in_file', 'design', 'contrasts', 'container', 'out_file', 'out_cope', 'out_varcb_name', 'out_t_name', 'out_z_name', 'out_p_name', 'out_pf_name']
+		glm = pe.JoinNode(name='glm', joinsource='get_scan', joinfield=glm_fields, interface=util.Function(function=l1_glm_batch,input_names=inspect.getfullargspec(l1_glm_batch)[0], output_names=['out_files']))
+		glm.inputs.out_base = path.join(out_base,workflow_name)
+		glm.inputs.prewhiten = prewhiten
+		if memory_budget is not None:
+			glm.inputs.memory_budget = memory_budget
+	else:
+		glm = pe.Node(interface=fsl.GLM(), name='glm', iterfield='design')
 	if mask == 'mouse':
 		mask = '/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii'
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
 	else:
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -269,7 +293,6 @@ def l1(preprocessing_dir,
 	if highpass_sigma or lowpass_sigma:
 		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
@@ -307,6 +330,9 @@ def l1(preprocessing_dir,
 				(get_scan, datasink, [('nii_path', '@ts_file')]),
 				])
 
+	if engine == 'numpy':
+		workflow_connections = [i for i in workflow_connections if i[0] is not glm]
+		workflow_connections.append((get_scan, glm, [(('dict_slice',bids_dict_to_dir), 'container')]))
 
 	workflow_config = {'execution': {'crashdump_dir': path.join(out_base,'crashdump'),}}
 	if debug:
@@ -328,7 +354,11 @@ def l1(preprocessing_dir,
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	copy_bids_files(preprocessing_dir, os.path.join(out_base,workflow_name))
 	if not keep_work:
 		shutil.rmtree(path.join(out_base,workdir_name))
@@ -342,6 +372,7 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 	lowpass_sigma=False,
 	include={},
 	keep_work=False,
+	memory_budget=None,
 	out_base="",
 	mask="",
 	match={},
@@ -384,6 +415,8 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 	mask : str, optional
 		Path to the brain mask which shall be used to define the brain volume in the analysis.
 		This has to point to an existing NIfTI file containing zero and one values only.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	temporal_derivatives : int, optional
@@ -462,7 +495,6 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
 	else:
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -542,7 +574,6 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 	if highpass_sigma or lowpass_sigma:
 		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
@@ -597,7 +628,11 @@ def l1_physio(preprocessing_dir, physiology_identifier,
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	copy_bids_files(preprocessing_dir, os.path.join(out_base,workflow_name))
 	if not keep_work:
 		shutil.rmtree(path.join(out_base,workdir_name))
@@ -610,6 +645,7 @@ def seed(preprocessing_dir, seed_mask,
 	lowpass_sigma=False,
 	include={},
 	keep_work=False,
+	memory_budget=None,
 	out_base="",
 	mask='mouse',
 	match={},
@@ -648,6 +684,8 @@ def seed(preprocessing_dir, seed_mask,
 	mask : str, optional
 		Path to the brain mask which shall be used to define the brain volume in the analysis.
 		This has to point to an existing NIfTI file containing zero and one values only.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	tr : int, optional
@@ -718,7 +756,6 @@ def seed(preprocessing_dir, seed_mask,
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
 	else:
 		glm.inputs.mask = path.abspath(path.expanduser(mask))
-	glm.interface.mem_gb = 6
 
 	try:
 		from bids.grabbids import BIDSLayout
@@ -807,7 +844,6 @@ def seed(preprocessing_dir, seed_mask,
 	if highpass_sigma or lowpass_sigma:
 		bandpass = pe.Node(interface=fsl.maths.TemporalFilter(), name="bandpass")
 		bandpass.inputs.highpass_sigma = highpass_sigma
-		bandpass.interface.mem_gb = 16
 		if lowpass_sigma:
 			bandpass.inputs.lowpass_sigma = lowpass_sigma
 		else:
@@ -849,7 +885,11 @@ def seed(preprocessing_dir, seed_mask,
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	copy_bids_files(preprocessing_dir, os.path.join(out_base,workflow_name))
 	if not keep_work:
 		shutil.rmtree(path.join(out_base,workdir_name))
@@ -883,9 +923,22 @@ def add_suffix(name, suffix):
 		name = "".join([str(i) for i in name])
 	return str(name)+str(suffix)
 
+def _l2_run_mode(engine, run_mode):
+	"""Validate the engine and run mode of a second-level model, and resolve the default run mode of the engine."""
+	from samri.pipelines.native import L2_RUN_MODES
+
+	if engine not in ['fsl', 'numpy']:
+		raise ValueError('The value you have provided for the `engine` parameter, namely "{}", is invalid. Please choose one of: {{"fsl","numpy"}}'.format(engine))
+	if run_mode is None:
+		run_mode = 'ols' if engine == 'numpy' else 'flame12'
+	if engine == 'numpy' and run_mode not in L2_RUN_MODES:
+		raise ValueError('The `run_mode` parameter must be one of: '+', '.join(L2_RUN_MODES)+'. Use the "fsl" engine for other run modes.')
+	return run_mode
+
 def l2_common_effect(l1_dir,
 	groupby="none",
 	keep_work=False,
+	memory_budget=None,
 	keep_crashdump=False,
 	tr=1,
 	mask='/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii',
@@ -900,18 +953,25 @@ def l2_common_effect(l1_dir,
 	workflow_name="generic",
 	debug=False,
 	target_set=[],
-	run_mode='flame12',
+	run_mode=None,
 	select_input_volume=None,
+	engine='fsl',
 	):
 	"""Determine the common effect in a sample of 3D feature maps.
 
 	Parameters
 	----------
 
+	engine : {'fsl', 'numpy'}, optional
+		Whether to merge the inputs and fit the model via FSL's `flameo`, or to fit the model in-process via `samri.pipelines.native.fit_l2()`, which streams the inputs in blocks and fits all `groupby` iterations in a single pass.
+		The 'numpy' engine supports the 'ols' and 'fe' run modes, and all `groupby` values except 'subject_task' and 'mtask'.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
-		Estimation model.
+		Estimation model, defaults to 'ols' for the 'numpy' engine, and to 'flame12' for the 'fsl' engine.
+		The 'fsl' engine currently always uses 'ols'.
 	exclude : dict, optional
 		Dictionary containing keys which are BIDS field identifiers, and values which are lists of BIDS identifier values which the user wants to exclude from the matched selection (blacklist).
 	include : dict, optional
@@ -925,6 +985,8 @@ def l2_common_effect(l1_dir,
 
 	from samri.pipelines.utils import bids_data_selection
 
+	run_mode = _l2_run_mode(engine, run_mode)
+
 	l1_dir = path.abspath(path.expanduser(l1_dir))
 	out_base = path.abspath(path.expanduser(out_base))
 	mask=path.abspath(path.expanduser(mask))
@@ -951,6 +1013,18 @@ def l2_common_effect(l1_dir,
 			data_selection = data_selection[data_selection[key].isin(include[key])]
 	data_selection.to_csv(path.join(workdir,'data_selection.csv'))
 
+	if engine == 'numpy':
+		l2_native_common_effect(data_selection, out_dir,
+			groupby=groupby,
+			mask=mask,
+			run_mode=run_mode,
+			select_input_volume=select_input_volume,
+			target_set=target_set,
+			)
+		if not keep_work:
+			shutil.rmtree(workdir)
+		return
+
 	# Workaround until the following issue is adequately addressed in pybids:
 	# https://github.com/bids-standard/pybids/issues/651
 	# The correct solution should be:
@@ -1276,7 +1350,11 @@ def l2_common_effect(l1_dir,
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	if not keep_crashdump:
 		try:
 			shutil.rmtree(crashdump_dir)
@@ -1285,9 +1363,94 @@ def l2_common_effect(l1_dir,
 	if not keep_work:
 		shutil.rmtree(path.join(out_base,workdir_name))
 
+def l2_native_common_effect(data_selection, out_dir,
+	groupby="none",
+	mask='',
+	run_mode='ols',
+	select_input_volume=None,
+	target_set=[],
+	):
+	"""Fit one-sample second-level models for all `groupby` iterations of a data selection in a single pass over the input files, via `samri.pipelines.native.fit_l2()`.
+
+	Parameters
+	----------
+
+	data_selection : pandas.DataFrame
+		BIDS-Information Pandas DataFrame of level-1 cope (and optionally varcb) files.
+	out_dir : str
+		Directory in which to write the `{group}_{common fields}_{statistic}.nii.gz` output files.
+	groupby : {'none', 'subject', 'session', 'task', 'subject_set'}, optional
+		Field by which to group the inputs into separate models.
+	mask : str, optional
+		Path to the brain mask.
+	run_mode : {'ols', 'fe'}, optional
+		Estimation model; as the lower-level degrees of freedom are not passed on, 'fe' z-statistics use the number of inputs minus one (see `samri.pipelines.native.fit_l2()`).
+	select_input_volume: int, optional
+		Select one of multiple volumes in the fourth dimension of level-1 input files.
+	target_set : list of dict, optional
+		Subject sets (with 'subject' lists and an optional 'alias') for the 'subject_set' grouping.
+	"""
+	from samri.pipelines.native import fit_l2
+
+	copes_selection = data_selection[data_selection['path'].str.contains('desc-cope')].reset_index(drop=True)
+	copes_list = copes_selection['path'].tolist()
+	varcopes_list = [i.replace('desc-cope', 'desc-varcb') for i in copes_list]
+	if not all(path.isfile(i) for i in varcopes_list):
+		varcopes_list = []
+
+	common_fields = []
+	for field, prefix in [('acquisition','acq-'), ('run','run-')] + ([('session','ses-')] if groupby == 'task' else []):
+		try:
+			values = copes_selection[field].drop_duplicates()
+		except KeyError:
+			continue
+		if len(values) == 1 and not values.isnull().values.any():
+			common_fields.append(prefix+str(values.item()))
+
+	groups = []
+	if groupby == 'none':
+		groups.append(([], copes_selection.index.tolist()))
+	elif groupby in ['subject', 'session', 'task']:
+		prefix = {'subject':'sub-', 'session':'ses-', 'task':'task-'}[groupby]
+		for value in copes_selection[groupby].drop_duplicates():
+			groups.append(([prefix+str(value)], copes_selection.index[copes_selection[groupby] == value].tolist()))
+	elif groupby == 'subject_set':
+		for target in target_set:
+			selection = copes_selection
+			for key in target:
+				if key == 'alias':
+					continue
+				values = target[key] if isinstance(target[key], (list, tuple)) else [target[key]]
+				selection = selection[selection[key].isin(values)]
+			if 'alias' in target:
+				name = 'alias-'+str(target['alias'])
+			else:
+				name = 'sub-'+'+'.join([str(i) for i in target['subject']])
+			groups.append(([name], selection.index.tolist()))
+	else:
+		raise ValueError('The "numpy" engine does not support `groupby="{}"`.'.format(groupby))
+
+	models = []
+	for name, rows in groups:
+		models.append({
+			'rows':rows,
+			'design':[[1]]*len(rows),
+			't_contrasts':[('mean',[1])],
+			'out_file':path.join(out_dir, '_'.join(name+common_fields+['{stat}.nii.gz'])),
+			})
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	return fit_l2(copes_list, models,
+		varcbs=varcopes_list,
+		mask=mask,
+		run_mode=run_mode,
+		volume=select_input_volume,
+		)
+
 def l2_controlled_effect(l1_dir,
 	control_dir='',
 	keep_work=False,
+	memory_budget=None,
 	tr=1,
 	mask='/usr/share/mouse-brain-templates/dsurqec_200micron_mask.nii',
 	match={},
@@ -1313,6 +1476,8 @@ def l2_controlled_effect(l1_dir,
 	control_dir : str, optional
 		Directory where the BIDS hierarchy for the control data is located.
 		If the value of this parameter evaluates as false, the control data will be assumed to also reside in `l1_dir`.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_jobs_percentage : float, optional
 		Percentage of the cores present on the machine which to maximally use for deploying jobs in parallel.
 	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
@@ -1476,7 +1641,11 @@ def l2_controlled_effect(l1_dir,
 		pass
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	if not keep_work:
 		shutil.rmtree(path.join(out_base,workdir_name))
 
@@ -1492,6 +1661,7 @@ def dict_and_suffix(my_dictionary,key,suffix):
 
 def l2_anova(l1_dir,
 	keep_work=False,
+	memory_budget=None,
 	l2_dir="",
 	loud=False,
 	tr=1,
@@ -1501,8 +1671,24 @@ def l2_anova(l1_dir,
 	n_jobs_percentage=1,
 	exclude={},
 	include={},
-	match_regex='.+/sub-(?P<sub>[a-zA-Z0-9]+)/ses-(?P<ses>[a-zA-Z0-9]+)/.*?_acq-(?P<acq>[a-zA-Z0-9]+)_task-(?P<task>[a-zA-Z0-9]+)_(?P<mod>[a-zA-Z0-9]+)_(?P<stat>(cope|varcb)+)\.(?:nii|nii\.gz)'
+	match_regex='.+/sub-(?P<sub>[a-zA-Z0-9]+)/ses-(?P<ses>[a-zA-Z0-9]+)/.*?_acq-(?P<acq>[a-zA-Z0-9]+)_task-(?P<task>[a-zA-Z0-9]+)_(?P<mod>[a-zA-Z0-9]+)_(?P<stat>(cope|varcb)+)\.(?:nii|nii\.gz)',
+	engine='fsl',
+	run_mode=None,
 	):
+	"""Determine the session effects in a sample of 3D feature maps, via an ANOVA controlling for the subject.
+
+	Parameters
+	----------
+
+	engine : {'fsl', 'numpy'}, optional
+		Whether to merge the inputs and fit the model via FSL's `flameo`, or to fit the model in-process via `samri.pipelines.native.fit_l2()`, which streams the inputs in blocks.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
+	run_mode : {'ols', 'fe', 'flame1', 'flame12'}, optional
+		Estimation model, defaults to 'ols' for the 'numpy' engine, and to 'flame12' for the 'fsl' engine; the 'numpy' engine supports 'ols' and 'fe'.
+	"""
+
+	run_mode = _l2_run_mode(engine, run_mode)
 
 	l1_dir = path.expanduser(l1_dir)
 	if not l2_dir:
@@ -1556,6 +1742,33 @@ def l2_anova(l1_dir,
 	contrasts = deepcopy(sessions)
 	contrasts.append(['anova', 'F', sessions])
 
+	if engine == 'numpy':
+		from samri.pipelines.native import fit_l2
+
+		out_dir = path.join(l2_dir,workflow_name)
+		if not os.path.exists(out_dir):
+			os.makedirs(out_dir)
+		# Columns are ordered as in the design written by `fsl.MultipleRegressDesign`.
+		columns = sorted(regressors.keys())
+		design = [[regressors[column][i] for column in columns] for i in range(len(copes))]
+		t_contrasts = []
+		for contrast in contrasts:
+			if contrast[1] == 'T':
+				t_contrasts.append((contrast[0], [contrast[3][contrast[2].index(column)] if column in contrast[2] else 0 for column in columns]))
+		f_contrasts = [(contrast[0], [i[0] for i in contrast[2]]) for contrast in contrasts if contrast[1] == 'F']
+		fit_l2(copes, [{
+				'rows':list(range(len(copes))),
+				'design':design,
+				't_contrasts':t_contrasts,
+				'f_contrasts':f_contrasts,
+				'out_file':path.join(out_dir,'{contrast}_{stat}.nii.gz'),
+				}],
+			varcbs=varcopes,
+			mask=mask,
+			run_mode=run_mode,
+			)
+		return
+
 	level2model = pe.Node(interface=fsl.MultipleRegressDesign(),name='level2model')
 	level2model.inputs.regressors = regressors
 	level2model.inputs.contrasts = contrasts
@@ -1564,7 +1777,7 @@ def l2_anova(l1_dir,
 	flameo.inputs.mask_file = mask
 	# Using 'fe' instead of 'ols' is recommended (https://dpaniukov.github.io/2016/07/14/three-level-analysis-with-fsl-and-ants-2.html)
 	# This has also been tested in SAMRI and shown to give better estimates.
-	flameo.inputs.run_mode = "flame12"
+	flameo.inputs.run_mode = run_mode
 
 	substitutions = []
 	t_counter = 1
@@ -1609,7 +1822,11 @@ def l2_anova(l1_dir,
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 	n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	if not keep_crashdump:
 		try:
 			shutil.rmtree(crashdump_dir)
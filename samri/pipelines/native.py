@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import nibabel as nib
+import numpy as np
+from os import path
+
+# Outputs of `fsl.GLM`, in the order in which they are computed by `samri.pipelines.native.fit_glm()`.
+L1_OUTPUTS = ('betas', 'cope', 'varcb', 'tstat', 'zstat', 'pstat', 'pfstat')
+
+def read_vest(file_path):
+	"""
+	Read an FSL VEST matrix file (as written e.g. by `fsl.FEATModel` for design `.mat` and contrast `.con` files).
+
+	Parameters
+	----------
+
+	file_path : str
+		Path to the VEST file.
+
+	Returns
+	-------
+
+	matrix : numpy.ndarray
+		Two-dimensional array of the values following the "/Matrix" line.
+	names : list of str
+		Values of the "/ContrastName<n>" lines (empty for design files).
+	"""
+	file_path = path.abspath(path.expanduser(file_path))
+	names = {}
+	rows = []
+	in_matrix = False
+	with open(file_path, 'r') as f:
+		for line in f:
+			line = line.strip()
+			if not line:
+				continue
+			if in_matrix:
+				rows.append([float(i) for i in line.split()])
+			elif line.startswith('/Matrix'):
+				in_matrix = True
+			elif line.startswith('/ContrastName'):
+				key, _, name = line.partition('\t') if '\t' in line else line.partition(' ')
+				names[int(key[len('/ContrastName'):])] = name.strip()
+	return np.array(rows, dtype=np.float64), [names[i] for i in sorted(names)]
+
+class Design(object):
+	"""
+	Precomputed terms of a first-level design matrix and contrast matrix, shared by all scans (and AR(1) coefficient bins) using the same design.
+
+	Parameters
+	----------
+
+	design : numpy.ndarray
+		Design matrix, of shape (volumes, regressors).
+	contrasts : numpy.ndarray
+		Contrast matrix, of shape (contrasts, regressors).
+	"""
+
+	def __init__(self, design, contrasts):
+		self.design = design
+		self.contrasts = np.atleast_2d(contrasts)
+		self.rank = np.linalg.matrix_rank(design)
+		self.dof = design.shape[0] - self.rank
+		self._terms = {}
+
+	def terms(self, rho=None):
+		"""
+		Return the (optionally AR(1)-prewhitened) design, its pseudo-inverse, and the contrast variance factors.
+		Terms are computed once per AR(1) coefficient.
+		"""
+		try:
+			return self._terms[rho]
+		except KeyError:
+			pass
+		design = self.design if rho is None else _ar1_whiten(self.design, rho)
+		pinv = np.linalg.pinv(design)
+		covariance = pinv.dot(pinv.T)
+		contrast_factors = np.einsum('ij,jk,ik->i', self.contrasts, covariance, self.contrasts)
+		self._terms[rho] = (design, pinv, contrast_factors)
+		return self._terms[rho]
+
+def _ar1_whiten(data, rho):
+	"""Apply the AR(1) prewhitening filter with coefficient `rho` along the first axis."""
+	whitened = np.empty_like(data)
+	whitened[0] = np.sqrt(1. - rho**2)*data[0]
+	whitened[1:] = data[1:] - rho*data[:-1]
+	return whitened
+
+def _ols(design_terms, data):
+	design, pinv, contrast_factors = design_terms
+	betas = pinv.dot(data)
+	residuals = data - design.dot(betas)
+	return betas, residuals
+
+def fit_glm(data, design,
+	prewhiten=False,
+	ar_precision=2,
+	):
+	"""
+	Fit a first-level GLM to all voxel time courses at once, and compute the statistics produced by `fsl.GLM`.
+
+	Parameters
+	----------
+
+	data : numpy.ndarray
+		Voxel time courses, of shape (volumes, voxels).
+	design : samri.pipelines.native.Design
+		Design and contrast terms.
+	prewhiten : bool, optional
+		Whether to refit the model after AR(1) prewhitening, with coefficients estimated per voxel from the OLS residuals.
+	ar_precision : int, optional
+		Number of decimals to which AR(1) coefficients are rounded, so that voxels with the same rounded coefficient share one whitened pseudo-inverse.
+
+	Returns
+	-------
+
+	dict
+		Arrays keyed by the names in `samri.pipelines.native.L1_OUTPUTS`: 'betas' of shape (regressors, voxels), 'cope', 'varcb', 'tstat', 'zstat', 'pstat' of shape (contrasts, voxels), and 'pfstat' of shape (voxels,).
+	"""
+	from scipy import stats
+
+	data = np.asarray(data, dtype=np.float64)
+	betas, residuals = _ols(design.terms(), data)
+	contrast_factors = np.repeat(design.terms()[2][:,np.newaxis], data.shape[1], axis=1)
+	explained = np.sum(design.design.dot(betas)**2, axis=0)
+
+	if prewhiten:
+		numerator = np.sum(residuals[1:]*residuals[:-1], axis=0)
+		denominator = np.sum(residuals**2, axis=0)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			rho = np.where(denominator > 0, numerator/denominator, 0.)
+		rho = np.clip(np.round(rho, ar_precision), -0.99, 0.99)
+		for coefficient in np.unique(rho):
+			voxels = np.flatnonzero(rho == coefficient)
+			terms = design.terms(float(coefficient))
+			whitened = _ar1_whiten(data[:,voxels], coefficient)
+			betas[:,voxels], residuals[:,voxels] = _ols(terms, whitened)
+			contrast_factors[:,voxels] = terms[2][:,np.newaxis]
+			explained[voxels] = np.sum(terms[0].dot(betas[:,voxels])**2, axis=0)
+
+	sigma_squared = np.sum(residuals**2, axis=0)/design.dof
+	cope = design.contrasts.dot(betas)
+	varcb = contrast_factors*sigma_squared
+	with np.errstate(invalid='ignore', divide='ignore'):
+		tstat = np.where(varcb > 0, cope/np.sqrt(varcb), 0.)
+		fstat = np.where(sigma_squared > 0, (explained/design.rank)/sigma_squared, 0.)
+	pstat = stats.t.sf(tstat, design.dof)
+	zstat = stats.norm.isf(pstat)
+	pfstat = stats.f.sf(fstat, design.rank, design.dof)
+	return dict(zip(L1_OUTPUTS, (betas, cope, varcb, tstat, zstat, pstat, pfstat)))
+
+def _design_key(design_file, contrasts_file):
+	digest = hashlib.sha1()
+	for file_path in (design_file, contrasts_file):
+		with open(file_path, 'rb') as f:
+			digest.update(f.read())
+	return digest.hexdigest()
+
+def _write_maps(values, mask, img, out_file):
+	"""Write an array of shape (maps, voxels) or (voxels,) into the in-mask voxels of a (3D or 4D) image on the grid of `img`."""
+	values = np.atleast_2d(values)
+	out_data = np.zeros(img.shape[:3]+(values.shape[0],), dtype=np.float32)
+	out_data[mask] = values.T
+	if values.shape[0] == 1:
+		out_data = out_data[...,0]
+	header = img.header.copy()
+	header.set_data_dtype(np.float32)
+	out_img = nib.Nifti1Image(out_data, img.affine, header)
+	nib.save(out_img, out_file)
+	return out_file
+
+# Number of float64 copies of a series held while fitting it: the masked series, and the residuals.
+L1_WORKING_COPIES = 2
+
+def l1_memory(in_file):
+	"""Estimate the memory (in bytes) needed to fit a first-level GLM to a 4D NIfTI file: the decoded series, plus its float64 working copies."""
+	from samri.report.execution import estimate_memory
+
+	try:
+		shape = nib.load(path.abspath(path.expanduser(in_file))).shape
+	except (FileNotFoundError, nib.filebasedimages.ImageFileError):
+		return 0
+	return estimate_memory(in_file, factor=1.) + int(np.prod(shape, dtype=np.int64))*np.dtype(np.float64).itemsize*L1_WORKING_COPIES
+
+def fit_l1_files(in_files, designs, contrasts, out_files,
+	mask='',
+	prewhiten=False,
+	n_jobs=False,
+	memory_budget=None,
+	):
+	"""
+	Fit first-level GLMs to a batch of 4D NIfTI files, computing the (pseudo-inverse) design terms only once for all files which share the same design and contrast files.
+
+	Parameters
+	----------
+
+	in_files : list of str
+		Paths to 4D NIfTI files.
+	designs : list of str
+		Paths to FSL VEST design matrix files (as produced by `fsl.FEATModel`), one for each input file.
+	contrasts : list of str
+		Paths to FSL VEST contrast files (as produced by `fsl.FEATModel`), one for each input file.
+	out_files : list of dict
+		Output paths for each input file, keyed by the names in `samri.pipelines.native.L1_OUTPUTS`.
+		Keys which are missing (or the values of which evaluate as false) are not written.
+	mask : str, optional
+		Path to a NIfTI mask on the grid of the input files; if unspecified, all voxels are fitted.
+	prewhiten : bool, optional
+		Whether to use AR(1) prewhitening, see `samri.pipelines.native.fit_glm()`.
+	n_jobs : int, optional
+		Number of files to fit concurrently (in threads, as the heavy lifting is done by NumPy).
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently fitted files may occupy, as accepted by `samri.report.execution.parallel_map()`.
+		The memory needed for each file is estimated via `samri.pipelines.native.l1_memory()`.
+
+	Returns
+	-------
+
+	list of dict
+		The written output paths for each input file.
+	"""
+	from samri.report.execution import parallel_map
+
+	mask_data = None
+	if mask:
+		mask_data = np.asanyarray(nib.load(path.abspath(path.expanduser(mask))).dataobj) > 0
+
+	design_cache = {}
+	design_objects = []
+	for design_file, contrasts_file in zip(designs, contrasts):
+		key = _design_key(design_file, contrasts_file)
+		if key not in design_cache:
+			design_matrix, _ = read_vest(design_file)
+			contrast_matrix, _ = read_vest(contrasts_file)
+			design_cache[key] = Design(design_matrix, contrast_matrix)
+		design_objects.append(design_cache[key])
+
+	def fit_file(in_file, design, file_outputs):
+		img = nib.load(path.abspath(path.expanduser(in_file)))
+		data = np.asanyarray(img.dataobj)
+		file_mask = mask_data if mask_data is not None else np.ones(img.shape[:3], dtype=bool)
+		results = fit_glm(data[file_mask].T, design, prewhiten=prewhiten)
+		written = {}
+		for key in L1_OUTPUTS:
+			if file_outputs.get(key):
+				written[key] = _write_maps(results[key], file_mask, img, path.abspath(path.expanduser(file_outputs[key])))
+		return written
+
+	return parallel_map(fit_file, in_files, design_objects, out_files,
+		backend='threading',
+		n_jobs=n_jobs,
+		memory_estimates=[l1_memory(i) for i in in_files],
+		memory_budget=memory_budget,
+		)
+
+def l1_glm_batch(in_file, design, contrasts, container, out_base, out_file, out_cope, out_varcb_name, out_t_name, out_z_name, out_p_name, out_pf_name,
+	mask='',
+	prewhiten=False,
+	memory_budget=None,
+	):
+	"""
+	Nipype `JoinNode` wrapper of `samri.pipelines.native.fit_l1_files()`, taking the same inputs as `nipype.interfaces.fsl.GLM` (as lists joined over all scans) and writing the outputs directly under `out_base`.
+	"""
+	from os import path, makedirs
+	from samri.pipelines.native import fit_l1_files, L1_OUTPUTS
+
+	out_files = []
+	for ix, scan_container in enumerate(container):
+		out_dir = path.join(out_base, scan_container)
+		makedirs(out_dir, exist_ok=True)
+		names = (out_file[ix], out_cope[ix], out_varcb_name[ix], out_t_name[ix], out_z_name[ix], out_p_name[ix], out_pf_name[ix])
+		out_files.append({key: path.join(out_dir, name) for key, name in zip(L1_OUTPUTS, names)})
+	written = fit_l1_files(in_file, design, contrasts, out_files,
+		mask=mask,
+		prewhiten=prewhiten,
+		memory_budget=memory_budget,
+		)
+	return [i for file_outputs in written for i in file_outputs.values()]
+
+# Second-level estimation modes supported natively, out of the `fsl.FLAMEO` run modes.
+L2_RUN_MODES = ('ols', 'fe')
+
+def _log_betainc(a, b, x):
+	"""Logarithm of the regularized incomplete beta function, via I_x(a,b) = x^a (1-x)^b 2F1(a+b,1;a+1;x) / (a B(a,b)), which remains finite where the function itself underflows."""
+	from scipy.special import betaln, hyp2f1
+
+	with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+		return a*np.log(x) + b*np.log1p(-x) - np.log(a) - betaln(a, b) + np.log(hyp2f1(a+b, 1., a+1., x))
+
+def _t_to_z(tstat, dof):
+	"""Convert t statistics to z statistics via the logarithm of the tail probability, so that large statistics remain finite."""
+	from scipy import stats
+	from scipy.special import ndtri_exp
+
+	tstat = np.asarray(tstat, dtype=np.float64)
+	magnitude = np.abs(tstat)
+	logsf = stats.t.logsf(magnitude, dof)
+	underflow = ~(logsf > -700)
+	if underflow.any():
+		tail = np.log(0.5) + _log_betainc(dof/2., 0.5, dof/(dof+magnitude[underflow]**2))
+		# For very many degrees of freedom the t distribution is normal.
+		logsf[underflow] = np.where(np.isfinite(tail), tail, stats.norm.logsf(magnitude[underflow]))
+	return -np.sign(tstat)*ndtri_exp(logsf)
+
+def _f_to_z(fstat, dfn, dfd):
+	"""Convert F statistics to z statistics via the logarithm of the tail probability, so that large statistics remain finite."""
+	from scipy import stats
+	from scipy.special import ndtri_exp
+
+	fstat = np.asarray(fstat, dtype=np.float64)
+	logsf = stats.f.logsf(fstat, dfn, dfd)
+	underflow = ~(logsf > -700)
+	if underflow.any():
+		tail = _log_betainc(dfd/2., dfn/2., dfd/(dfd+dfn*fstat[underflow]))
+		logsf[underflow] = np.where(np.isfinite(tail), tail, stats.chi2.logsf(dfn*fstat[underflow], dfn))
+	return -ndtri_exp(logsf)
+
+def _l2_block(copes, varcbs, design, t_contrasts, f_contrasts, run_mode,
+	dofs=None,
+	):
+	"""
+	Solve a second-level model for a block of voxels.
+
+	Parameters
+	----------
+
+	copes : numpy.ndarray
+		Lower-level contrast estimates, of shape (inputs, voxels).
+	varcbs : numpy.ndarray or None
+		Lower-level contrast variances, of shape (inputs, voxels), required for the 'fe' run mode.
+	design : numpy.ndarray
+		Group design matrix, of shape (inputs, regressors).
+	t_contrasts : numpy.ndarray
+		T-contrast matrix, of shape (contrasts, regressors).
+	f_contrasts : list of list of int
+		Indices of the T-contrasts which make up each F-contrast.
+	run_mode : {'ols', 'fe'}
+		Ordinary least squares (between-input variance only), or fixed effects (lower-level variances only).
+	dofs : numpy.ndarray, optional
+		Lower-level degrees of freedom, one for each input; if specified, the 'fe' run mode uses their sum (as does `fsl.FLAMEO`), otherwise the number of inputs minus the design rank.
+	"""
+	n, p = design.shape
+	rank = np.linalg.matrix_rank(design)
+	dof = n - rank
+	results = {}
+	if run_mode == 'ols':
+		pinv = np.linalg.pinv(design)
+		betas = pinv.dot(copes)
+		residuals = copes - design.dot(betas)
+		sigma_squared = np.sum(residuals**2, axis=0)/dof
+		# The parameter covariance is (X'X)+ for all voxels, scaled by the residual variance of each.
+		unscaled = pinv.dot(pinv.T)
+		cope = t_contrasts.dot(betas)
+		varcope = np.diag(t_contrasts.dot(unscaled).dot(t_contrasts.T))[:,np.newaxis]*sigma_squared[np.newaxis]
+	elif run_mode == 'fe':
+		if dofs is not None:
+			dof = np.sum(dofs)
+		with np.errstate(divide='ignore'):
+			weights = np.where(varcbs > 0, 1./varcbs, 0.)
+		information = np.einsum('ni,nv,nj->vij', design, weights, design)
+		covariance = np.linalg.pinv(information)
+		betas = np.einsum('vij,nj,nv,nv->iv', covariance, design, weights, copes)
+		cope = t_contrasts.dot(betas)
+		varcope = np.einsum('ci,vij,cj->cv', t_contrasts, covariance, t_contrasts)
+	else:
+		raise ValueError('The `run_mode` parameter must be one of: '+', '.join(L2_RUN_MODES)+'.')
+
+	with np.errstate(invalid='ignore', divide='ignore'):
+		tstat = np.where(varcope > 0, cope/np.sqrt(varcope), 0.)
+	results['cope'] = cope
+	results['varcope'] = varcope
+	results['tstat'] = tstat
+	results['zstat'] = _t_to_z(tstat, dof)
+	fstats = []
+	zfstats = []
+	for contrast_indices in f_contrasts:
+		contrast = t_contrasts[contrast_indices]
+		estimate = contrast.dot(betas)
+		q = np.linalg.matrix_rank(contrast)
+		if run_mode == 'ols':
+			solved = np.linalg.pinv(contrast.dot(unscaled).dot(contrast.T)).dot(estimate)
+			with np.errstate(invalid='ignore', divide='ignore'):
+				fstat = np.where(sigma_squared > 0, np.sum(estimate*solved, axis=0)/(q*sigma_squared), 0.)
+		else:
+			contrast_covariance = np.einsum('ci,vij,dj->vcd', contrast, covariance, contrast)
+			solved = np.einsum('vcd,dv->cv', np.linalg.pinv(contrast_covariance), estimate)
+			fstat = np.sum(estimate*solved, axis=0)/q
+		fstats.append(fstat)
+		zfstats.append(_f_to_z(fstat, q, dof))
+	if fstats:
+		results['fstat'] = np.array(fstats)
+		results['zfstat'] = np.array(zfstats)
+	return results
+
+def fit_l2(copes, models,
+	varcbs=[],
+	dofs=[],
+	mask='',
+	run_mode='ols',
+	volume=None,
+	block_slices=8,
+	):
+	"""
+	Fit one or more second-level models to lower-level contrast maps, streaming the input files through their array proxies in blocks of slices, without creating merged 4D files.
+	Each block of each input file is read only once, and shared by all models.
+
+	Parameters
+	----------
+
+	copes : list of str
+		Paths to the lower-level contrast estimate (cope) NIfTI files.
+	models : list of dict
+		Second-level models, each a dictionary with the keys 'rows' (indices into `copes` of the model inputs), 'design' (design matrix of shape (rows, regressors)), 't_contrasts' (list of (name, weights) tuples), 'f_contrasts' (optional list of (name, list of T-contrast names) tuples), and 'out_file' (a format string with 'contrast' and 'stat' fields, used to name the output files).
+	varcbs : list of str, optional
+		Paths to the lower-level contrast variance (varcb) NIfTI files, corresponding to `copes`; required for the 'fe' run mode.
+	dofs : list of float, optional
+		Lower-level degrees of freedom, corresponding to `copes`.
+		The 'fe' run mode uses their sum for the z-statistics, as does `fsl.FLAMEO`; if unspecified, it uses the number of inputs minus the design rank, which is not comparable to FSL fixed-effects z-statistics.
+	mask : str, optional
+		Path to a NIfTI mask on the grid of the input files; if unspecified, all voxels are fitted.
+	run_mode : {'ols', 'fe'}, optional
+		Estimation model, equivalent to the respective `fsl.FLAMEO` run mode.
+	volume : int, optional
+		Volume to select from 4D input files (e.g. if the lower-level model produced multiple contrasts).
+	block_slices : int, optional
+		Number of slices (along the third axis) read from each file at a time.
+
+	Returns
+	-------
+
+	list of list of str
+		Paths of the files written for each model.
+	"""
+
+	if run_mode not in L2_RUN_MODES:
+		raise ValueError('The `run_mode` parameter must be one of: '+', '.join(L2_RUN_MODES)+'. Use the "fsl" engine for other run modes.')
+	if run_mode == 'fe' and len(varcbs) != len(copes):
+		raise ValueError('The "fe" run mode requires a varcb file for each cope file.')
+	if dofs and len(dofs) != len(copes):
+		raise ValueError('The `dofs` parameter requires a value for each cope file.')
+
+	cope_imgs = [nib.load(path.abspath(path.expanduser(i)), keep_file_open=True) for i in copes]
+	varcb_imgs = [nib.load(path.abspath(path.expanduser(i)), keep_file_open=True) for i in varcbs]
+	reference = cope_imgs[0]
+	shape = reference.shape[:3]
+	if mask:
+		mask_data = np.asanyarray(nib.load(path.abspath(path.expanduser(mask))).dataobj) > 0
+	else:
+		mask_data = np.ones(shape, dtype=bool)
+
+	def read_block(img, start, stop):
+		if len(img.shape) > 3:
+			return np.asanyarray(img.dataobj[:,:,start:stop,volume if volume is not None else 0])
+		return np.asanyarray(img.dataobj[:,:,start:stop])
+
+	terms = []
+	for model in models:
+		names = [name for name, _ in model['t_contrasts']]
+		t_matrix = np.array([weights for _, weights in model['t_contrasts']], dtype=np.float64)
+		f_indices = [[names.index(i) for i in t_names] for _, t_names in model.get('f_contrasts', [])]
+		terms.append((np.asarray(model['design'], dtype=np.float64), t_matrix, f_indices))
+	outputs = [{} for model in models]
+
+	for start in range(0, shape[2], block_slices):
+		stop = min(start+block_slices, shape[2])
+		block_mask = mask_data[:,:,start:stop]
+		if not block_mask.any():
+			continue
+		cope_block = np.array([read_block(img, start, stop)[block_mask] for img in cope_imgs], dtype=np.float64)
+		varcb_block = None
+		if varcb_imgs:
+			varcb_block = np.array([read_block(img, start, stop)[block_mask] for img in varcb_imgs], dtype=np.float64)
+		for model, (design, t_matrix, f_indices), model_outputs in zip(models, terms, outputs):
+			rows = model['rows']
+			results = _l2_block(cope_block[rows], varcb_block[rows] if varcb_block is not None else None, design, t_matrix, f_indices, run_mode,
+				dofs=np.asarray(dofs, dtype=np.float64)[rows] if dofs else None,
+				)
+			for stat, values in results.items():
+				if stat in ['fstat', 'zfstat']:
+					contrast_names = [name for name, _ in model.get('f_contrasts', [])]
+				else:
+					contrast_names = [name for name, _ in model['t_contrasts']]
+				for contrast_name, contrast_values in zip(contrast_names, values):
+					key = (contrast_name, stat)
+					if key not in model_outputs:
+						model_outputs[key] = np.zeros(shape, dtype=np.float32)
+					model_outputs[key][:,:,start:stop][block_mask] = contrast_values
+
+	header = reference.header.copy()
+	header.set_data_dtype(np.float32)
+	written = []
+	for model, model_outputs in zip(models, outputs):
+		model_written = []
+		for (contrast_name, stat), data in model_outputs.items():
+			out_file = path.abspath(path.expanduser(model['out_file'].format(contrast=contrast_name, stat=stat)))
+			nib.save(nib.Nifti1Image(data, reference.affine, header), out_file)
+			model_written.append(out_file)
+		written.append(model_written)
+	return written
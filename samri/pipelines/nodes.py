@@ -3,6 +3,7 @@ from os import path
 import nipype.pipeline.engine as pe
 import nipype.interfaces.ants as ants
 from nipype.interfaces import fsl
+from samri.pipelines.extra_interfaces import CachedRegistration, REGISTRATION_CACHE_DIR
 from samri.pipelines.utils import GENERIC_PHASES
 
 def autorotate(template,
@@ -36,8 +37,17 @@ def autorotate(template,
 	flt_res = flt.run()
 	return flt_res
 
-def structural_registration(template, num_threads=4):
-	registration = pe.Node(ants.Registration(), name="s_register")
+def _registration_cache(registration_cache):
+	if registration_cache is True:
+		return REGISTRATION_CACHE_DIR
+	return path.abspath(path.expanduser(registration_cache))
+
+def structural_registration(template, num_threads=4,
+	registration_cache=False,
+	):
+	registration = pe.Node(CachedRegistration(), name="s_register")
+	if registration_cache:
+		registration.inputs.cache_dir = _registration_cache(registration_cache)
 	registration.inputs.fixed_image = path.abspath(path.expanduser(template))
 	registration.inputs.output_transform_prefix = "output_"
 	registration.inputs.transforms = ['Affine', 'SyN'] ##
@@ -91,14 +101,20 @@ def generic_registration(template,
 	phase_dictionary=GENERIC_PHASES,
 	s_phases=['s_translation','similarity','affine','syn'],
 	f_phases=['f_translation',],
+	registration_cache=False,
 	):
+	"""Return structural and functional registration and warping nodes, with parameters taken from the `phase_dictionary` entries named in `s_phases` and `f_phases`.
+	If `registration_cache` is set (to `True`, for `samri.pipelines.extra_interfaces.REGISTRATION_CACHE_DIR`, or to a directory path), the registration nodes store and reuse their transforms in a persistent cache (see `samri.pipelines.extra_interfaces.CachedRegistration`).
+	"""
 
 	s_phases = [phase for phase in s_phases if phase in phase_dictionary]
 	f_phases = [phase for phase in f_phases if phase in phase_dictionary]
 
 	s_parameters = [phase_dictionary[selection] for selection in s_phases]
 
-	s_registration = pe.Node(ants.Registration(), name="s_register")
+	s_registration = pe.Node(CachedRegistration(), name="s_register")
+	if registration_cache:
+		s_registration.inputs.cache_dir = _registration_cache(registration_cache)
 	s_registration.inputs.fixed_image = path.abspath(path.expanduser(template))
 	s_registration.inputs.output_transform_prefix = "output_"
 	s_registration.inputs.transforms = [i["transforms"] for i in s_parameters] ##
@@ -129,7 +145,9 @@ def generic_registration(template,
 
 	f_parameters = [phase_dictionary[selection] for selection in f_phases]
 
-	f_registration = pe.Node(ants.Registration(), name="f_register")
+	f_registration = pe.Node(CachedRegistration(), name="f_register")
+	if registration_cache:
+		f_registration.inputs.cache_dir = _registration_cache(registration_cache)
 	#f_registration.inputs.fixed_image = path.abspath(path.expanduser(template))
 	f_registration.inputs.output_transform_prefix = "output_"
 	f_registration.inputs.transforms = [i["transforms"] for i in f_parameters] ##
@@ -168,7 +186,6 @@ def generic_registration(template,
 	f_warp.inputs.interpolation_parameters = (5,)
 	f_warp.inputs.invert_transform_flags = [False, False]
 	f_warp.num_threads = num_threads
-	f_warp.interface.mem_gb = 16
 
 	s_warp = pe.Node(ants.ApplyTransforms(), name="s_warp")
 	s_warp.inputs.reference_image = path.abspath(path.expanduser(template))
@@ -185,13 +202,16 @@ def functional_registration(template,
 	num_threads=4,
 	phase_dictionary=GENERIC_PHASES,
 	f_phases=["f_only_translation",'similarity',"affine","syn"],
+	registration_cache=False,
 	):
 
 	template = path.abspath(path.expanduser(template))
 
 	f_parameters = [phase_dictionary[selection] for selection in f_phases]
 
-	f_registration = pe.Node(ants.Registration(), name="f_register")
+	f_registration = pe.Node(CachedRegistration(), name="f_register")
+	if registration_cache:
+		f_registration.inputs.cache_dir = _registration_cache(registration_cache)
 	f_registration.inputs.fixed_image = template
 	f_registration.inputs.output_transform_prefix = "output_"
 	f_registration.inputs.transforms = [i["transforms"] for i in f_parameters] ##
@@ -227,7 +247,6 @@ def functional_registration(template,
 	warp.inputs.invert_transform_flags = [False]
 	#warp.inputs.terminal_output = 'file'
 	warp.num_threads = num_threads
-	warp.interface.mem_gb = 16
 
 	return f_registration, warp
 
@@ -16,9 +16,10 @@ import pandas as pd
 from nipype.interfaces import ants, afni, bru2nii, fsl, nipy
 
 from samri.fetch.templates import fetch_rat_waxholm
-from samri.pipelines.extra_functions import corresponding_physiofile, get_bids_scan, write_bids_events_file, force_dummy_scans, BIDS_METADATA_EXTRACTION_DICTS
+from samri.pipelines.extra_functions import corresponding_physiofile, get_bids_scan, write_bids_events_file, force_dummy_scans, fused_dummy_scans, BIDS_METADATA_EXTRACTION_DICTS
 from samri.pipelines.extra_interfaces import VoxelResize, FSLOrient
 from samri.pipelines.nodes import *
+from samri.pipelines.resources import plan_resources
 from samri.pipelines.utils import bids_data_selection, copy_bids_files, fslmaths_invert_values, ss_to_path, GENERIC_PHASES
 
 DUMMY_SCANS=10
@@ -39,6 +40,7 @@ def legacy(bids_base, template,
 	functional_blur_xy=False,
 	functional_match={},
 	keep_work=False,
+	memory_budget=None,
 	n_jobs=False,
 	n_jobs_percentage=0.8,
 	out_base=None,
@@ -75,6 +77,9 @@ def legacy(bids_base, template,
 		The dictionary should have keys which are 'acquisition', 'task', or 'modality', and values which are lists of acceptable strings for the respective BIDS field.
 	keep_work : bool, str
 		Whether to keep the work directory after workflow conclusion (this directory contains all the intermediary processing commands, inputs, and outputs --- it is invaluable for debugging but many times larger in size than the actual output).
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
+		Node requirements are estimated from the input image sizes via `samri.pipelines.resources.plan_resources()`.
 	n_jobs : int, optional
 		Number of processors to maximally use for the workflow; if unspecified a best guess will be estimate based on `n_jobs_percentage` and hardware (but not on current load).
 	n_jobs_percentage : float, optional
@@ -292,7 +297,12 @@ def legacy(bids_base, template,
 	except OSError:
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		template=template,
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	copy_bids_files(bids_base, os.path.join(out_base,workflow_name))
 	if not keep_work:
 		workdir = path.join(workflow.base_dir,workdir_name)
@@ -320,6 +330,7 @@ def generic(bids_base, template,
 	functional_match={},
 	functional_registration_method="composite",
 	keep_work=False,
+	memory_budget=None,
 	n_jobs=False,
 	n_jobs_percentage=0.8,
 	out_base=None,
@@ -334,6 +345,8 @@ def generic(bids_base, template,
 	phase_dictionary=GENERIC_PHASES,
 	enforce_dummy_scans=DUMMY_SCANS,
 	exclude={},
+	fuse_early_nodes=False,
+	registration_cache=True,
 	):
 	'''
 	Generic preprocessing and registration workflow for small animal data in BIDS format.
@@ -362,8 +375,14 @@ def generic(bids_base, template,
 	functional_registration_method : {'composite','functional','structural'}, optional
 		How to register the functional scan to the template.
 		Values mean the following: 'composite' that it will be registered to the structural scan which will in turn be registered to the template, 'functional' that it will be registered directly, 'structural' that it will be registered exactly as the structural scan.
+	fuse_early_nodes : bool, optional
+		Whether to crop dummy scans and compute the temporal mean in a single node (`samri.pipelines.extra_functions.fused_dummy_scans()`), which reads the time series once and writes it at most once.
+		The temporal mean is only taken from this node if no realignment is performed (`realign=""`), and is written in single precision.
 	keep_work : bool, str
 		Whether to keep the work directory after workflow conclusion (this directory contains all the intermediary processing commands, inputs, and outputs --- it is invaluable for debugging but many times larger in size than the actual output).
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
+		Node requirements are estimated from the input image sizes via `samri.pipelines.resources.plan_resources()`.
 	n_jobs : int, optional
 		Number of processors to maximally use for the workflow; if unspecified a best guess will be estimate based on `n_jobs_percentage` and hardware (but not on current load).
 	n_jobs_percentage : float, optional
@@ -372,6 +391,9 @@ def generic(bids_base, template,
 		Output base directory --- inside which a directory named `workflow_name`(as well as associated directories) will be created.
 	realign : {"space","time","spacetime",""}, optional
 		Parameter that dictates slictiming correction and realignment of slices. "time" (FSL.SliceTimer) is default, since it works safely. Use others only with caution!
+	registration_cache : bool or str, optional
+		Whether to store the registration transforms in a persistent cache, or path to the cache directory (by default `samri.pipelines.extra_interfaces.REGISTRATION_CACHE_DIR`).
+		Entries are keyed by the contents of the registration inputs and by the registration parameters, so that reruns (e.g. with different smoothing or realignment settings) skip all registrations whose inputs are unchanged, even if the work directory was deleted.
 	registration_mask : str, optional
 		Mask to use for the registration process.
 		This mask will constrain the area for similarity metric evaluation, but the data will not be cropped.
@@ -431,7 +453,10 @@ def generic(bids_base, template,
 		get_f_scan.inputs.bids_base = bids_base
 		get_f_scan.iterables = ("ind_type", func_ind)
 
-		dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getfullargspec(force_dummy_scans)[0], output_names=['out_file','deleted_scans']))
+		if fuse_early_nodes:
+			dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=fused_dummy_scans,input_names=inspect.getfullargspec(fused_dummy_scans)[0], output_names=['out_file','deleted_scans','mean_file']))
+		else:
+			dummy_scans = pe.Node(name='dummy_scans', interface=util.Function(function=force_dummy_scans,input_names=inspect.getfullargspec(force_dummy_scans)[0], output_names=['out_file','deleted_scans']))
 		dummy_scans.inputs.desired_dummy_scans = enforce_dummy_scans
 
 		events_file = pe.Node(name='events_file', interface=util.Function(function=write_bids_events_file,input_names=inspect.getfullargspec(write_bids_events_file)[0], output_names=['out_file']))
@@ -503,6 +528,7 @@ def generic(bids_base, template,
 		s_register, s_warp, f_register, f_warp = generic_registration(template,
 			structural_mask=registration_mask,
 			phase_dictionary=phase_dictionary,
+			registration_cache=registration_cache,
 			)
 		#TODO: incl. in func registration
 		if autorotate:
@@ -554,7 +580,11 @@ def generic(bids_base, template,
 	elif functional_registration_method == "composite":
 		if not structural_scan_types.any():
 			raise ValueError('The option `registration="composite"` requires there to be a structural scan type.')
-		temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+		if fuse_early_nodes and realign not in ["space", "spacetime", "time"]:
+			# The temporal mean is computed by the `dummy_scans` node, and only passed on.
+			temporal_mean = pe.Node(interface=util.IdentityInterface(fields=['out_file']), name="temporal_mean")
+		else:
+			temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
 
 		merge = pe.Node(util.Merge(2), name='merge')
 
@@ -581,15 +611,26 @@ def generic(bids_base, template,
 				(realigner, temporal_mean, [('slice_time_corrected_file', 'in_file')]),
 				(realigner, f_warp, [('slice_time_corrected_file', 'input_image')]),
 				])
+		elif fuse_early_nodes:
+			workflow_connections.extend([
+				(dummy_scans, temporal_mean, [('mean_file', 'out_file')]),
+				(dummy_scans, f_warp, [('out_file', 'input_image')]),
+				])
 		else:
 			workflow_connections.extend([
 				(dummy_scans, temporal_mean, [('out_file', 'in_file')]),
 				(dummy_scans, f_warp, [('out_file', 'input_image')]),
 				])
 	elif functional_registration_method == "functional":
-		f_register, f_warp = functional_registration(template)
+		f_register, f_warp = functional_registration(template,
+			registration_cache=registration_cache,
+			)
 
-		temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
+		if fuse_early_nodes and realign not in ["space", "spacetime", "time"]:
+			# The temporal mean is computed by the `dummy_scans` node, and only passed on.
+			temporal_mean = pe.Node(interface=util.IdentityInterface(fields=['out_file']), name="temporal_mean")
+		else:
+			temporal_mean = pe.Node(interface=fsl.MeanImage(), name="temporal_mean")
 
 		#f_cutoff = pe.Node(interface=fsl.ImageMaths(), name="f_cutoff")
 		#f_cutoff.inputs.op_string = "-thrP 30"
@@ -621,6 +662,11 @@ def generic(bids_base, template,
 				(realigner, temporal_mean, [('slice_time_corrected_file', 'in_file')]),
 				(realigner, f_warp, [('slice_time_corrected_file', 'input_image')]),
 				])
+		elif fuse_early_nodes:
+			workflow_connections.extend([
+				(dummy_scans, temporal_mean, [('mean_file', 'out_file')]),
+				(dummy_scans, f_warp, [('out_file', 'input_image')]),
+				])
 		else:
 			workflow_connections.extend([
 				(dummy_scans, temporal_mean, [('out_file', 'in_file')]),
@@ -651,7 +697,12 @@ def generic(bids_base, template,
 	except OSError:
 		print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
-	workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_jobs})
+	plugin_args = plan_resources(workflow, data_selection['path'].tolist(),
+		template=template,
+		n_procs=n_jobs,
+		memory_budget=memory_budget,
+		)
+	workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 	copy_bids_files(bids_base, os.path.join(out_base,workflow_name))
 	if not keep_work:
 		workdir = path.join(workflow.base_dir,workdir_name)
@@ -1,10 +1,11 @@
 from os import path, remove
-from samri.pipelines.extra_functions import flip_if_needed, get_data_selection, get_bids_scan, write_bids_metadata_file, write_bids_events_file, write_bids_physio_file, BIDS_METADATA_EXTRACTION_DICTS
+from samri.pipelines.extra_functions import flip_if_needed, get_data_selections, get_bids_scan, write_bids_metadata_file, write_bids_events_file, write_bids_physio_file, BIDS_METADATA_EXTRACTION_DICTS
 import os
 
 import argh
 import re
 import inspect
+import hashlib
 import json
 import os
 import shutil
@@ -18,6 +19,7 @@ import pandas as pd
 
 from samri.pipelines.utils import sessions_file, ss_to_path
 from samri.pipelines.extra_interfaces import Bru2
+from samri.pipelines.resources import plan_resources
 from samri.utilities import N_PROCS
 
 try:
@@ -27,6 +29,234 @@ except NameError:
 
 N_PROCS=max(N_PROCS-4, 2)
 
+MANIFEST_DIR = path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'samri', 'bru2bids')
+STAGING_SUFFIX = '_staging'
+
+def _scan_dirs(data_selection):
+	"""Return the Bruker ParaVision scan directories of a data selection, as constructed by `samri.pipelines.extra_functions.get_bids_scan()`."""
+	return [measurement+'/'+scan for measurement, scan in zip(data_selection['measurement'], data_selection['scan'])]
+
+def manifest_path(out_dir):
+	"""Return the path of the direct conversion manifest for a BIDS directory.
+
+	Manifests are stored in the user cache directory (`samri.pipelines.reposit.MANIFEST_DIR`), keyed by the path of the BIDS directory, so that they are not published with the dataset.
+	"""
+	out_dir = path.abspath(path.expanduser(out_dir))
+	os.makedirs(MANIFEST_DIR, exist_ok=True)
+	out_dir_hash = hashlib.sha1(out_dir.encode('utf-8')).hexdigest()
+	return path.join(MANIFEST_DIR, out_dir_hash+'.jsonl')
+
+def _read_manifest(manifest):
+	"""Return the manifest entries of completed scan conversions, keyed by (scan path, modality directory, NIfTI name)."""
+	entries = {}
+	try:
+		with open(manifest, 'r') as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# A line may be truncated if the writing process was killed.
+					continue
+				entries[(entry['scan_path'], entry['modality_dir'], entry['nii_name'])] = entry
+	except FileNotFoundError:
+		pass
+	return entries
+
+def _direct_jobs(data_selection, modality_dir,
+	extra=['acq','run'],
+	flip=True,
+	force_conversion=False,
+	events=False,
+	):
+	"""Return the direct conversion job dictionaries of a data selection, as consumed by `samri.pipelines.reposit.convert_scan()`."""
+	jobs = []
+	for ind in data_selection.index.tolist():
+		scan_path, _, task, _, nii_name, eventfile_name, subject_session, metadata_filename, _, _ = get_bids_scan(data_selection,
+			ind_type=ind,
+			extra=extra,
+			)
+		jobs.append({
+			'scan_path':scan_path,
+			'modality_dir':modality_dir,
+			'subject_session':subject_session,
+			'nii_name':nii_name,
+			'metadata_filename':metadata_filename,
+			'eventfile_name':eventfile_name if events else '',
+			'task':task,
+			'PV_position':data_selection.loc[ind,'PV_position'] if flip else '',
+			'force_conversion':force_conversion,
+			})
+	return jobs
+
+def convert_scan(job, out_dir, manifest, staging_base,
+	inflated_size=False,
+	):
+	"""
+	Convert one Bruker ParaVision scan, and write its NIfTI file, sidecar JSON, and (for functional scans) events and physiology files directly into a BIDS directory.
+	All files are produced in a staging directory inside `staging_base` and moved to their final location with atomic renames, after which the conversion is recorded in the manifest.
+
+	Parameters
+	----------
+
+	job : dict
+		Conversion job, as produced by `samri.pipelines.reposit._direct_jobs()`.
+	out_dir : str
+		Path to the root of the BIDS directory.
+	manifest : str
+		Path to the JSON Lines manifest file in which to record completed conversions.
+	staging_base : str
+		Path to the directory in which to create the staging directory, which should be on the same file system as `out_dir`.
+	inflated_size : bool, optional
+		Whether to inflate the voxel size reported by the scanner when converting the data to NIfTI.
+
+	Returns
+	-------
+
+	list of str or None
+		Paths of the files written to the BIDS directory, or `None` if the conversion failed.
+	"""
+
+	import tempfile
+
+	staging_dir = tempfile.mkdtemp(dir=staging_base)
+	try:
+		os.makedirs(path.join(staging_dir,'bru2'))
+		converter = Bru2()
+		converter.inputs.input_dir = job['scan_path']
+		converter.inputs.output_filename = path.join(staging_dir,'bru2',job['nii_name'])
+		converter.inputs.actual_size = not inflated_size
+		converter.inputs.compress = True
+		if job['force_conversion']:
+			converter.inputs.force_conversion = True
+		nii_file = converter.run().outputs.nii_file
+		if job['PV_position']:
+			nii_file = flip_if_needed(pd.DataFrame([{'PV_position':job['PV_position']}]), nii_file, 0,
+				output_filename=path.join(staging_dir,job['nii_name']),
+				)
+		staged_files = [write_bids_metadata_file(job['scan_path'], BIDS_METADATA_EXTRACTION_DICTS,
+			out_file=path.join(staging_dir,job['metadata_filename']),
+			task=job['task'],
+			)]
+		if job['eventfile_name']:
+			# Events and physiology files are optional, as in the nipype workflow.
+			try:
+				staged_files.append(write_bids_events_file(job['scan_path'],
+					metadata_file=staged_files[0],
+					out_file=path.join(staging_dir,job['eventfile_name']),
+					task=job['task'],
+					timecourse_file=nii_file,
+					))
+			except Exception as e:
+				print('Could not write events file for {}: {}'.format(job['scan_path'], e))
+			physio_files = write_bids_physio_file(job['scan_path'],
+				nii_name=path.join(staging_dir,job['nii_name']),
+				)
+			if physio_files != '/dev/null':
+				staged_files.extend(physio_files)
+		staged_files = [i for i in staged_files if i != '/dev/null']
+		# The NIfTI file is moved last, so that its presence implies the presence of its associated files.
+		staged_files.append(nii_file)
+
+		target_dir = path.join(out_dir, ss_to_path(job['subject_session']), job['modality_dir'])
+		try:
+			os.makedirs(target_dir)
+		except FileExistsError:
+			pass
+		out_files = []
+		for staged_file in staged_files:
+			if staged_file == nii_file:
+				out_file = path.join(target_dir, job['nii_name']+'.nii.gz')
+			else:
+				out_file = path.join(target_dir, path.basename(staged_file))
+			os.replace(staged_file, out_file)
+			out_files.append(out_file)
+	except Exception as e:
+		print('Could not convert {}: {}'.format(job['scan_path'], e))
+		return None
+	finally:
+		shutil.rmtree(staging_dir, ignore_errors=True)
+
+	entry = dict(job)
+	entry['files'] = [path.relpath(i, out_dir) for i in out_files]
+	# Single appends of short lines are atomic, so concurrent workers can share the manifest.
+	with open(manifest, 'a') as f:
+		f.write(json.dumps(entry)+'\n')
+	return out_files
+
+def direct_conversion(out_dir, jobs,
+	inflated_size=False,
+	n_procs=N_PROCS,
+	resume=True,
+	):
+	"""
+	Convert Bruker ParaVision scans directly into a BIDS directory in a bounded process pool, bypassing the nipype work directory.
+	Files are staged in a `{out_dir}_staging` directory next to the BIDS directory, which is removed once all jobs have run.
+	Completed conversions are recorded in a manifest in the user cache directory (see `samri.pipelines.reposit.manifest_path()`), so that interrupted or partially failed runs can be resumed.
+
+	Parameters
+	----------
+
+	out_dir : str
+		Path to the root of the BIDS directory.
+	jobs : list of dict
+		Conversion jobs, as produced by `samri.pipelines.reposit._direct_jobs()`.
+	inflated_size : bool, optional
+		Whether to inflate the voxel size reported by the scanner when converting the data to NIfTI.
+	n_procs : int, optional
+		Maximum number of scans to convert simultaneously.
+	resume : bool, optional
+		Whether to skip scans which the manifest records as converted, and the files of which are still present.
+
+	Returns
+	-------
+
+	list
+		Paths of the files written by each job which was run.
+
+	Raises
+	------
+
+	RuntimeError
+		If any of the scans could not be converted, after all other jobs have run.
+	"""
+
+	from samri.report.execution import parallel_map
+
+	out_dir = path.abspath(path.expanduser(out_dir))
+	manifest = manifest_path(out_dir)
+	# Remove staging files left behind by interrupted runs.
+	staging_base = out_dir.rstrip('/')+STAGING_SUFFIX
+	shutil.rmtree(staging_base, ignore_errors=True)
+	os.makedirs(staging_base)
+	if resume:
+		done = _read_manifest(manifest)
+		remaining = []
+		for job in jobs:
+			entry = done.get((job['scan_path'], job['modality_dir'], job['nii_name']))
+			if entry and all(path.isfile(path.join(out_dir,i)) for i in entry['files']):
+				continue
+			remaining.append(job)
+		jobs = remaining
+	elif path.isfile(manifest):
+		os.remove(manifest)
+
+	try:
+		out_files = parallel_map(convert_scan,
+			jobs,
+			[out_dir]*len(jobs),
+			[manifest]*len(jobs),
+			[staging_base]*len(jobs),
+			[inflated_size]*len(jobs),
+			backend='multiprocessing',
+			n_jobs=n_procs,
+			)
+	finally:
+		shutil.rmtree(staging_base, ignore_errors=True)
+	failed = [job['scan_path'] for job, files in zip(jobs, out_files) if files is None]
+	if failed:
+		raise RuntimeError('Could not convert {} of {} scans (see the messages above), rerun to retry only these: {}'.format(len(failed), len(jobs), ', '.join(failed)))
+	return out_files
+
 @argh.arg('-e','--exclude', type=json.loads)
 @argh.arg('-d','--diffusion-match', type=json.loads)
 @argh.arg('-f','--functional-match', type=json.loads)
@@ -40,12 +270,14 @@ def bru2bids(measurements_base,
 	dataset_name=False,
 	debug=False,
 	diffusion_match={},
+	direct=False,
 	exclude={},
 	functional_match={},
 	inflated_size=False,
 	keep_crashdump=False,
 	keep_work=False,
 	measurements=[],
+	memory_budget=None,
 	n_procs=N_PROCS,
 	out_base=None,
 	structural_match={},
@@ -80,6 +312,10 @@ def bru2bids(measurements_base,
 	diffusion_match : dict, optional
 		A dictionary with any combination of "session", "subject", "task", and "acquisition" as keys and corresponding lists of identifiers as values.
 		Only diffusion scans matching all identifiers will be included - i.e. this is a whitelist.
+	direct : bool, optional
+		Whether to convert scans directly into the BIDS directory in a process pool (see `samri.pipelines.reposit.direct_conversion()`), rather than via a nipype workflow staged through a work directory.
+		Direct conversions are recorded in a manifest file in the user cache directory, so that interrupted runs can be resumed.
+		If any scans fail to convert, a `RuntimeError` listing them is raised.
 	exclude : dict, optional
 		A dictionary with any combination of "session", "subject", "task" , and "acquisition" as keys and corresponding identifiers as values.
 		Only scans not matching any of the listed criteria will be included in the workfolow - i.e. this is a blacklist (for functional and structural scans).
@@ -98,6 +334,8 @@ def bru2bids(measurements_base,
 		This is useful for debugging and quality control.
 	measurements : list, optional
 		Whitelist of Bruker ParaVision scan directories to consider.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
 	n_procs : int, optional
 		Maximum number of processes which to simultaneously spawn for the workflow.
 		If not explicitly defined, this is automatically calculated from the number of available cores and under the assumption that the workflow will be the main process running for the duration that it is running.
@@ -143,36 +381,45 @@ def bru2bids(measurements_base,
 	# define measurement directories to be processed, and populate the list either with the given include_measurements, or with an intelligent selection
 	functional_scan_types = diffusion_scan_types = structural_scan_types = []
 	data_selection = pd.DataFrame([])
+	# All match passes share a single (cached) parse of the measurement directories.
+	s_data_selection, f_data_selection, d_data_selection = get_data_selections(measurements_base,
+		[structural_match, functional_match, diffusion_match],
+		exclude=exclude,
+		measurements=measurements,
+		)
 	if structural_match:
-		s_data_selection = get_data_selection(measurements_base,
-			match=structural_match,
-			exclude=exclude,
-			measurements=measurements,
-			)
 		print(s_data_selection.columns)
 		structural_scan_types = list(s_data_selection['scan_type'].unique())
 		struct_ind = s_data_selection.index.tolist()
 		data_selection = pd.concat([data_selection,s_data_selection], sort=True)
 	if functional_match:
-		f_data_selection = get_data_selection(measurements_base,
-			match=functional_match,
-			exclude=exclude,
-			measurements=measurements,
-			)
 		print(f_data_selection)
 		functional_scan_types = list(f_data_selection['scan_type'].unique())
 		func_ind = f_data_selection.index.tolist()
 		data_selection = pd.concat([data_selection,f_data_selection], sort=True)
 	if diffusion_match:
-		d_data_selection = get_data_selection(measurements_base,
-			match=diffusion_match,
-			exclude=exclude,
-			measurements=measurements,
-			)
 		diffusion_scan_types = list(d_data_selection['scan_type'].unique())
 		dwi_ind = d_data_selection.index.tolist()
 		data_selection = pd.concat([data_selection,d_data_selection], sort=True)
 
+	if direct:
+		jobs = []
+		if functional_scan_types:
+			jobs += _direct_jobs(f_data_selection, 'func', events=True)
+		if diffusion_scan_types:
+			jobs += _direct_jobs(d_data_selection, 'dwi', extra=['acq'], flip=False, force_conversion=True)
+		if structural_scan_types:
+			jobs += _direct_jobs(s_data_selection, 'anat', extra=['acq'], force_conversion=True)
+		if debug:
+			print('Direct conversion jobs:')
+			print(pd.DataFrame(jobs))
+		direct_conversion(out_dir, jobs,
+			inflated_size=inflated_size,
+			n_procs=n_procs,
+			)
+		# No nipype workflows need to be run.
+		functional_scan_types = diffusion_scan_types = structural_scan_types = []
+
 	# we start to define nipype workflow elements (nodes, connections, meta)
 	subjects_sessions = data_selection[["subject","session"]].drop_duplicates().values.tolist()
 	if debug:
@@ -268,13 +515,17 @@ def bru2bids(measurements_base,
 			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 		#Execute the workflow
+		plugin_args = plan_resources(workflow, _scan_dirs(f_data_selection),
+			n_procs=n_procs,
+			memory_budget=memory_budget,
+			)
 		if not keep_work or not keep_crashdump:
 			try:
-				workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+				workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 			except RuntimeError:
 				pass
 		else:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+			workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 		if not keep_work:
 			shutil.rmtree(path.join(workflow.base_dir,workdir_name))
 		if not keep_crashdump:
@@ -339,13 +590,17 @@ def bru2bids(measurements_base,
 			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 		#Execute the workflow
+		plugin_args = plan_resources(workflow, _scan_dirs(d_data_selection),
+			n_procs=n_procs,
+			memory_budget=memory_budget,
+			)
 		if not keep_work or not keep_crashdump:
 			try:
-				workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+				workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 			except RuntimeError:
 				pass
 		else:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+			workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 		if not keep_work:
 			shutil.rmtree(path.join(workflow.base_dir,workdir_name))
 		if not keep_crashdump:
@@ -415,13 +670,17 @@ def bru2bids(measurements_base,
 			print('We could not write the DOT file for visualization (`dot` function from the graphviz package). This is non-critical to the processing, but you should get this fixed.')
 
 		#Execute the workflow
+		plugin_args = plan_resources(workflow, _scan_dirs(s_data_selection),
+			n_procs=n_procs,
+			memory_budget=memory_budget,
+			)
 		if not keep_work or not keep_crashdump:
 			try:
-				workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+				workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 			except RuntimeError:
 				pass
 		else:
-			workflow.run(plugin="MultiProc", plugin_args={'n_procs' : n_procs})
+			workflow.run(plugin="MultiProc", plugin_args=plugin_args)
 		if not keep_work:
 			shutil.rmtree(path.join(workflow.base_dir,workdir_name))
 		if not keep_crashdump:
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing as mp
+import nibabel as nib
+import numpy as np
+import os
+from os import path
+
+from samri.report.execution import available_memory
+
+# Memory (in GB) which every node process occupies irrespective of its inputs (Python interpreter, nipype, command wrapper).
+NODE_OVERHEAD_GB = 0.25
+# Minimal number of threads assigned to threaded nodes, as used for ANTs nodes before resources were planned.
+MIN_THREADS = 4
+
+# Memory requirements of interfaces, by interface class name, as (input size kind, multiple of input size, whether the interface is threaded).
+# The size kinds are those returned by `samri.pipelines.resources.input_sizes()`.
+INTERFACE_REQUIREMENTS = {
+	'Registration':('volume', 40., True),
+	'CachedRegistration':('volume', 40., True),
+	'ApplyTransforms':('resampled_series', 2.5, True),
+	'N4BiasFieldCorrection':('volume', 10., True),
+	'SliceTimer':('series', 3., False),
+	'MCFLIRT':('series', 3., False),
+	'SpaceTimeRealigner':('series', 4., False),
+	'MeanImage':('series', 1.5, False),
+	'TemporalFilter':('resampled_series', 3., False),
+	'BlurToFWHM':('resampled_series', 3., False),
+	'GLM':('resampled_series', 3., False),
+	'FLAMEO':('volume', 20., False),
+	'MELODIC':('resampled_series', 6., False),
+	'Bru2':('series', 2., False),
+	}
+
+# Memory requirements of `nipype.interfaces.utility.Function` nodes, by node name, as above.
+FUNCTION_REQUIREMENTS = {
+	'dummy_scans':('series', 2., False),
+	'f_flip':('series', 2., False),
+	'glm':('resampled_series', 3., False),
+	}
+
+def image_gb(file_path):
+	"""
+	Return the in-memory size (in GB) of an image, as (at least single precision) floating point data, without reading its data.
+
+	Parameters
+	----------
+
+	file_path : str
+		Path to a NIfTI file, to a Bruker ParaVision scan directory, or to any other file (whose size on disk is used).
+
+	Returns
+	-------
+
+	tuple
+		Size of the full image, and size of a single volume (both in GB); zeros if the file does not exist.
+	"""
+
+	file_path = path.abspath(path.expanduser(file_path))
+	if path.isdir(file_path):
+		# Bruker scan directories contain the reconstructed image as unscaled binary data.
+		file_path = path.join(file_path, 'pdata', '1', '2dseq')
+	try:
+		img = nib.load(file_path)
+	except FileNotFoundError:
+		return 0., 0.
+	except nib.filebasedimages.ImageFileError:
+		try:
+			size = os.path.getsize(file_path)*4./1024**3
+		except OSError:
+			return 0., 0.
+		return size, size
+	itemsize = max(img.get_data_dtype().itemsize, 4)
+	volume = np.prod(img.shape[:3], dtype=np.int64)*itemsize/1024.**3
+	return volume*np.prod(img.shape[3:], dtype=np.int64), volume
+
+def input_sizes(in_files,
+	template=None,
+	):
+	"""
+	Return the largest input sizes relevant to the memory requirements of workflow nodes.
+
+	Parameters
+	----------
+
+	in_files : list
+		Paths to the input images of the workflow.
+	template : str, optional
+		Path to the template image, into whose space the input images are resampled.
+
+	Returns
+	-------
+
+	dict
+		Dictionary with the keys 'series' (largest full input image), 'volume' (largest single volume, including the template), and 'resampled_series' (largest number of volumes on the largest grid), and GB values.
+	"""
+
+	sizes = [image_gb(i) for i in in_files]
+	if template:
+		_, template_volume = image_gb(template)
+		sizes.append((template_volume, template_volume))
+	if not sizes:
+		return {'series':0., 'volume':0., 'resampled_series':0.}
+	series = max([i[0] for i in sizes])
+	volume = max([i[1] for i in sizes])
+	volumes = max([i[0]/i[1] for i in sizes if i[1]] + [1])
+	return {
+		'series':series,
+		'volume':volume,
+		'resampled_series':max(series, volume*volumes),
+		}
+
+def node_requirements(node, sizes):
+	"""Return the estimated memory (in GB) of a node, and whether it is threaded."""
+	interface = node.interface.__class__.__name__
+	if interface == 'Function':
+		requirement = FUNCTION_REQUIREMENTS.get(node.name)
+	else:
+		requirement = INTERFACE_REQUIREMENTS.get(interface)
+	if not requirement:
+		return NODE_OVERHEAD_GB, False
+	kind, factor, threaded = requirement
+	return NODE_OVERHEAD_GB + factor*sizes[kind], threaded
+
+def plan_resources(workflow, in_files,
+	template=None,
+	n_procs=None,
+	memory_budget=None,
+	max_threads=8,
+	):
+	"""
+	Set the memory and thread requirements of all nodes in a workflow, based on the sizes of its input images, and return matching arguments for the nipype MultiProc plugin.
+	Memory estimates are taken from `samri.pipelines.resources.INTERFACE_REQUIREMENTS` and `samri.pipelines.resources.FUNCTION_REQUIREMENTS`, and threaded nodes (e.g. ANTs) are assigned an equal share of the processors across the instances which the memory budget admits concurrently.
+
+	Parameters
+	----------
+
+	workflow : nipype.pipeline.engine.Workflow
+		Workflow whose nodes to plan, this is modified in place.
+	in_files : list
+		Paths to the input images of the workflow (NIfTI files or Bruker scan directories).
+	template : str, optional
+		Path to the template image, into whose space the input images are resampled.
+	n_procs : int, optional
+		Number of processors to maximally use for the workflow, defaults to the CPU count.
+	memory_budget : float, optional
+		Total memory (in GB) which concurrently running nodes may occupy, defaults to 90% of the currently available memory.
+	max_threads : int, optional
+		Maximal number of threads to assign to a threaded node.
+		Threaded nodes are assigned at least `samri.pipelines.resources.MIN_THREADS` threads (if available), as the memory budget does not account for all limits on concurrency.
+
+	Returns
+	-------
+
+	dict
+		Plugin arguments for the nipype MultiProc plugin, with the keys 'n_procs' and 'memory_gb'.
+	"""
+
+	if not n_procs:
+		n_procs = mp.cpu_count()
+	if not memory_budget:
+		memory_budget = 0.9*available_memory()/1024.**3
+	sizes = input_sizes(in_files, template=template)
+
+	for node in workflow._get_all_nodes():
+		mem_gb, threaded = node_requirements(node, sizes)
+		# Nodes requiring more than the budget are run alone, rather than rejected by the scheduler.
+		node._mem_gb = min(mem_gb, memory_budget)
+		if threaded:
+			# One instance runs per input image, as far as the memory budget admits.
+			concurrent = min(max(int(memory_budget//node._mem_gb), 1), max(len(in_files), 1))
+			node.n_procs = min(max(n_procs//concurrent, MIN_THREADS), max_threads, n_procs)
+
+	return {'n_procs':n_procs, 'memory_gb':memory_budget}
@@ -0,0 +1,45 @@
+import os
+
+def _touch(file_path):
+	os.makedirs(os.path.dirname(file_path), exist_ok=True)
+	open(file_path, 'w').close()
+
+def test_catalog_df(tmp_path, monkeypatch):
+	from samri.pipelines import catalog
+
+	monkeypatch.setattr(catalog, 'CATALOG_DIR', str(tmp_path/'cache'))
+	catalog_df = catalog.catalog_df
+	base = str(tmp_path/'bids')
+	_touch(f'{base}/sub-1/ses-a/func/sub-1_ses-a_task-JogB_acq-EPI_run-0_cbv.nii.gz')
+	_touch(f'{base}/sub-1/ses-a/anat/sub-1_ses-a_acq-TurboRARE_T2w.nii.gz')
+	_touch(f'{base}/code/analysis.py')
+	_touch(f'{base}/.hidden/sub-1_ses-a_T2w.nii.gz')
+
+	df = catalog_df(base)
+	assert len(df) == 2
+	assert sorted(df['suffix'].tolist()) == ['T2w', 'cbv']
+	assert df.loc[df['suffix'] == 'cbv', 'task'].item() == 'JogB'
+
+	# Incremental updates pick up additions and removals.
+	_touch(f'{base}/sub-2/ses-b/func/sub-2_ses-b_task-CogB_acq-EPI_run-1_bold.nii.gz')
+	os.remove(f'{base}/sub-1/ses-a/anat/sub-1_ses-a_acq-TurboRARE_T2w.nii.gz')
+	df = catalog_df(base)
+	assert sorted(df['subject'].tolist()) == ['1', '2']
+	assert 'T2w' not in df['suffix'].tolist()
+
+	# The catalog is kept in the cache directory, and the BIDS directory is left untouched.
+	assert os.listdir(str(tmp_path/'cache')) == [os.path.basename(catalog.catalog_path(base))]
+	assert sorted(os.listdir(base)) == ['.hidden', 'code', 'sub-1', 'sub-2']
+
+def test_catalog_fallback(tmp_path, monkeypatch):
+	from samri.pipelines import catalog
+	from samri.pipelines.utils import bids_data_selection
+
+	base = str(tmp_path/'bids')
+	_touch(f'{base}/sub-1/ses-a/func/sub-1_ses-a_task-JogB_acq-EPI_run-0_cbv.nii.gz')
+	_touch(f'{base}/dataset_description.json')
+	# A cache directory which cannot be created.
+	_touch(str(tmp_path/'cache'))
+	monkeypatch.setattr(catalog, 'CATALOG_DIR', str(tmp_path/'cache'/'catalogs'))
+	df = bids_data_selection(base, structural_match=False, functional_match=False, subjects=False, sessions=False)
+	assert df['task'].tolist() == ['JogB']
@@ -64,3 +64,77 @@ def test_reset_background(tmp_path):
 	data = img.get_data()
 	bg_by_coordinates = data[0,0,0,0]
 	assert bg_by_coordinates == 1000
+
+def test_get_data_selections(tmp_path):
+	from os import path
+	from samri.pipelines.extra_functions import get_data_selection, get_data_selections
+
+	bruker_data_dir = path.join(path.dirname(path.realpath(__file__)),'../../tests/data/bruker')
+	cache = str(tmp_path / 'bruker_cache.json')
+	f_data_selection, s_data_selection = get_data_selections(bruker_data_dir,
+		[{'task':['JogB','CogB','CogB2m']}, {'acquisition':['TurboRARE', 'TurboRARElowcov']}],
+		cache=cache,
+		)
+	assert path.isfile(cache)
+	assert sorted(f_data_selection['scan'].tolist()) == ['13', '7', '9']
+	assert s_data_selection['modality'].tolist() == ['T2w', 'T2w']
+
+	# A second call is served from the cache, and subject matching drops entire measurements.
+	data_selection = get_data_selection(bruker_data_dir,
+		match={'acquisition':['EPI'], 'subject':['5704']},
+		cache=cache,
+		)
+	assert data_selection['subject'].tolist() == ['5704']
+	assert data_selection['task'].tolist() == ['CogB']
+
+def test_reset_background_chunked(tmp_path):
+	import nibabel as nib
+	import numpy as np
+	from samri.pipelines.extra_functions import background_modes, reset_background
+
+	rng = np.random.default_rng(0)
+	data = rng.integers(0, 50, size=(6,7,8,5)).astype(np.int16)
+	data[:3,:3,:3] = np.arange(5)*7 + 3
+	in_file = str(tmp_path/'in.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+
+	modes = background_modes(data)
+	assert np.array_equal(modes, np.arange(5)*7 + 3)
+
+	# Chunks of a single volume
+	out_file = reset_background(in_file, bg_value=-1, out_file=str(tmp_path/'out.nii.gz'), chunk_size=1)
+	out_data = np.asanyarray(nib.load(out_file).dataobj)
+	expected = data.copy()
+	for i in range(5):
+		expected[...,i][data[...,i] == modes[i]] = -1
+	assert np.array_equal(out_data, expected)
+
+def test_fused_dummy_scans(tmp_path):
+	import json
+	import nibabel as nib
+	import numpy as np
+	from samri.pipelines.extra_functions import fused_dummy_scans
+
+	data = np.random.default_rng(0).integers(0, 50, size=(4,5,6,12)).astype(np.int16)
+	in_file = str(tmp_path/'sub-1_task-rest_bold.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), in_file)
+	with open(str(tmp_path/'sub-1_task-rest_bold.json'), 'w') as f:
+		json.dump({'NumberOfVolumesDiscardedByScanner':2}, f)
+
+	out_file, deleted_scans, mean_file = fused_dummy_scans(in_file,
+		desired_dummy_scans=5,
+		out_file=str(tmp_path/'out.nii.gz'),
+		mean_file=str(tmp_path/'mean.nii.gz'),
+		chunk_size=1,
+		)
+	assert deleted_scans == 3
+	assert np.array_equal(np.asanyarray(nib.load(out_file).dataobj), data[...,3:])
+	assert np.allclose(np.asanyarray(nib.load(mean_file).dataobj), data[...,3:].mean(axis=3))
+
+	out_file, deleted_scans, mean_file = fused_dummy_scans(in_file,
+		desired_dummy_scans=2,
+		out_file=str(tmp_path/'copy.nii.gz'),
+		mean_file=str(tmp_path/'mean.nii.gz'),
+		)
+	assert deleted_scans == 0
+	assert np.array_equal(np.asanyarray(nib.load(out_file).dataobj), data)
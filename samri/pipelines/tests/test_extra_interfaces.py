@@ -0,0 +1,50 @@
+def test_cached_registration(tmp_path, monkeypatch):
+	import os
+	import nibabel as nib
+	import numpy as np
+	from nipype.interfaces.ants import Registration
+	from samri.pipelines.extra_interfaces import CachedRegistration
+
+	calls = []
+	def fake_run_interface(self, runtime, correct_return_codes=(0,)):
+		calls.append(runtime.cwd)
+		for suffix in ['Composite.h5', 'InverseComposite.h5']:
+			with open(os.path.join(runtime.cwd, self.inputs.output_transform_prefix+suffix), 'w') as f:
+				f.write(suffix)
+		self._elapsed_time = 1.
+		self._metric_value = -0.5
+		runtime.returncode = 0
+		return runtime
+	monkeypatch.setattr(Registration, '_run_interface', fake_run_interface)
+	monkeypatch.setattr(Registration, '_check_version_requirements', lambda self, trait_object, permissive=False: [])
+
+	image = str(tmp_path/'image.nii.gz')
+	nib.save(nib.Nifti1Image(np.ones((3,3,3), dtype=np.float32), np.eye(4)), image)
+
+	def run(cwd):
+		os.makedirs(cwd)
+		monkeypatch.chdir(cwd)
+		reg = CachedRegistration(
+			fixed_image=image,
+			moving_image=image,
+			transforms=['Affine'],
+			transform_parameters=[(1.0,)],
+			metric=['Mattes'],
+			metric_weight=[1],
+			radius_or_number_of_bins=[32],
+			number_of_iterations=[[10]],
+			shrink_factors=[[1]],
+			smoothing_sigmas=[[0]],
+			write_composite_transform=True,
+			output_transform_prefix='output_',
+			cache_dir=str(tmp_path/'cache'),
+			)
+		return reg.run()
+
+	first = run(str(tmp_path/'first'))
+	second = run(str(tmp_path/'second'))
+	assert len(calls) == 1
+	assert second.outputs.composite_transform == str(tmp_path/'second'/'output_Composite.h5')
+	with open(second.outputs.composite_transform) as f:
+		assert f.read() == 'Composite.h5'
+	assert second.outputs.metric_value == first.outputs.metric_value
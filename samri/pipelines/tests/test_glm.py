@@ -1,4 +1,6 @@
-from samri.pipelines.glm import l1, l1_physio, seed
+import os
+import pytest
+from samri.pipelines.glm import l1, l1_physio, l2_anova, l2_common_effect, seed
 
 PREPROCESS_BASE = '/usr/share/samri_bidsdata/preprocessing'
 
@@ -10,6 +12,19 @@ def test_l1(tmp_path):
 		workflow_name='l1',
 		)
 
+def test_l2_run_mode(tmp_path):
+	from samri.pipelines.glm import _l2_run_mode
+
+	assert _l2_run_mode('numpy', None) == 'ols'
+	assert _l2_run_mode('fsl', None) == 'flame12'
+	assert _l2_run_mode('numpy', 'fe') == 'fe'
+	# Invalid run modes are rejected before any data is selected or written.
+	with pytest.raises(ValueError):
+		l2_common_effect(str(tmp_path/'l1'), out_base=str(tmp_path), engine='numpy', run_mode='flame12')
+	with pytest.raises(ValueError):
+		l2_anova(str(tmp_path/'l1'), l2_dir=str(tmp_path/'l2'), engine='numpy', run_mode='flame1')
+	assert os.listdir(str(tmp_path)) == []
+
 # Takes too long or hangs
 #def test_physio():
 #	l1_physio(PREPROCESS_BASE, 'astrocytes',
@@ -0,0 +1,124 @@
+import numpy as np
+
+def _design(n=60):
+	rng = np.random.default_rng(0)
+	design = np.column_stack([np.sin(np.arange(n)/5.), rng.random(n), np.ones(n)])
+	contrasts = np.array([[1,0,0],[1,-1,0]])
+	data = design.dot(rng.random((3,20))) + rng.normal(size=(n,20))
+	return design, contrasts, data
+
+def _write_vest(file_path, matrix):
+	with open(file_path, 'w') as f:
+		f.write('/NumWaves\t{}\n/NumPoints\t{}\n\n/Matrix\n'.format(matrix.shape[1], matrix.shape[0]))
+		for row in matrix:
+			f.write(' '.join(str(i) for i in row)+'\n')
+	return str(file_path)
+
+def test_fit_glm():
+	from samri.pipelines.native import Design, fit_glm
+
+	design, contrasts, data = _design()
+	results = fit_glm(data, Design(design, contrasts))
+	betas, residuals, _, _ = np.linalg.lstsq(design, data, rcond=None)
+	assert np.allclose(results['betas'], betas)
+	assert np.allclose(results['cope'], contrasts.dot(betas))
+	sigma_squared = residuals/(design.shape[0] - 3)
+	varcb = np.diag(contrasts.dot(np.linalg.inv(design.T.dot(design))).dot(contrasts.T))[:,np.newaxis]*sigma_squared
+	assert np.allclose(results['varcb'], varcb)
+	assert np.allclose(results['tstat'], contrasts.dot(betas)/np.sqrt(varcb))
+
+	prewhitened = fit_glm(data, Design(design, contrasts), prewhiten=True)
+	assert prewhitened['tstat'].shape == results['tstat'].shape
+
+def test_fit_l1_files(tmp_path):
+	import nibabel as nib
+	from samri.pipelines.native import fit_l1_files
+
+	design, contrasts, data = _design()
+	design_file = _write_vest(tmp_path/'design.mat', design)
+	contrasts_file = _write_vest(tmp_path/'design.con', contrasts)
+	in_files = []
+	out_files = []
+	for i in range(2):
+		in_file = str(tmp_path/'scan{}.nii.gz'.format(i))
+		nib.save(nib.Nifti1Image(data.T.reshape((5,4,1,-1)).astype(np.float32), np.eye(4)), in_file)
+		in_files.append(in_file)
+		out_files.append({'cope':str(tmp_path/'cope{}.nii.gz'.format(i)), 'zstat':str(tmp_path/'zstat{}.nii.gz'.format(i))})
+	written = fit_l1_files(in_files, [design_file]*2, [contrasts_file]*2, out_files, memory_budget=1)
+	assert written == out_files
+	assert nib.load(out_files[1]['cope']).shape == (5,4,1,2)
+
+def test_l1_memory(tmp_path):
+	import nibabel as nib
+	from samri.pipelines.native import L1_WORKING_COPIES, l1_memory
+
+	in_file = str(tmp_path/'scan.nii.gz')
+	nib.save(nib.Nifti1Image(np.zeros((5,4,3,10), dtype=np.int16), np.eye(4)), in_file)
+	assert l1_memory(in_file) == 600*2 + 600*8*L1_WORKING_COPIES
+	assert l1_memory(str(tmp_path/'missing.nii.gz')) == 0
+
+def test_fit_l2(tmp_path):
+	import nibabel as nib
+	from samri.pipelines.native import fit_l2
+
+	rng = np.random.default_rng(1)
+	copes = []
+	varcbs = []
+	values = rng.normal(1., 1., size=(6,4,3,5))
+	for i, value in enumerate(values):
+		copes.append(str(tmp_path/'cope{}.nii.gz'.format(i)))
+		varcbs.append(str(tmp_path/'varcb{}.nii.gz'.format(i)))
+		nib.save(nib.Nifti1Image(value.astype(np.float32), np.eye(4)), copes[-1])
+		nib.save(nib.Nifti1Image(np.ones((4,3,5), dtype=np.float32), np.eye(4)), varcbs[-1])
+	models = [
+		{'rows':list(range(6)), 'design':[[1]]*6, 't_contrasts':[('mean',[1])], 'out_file':str(tmp_path/'all_{stat}.nii.gz')},
+		{'rows':[0,1,2], 'design':[[1]]*3, 't_contrasts':[('mean',[1])], 'out_file':str(tmp_path/'subset_{stat}.nii.gz')},
+		]
+	written = fit_l2(copes, models, varcbs=varcbs, block_slices=2)
+	assert str(tmp_path/'all_tstat.nii.gz') in written[0]
+	cope = np.asanyarray(nib.load(str(tmp_path/'subset_cope.nii.gz')).dataobj)
+	assert np.allclose(cope, values[:3].mean(axis=0), atol=1e-5)
+	tstat = np.asanyarray(nib.load(str(tmp_path/'all_tstat.nii.gz')).dataobj)
+	expected = values.mean(axis=0)/(values.std(axis=0, ddof=1)/np.sqrt(6))
+	assert np.allclose(tstat, expected, atol=1e-4)
+
+	fit_l2(copes, models[:1], varcbs=varcbs, run_mode='fe')
+	varcope = np.asanyarray(nib.load(str(tmp_path/'all_varcope.nii.gz')).dataobj)
+	assert np.allclose(varcope, 1/6.)
+
+def test_l2_block():
+	from scipy import stats
+	from samri.pipelines.native import _l2_block, _t_to_z
+
+	rng = np.random.default_rng(2)
+	design = np.column_stack([np.ones(12), np.repeat([0,1,0], 4), np.repeat([0,0,1], 4)])
+	t_contrasts = np.array([[1,0,0],[0,1,0],[0,0,1]], dtype=np.float64)
+	copes = design.dot(rng.normal(size=(3,30))) + rng.normal(size=(12,30))
+	copes[:,0] = design.dot([1000,0,0]) + rng.normal(size=12)*1e-3
+	results = _l2_block(copes, None, design, t_contrasts, [[1,2]], 'ols')
+
+	# Per-voxel parameter covariance, as estimated before sharing (X'X)+ across voxels.
+	pinv = np.linalg.pinv(design)
+	betas = pinv.dot(copes)
+	sigma_squared = np.sum((copes - design.dot(betas))**2, axis=0)/9
+	covariance = pinv.dot(pinv.T)[np.newaxis]*sigma_squared[:,np.newaxis,np.newaxis]
+	assert np.allclose(results['varcope'], np.einsum('ci,vij,cj->cv', t_contrasts, covariance, t_contrasts))
+	contrast = t_contrasts[[1,2]]
+	estimate = contrast.dot(betas)
+	solved = np.einsum('vcd,dv->cv', np.linalg.pinv(np.einsum('ci,vij,dj->vcd', contrast, covariance, contrast)), estimate)
+	assert np.allclose(results['fstat'][0], np.sum(estimate*solved, axis=0)/2)
+
+	assert np.all(np.isfinite(results['zstat']))
+	assert results['zstat'][0,0] > 10
+	# The tail probability of large statistics underflows, but not its logarithm.
+	assert np.isinf(stats.norm.isf(stats.t.sf(60., 1000)))
+	assert 38 < _t_to_z(np.array([60.]), 1000)[0] < 60
+	assert 38 < _t_to_z(np.array([-60.]), 1000)[0]*-1 < 60
+	assert np.allclose(results['zstat'][:,1:], stats.norm.isf(stats.t.sf(results['tstat'][:,1:], 9)), atol=1e-6)
+	assert np.allclose(results['zfstat'][0,1:], stats.norm.isf(stats.f.sf(results['fstat'][0,1:], 2, 9)), atol=1e-6)
+
+	varcbs = np.ones_like(copes)
+	fe = _l2_block(copes, varcbs, design, t_contrasts, [], 'fe')
+	fe_dofs = _l2_block(copes, varcbs, design, t_contrasts, [], 'fe', dofs=np.full(12, 20.))
+	assert np.allclose(fe['tstat'], fe_dofs['tstat'])
+	assert np.allclose(fe_dofs['zstat'][:,1:], stats.norm.isf(stats.t.sf(fe['tstat'][:,1:], 240)), atol=1e-6)
@@ -13,3 +13,57 @@ def test_bru2bids(tmp_path):
 		#keep_crashdump=True,
 		keep_work=True,
 		)
+
+def test_bru2bids_direct(tmp_path, monkeypatch):
+	import os
+	from samri.pipelines import reposit
+
+	monkeypatch.setattr(reposit, 'MANIFEST_DIR', str(tmp_path/'cache'))
+	bru2bids(BRU_DIR,
+		inflated_size=False,
+		functional_match={"acquisition":["EPI"]},
+		structural_match={"acquisition":["TurboRARE"]},
+		out_base=tmp_path,
+		direct=True,
+		)
+	manifest = reposit.manifest_path(os.path.join(tmp_path,'bids'))
+	assert os.path.isfile(manifest)
+	assert not [i for i in os.listdir(os.path.join(tmp_path,'bids')) if i.startswith('.')]
+	with open(manifest) as f:
+		converted = len(f.readlines())
+
+	# A repeated run resumes from the manifest and converts nothing anew.
+	bru2bids(BRU_DIR,
+		inflated_size=False,
+		functional_match={"acquisition":["EPI"]},
+		structural_match={"acquisition":["TurboRARE"]},
+		out_base=tmp_path,
+		direct=True,
+		)
+	with open(manifest) as f:
+		assert len(f.readlines()) == converted
+
+def test_direct_conversion_failure(tmp_path, monkeypatch):
+	import os
+	import pytest
+	from samri.pipelines import reposit
+
+	monkeypatch.setattr(reposit, 'MANIFEST_DIR', str(tmp_path/'cache'))
+	out_dir = str(tmp_path/'bids')
+	os.makedirs(out_dir)
+	job = {
+		'scan_path':str(tmp_path/'missing'/'1'),
+		'modality_dir':'anat',
+		'subject_session':['1','ofM'],
+		'nii_name':'sub-1_ses-ofM_T2w',
+		'metadata_filename':'sub-1_ses-ofM_T2w.json',
+		'eventfile_name':'',
+		'task':'',
+		'PV_position':'',
+		'force_conversion':True,
+		}
+	with pytest.raises(RuntimeError, match='1 of 1 scans'):
+		reposit.direct_conversion(out_dir, [job], n_procs=1)
+	# Neither the manifest nor any staging files are left in, or next to, the BIDS directory.
+	assert os.listdir(out_dir) == []
+	assert sorted(os.listdir(str(tmp_path))) == ['bids', 'cache']
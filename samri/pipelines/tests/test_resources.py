@@ -0,0 +1,58 @@
+def test_plan_resources(tmp_path):
+	import nibabel as nib
+	import numpy as np
+	import nipype.interfaces.utility as util
+	import nipype.pipeline.engine as pe
+	from nipype.interfaces import ants
+	from samri.pipelines.resources import plan_resources, NODE_OVERHEAD_GB
+
+	functional = str(tmp_path/'functional.nii.gz')
+	nib.save(nib.Nifti1Image(np.zeros((64,64,32,256), dtype=np.int16), np.eye(4)), functional)
+	template = str(tmp_path/'template.nii.gz')
+	nib.save(nib.Nifti1Image(np.zeros((128,128,64), dtype=np.float64), np.eye(4)), template)
+
+	def crop(in_file):
+		return in_file
+	source = pe.Node(util.IdentityInterface(fields=['in_file']), name='source')
+	dummy_scans = pe.Node(util.Function(function=crop, input_names=['in_file'], output_names=['out_file']), name='dummy_scans')
+	warp = pe.Node(ants.ApplyTransforms(), name='f_warp')
+	workflow = pe.Workflow(name='planned', base_dir=str(tmp_path))
+	workflow.connect([
+		(source, dummy_scans, [('in_file', 'in_file')]),
+		(dummy_scans, warp, [('out_file', 'input_image')]),
+		])
+
+	plugin_args = plan_resources(workflow, [functional],
+		template=template,
+		n_procs=4,
+		memory_budget=2,
+		)
+	assert plugin_args == {'n_procs':4, 'memory_gb':2}
+	assert source.mem_gb == NODE_OVERHEAD_GB
+	# 64*64*32 voxels * 256 volumes * 4 bytes (data is computed on in single precision) = 0.125 GB
+	assert np.isclose(dummy_scans.mem_gb, NODE_OVERHEAD_GB + 2*0.125)
+	assert source.n_procs == 1
+	assert warp.n_procs == 4
+	assert warp.interface.inputs.num_threads == 4
+	# The template grid (8 times the functional grid, and 8 bytes per voxel) exceeds the budget, which caps the estimate.
+	assert warp.mem_gb == 2
+
+	# With more inputs than processors, the thread share follows the number of nodes which the memory budget admits at once.
+	plan_resources(workflow, [functional]*16,
+		template=template,
+		n_procs=16,
+		memory_budget=2,
+		)
+	assert warp.n_procs == 8
+	plan_resources(workflow, [functional]*16,
+		template=template,
+		n_procs=16,
+		memory_budget=1000,
+		)
+	assert warp.n_procs == 4
+	plan_resources(workflow, [functional]*16,
+		template=template,
+		n_procs=2,
+		memory_budget=1000,
+		)
+	assert warp.n_procs == 2
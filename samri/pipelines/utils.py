@@ -186,6 +186,7 @@ TRANSFORM_PHASES = {
 def bids_data_selection(base, structural_match, functional_match, subjects, sessions,
 	verbose=False,
 	joint_conditions=True,
+	catalog=True,
 	):
 	"""
 	Creates a Pandas Dataframe descriptor from a BIDS datapath, optionally filtering out conditions.
@@ -207,6 +208,9 @@ def bids_data_selection(base, structural_match, functional_match, subjects, sess
 	sessions: list or bool
 		A list of session names which may be present in the 'sessions' column of the created Pandas DataFrame, 'df'.
 		False if user does not want to filter DataFrame by sessions.
+	catalog : bool, optional
+		Whether to query the incrementally updated file catalog kept in the user cache directory (see `samri.pipelines.catalog`), rather than crawl the directory with a new `BIDSLayout`.
+		If the catalog cannot be written, the directory is crawled instead.
 
 	Returns
 	-------
@@ -214,20 +218,29 @@ def bids_data_selection(base, structural_match, functional_match, subjects, sess
 	df : pandas.DataFrame
 		A Pandas DataFrame with information corresponding to the whitelisted BIDS identifiers and optionally filtered by subjects and/or sessions.
 	"""
-	validate = BIDSValidator()
 	if verbose:
+		validate = BIDSValidator()
 		for x in os.walk(base):
 			print(x[0])
 			if validate.is_bids(x[0]):
 				print("Is not BIDS-formatted.")
 			else:
 				print("Detected!")
-	#layout = BIDSLayout(base, validate=False, derivatives=True)
-	layout = BIDSLayout(base,validate=False)
-	try:
-		df = layout.as_data_frame()
-	except AttributeError:
-		df = layout.to_df()
+	df = None
+	if catalog:
+		import sqlite3
+		from samri.pipelines.catalog import catalog_df
+		try:
+			df = catalog_df(base)
+		except (OSError, sqlite3.Error):
+			pass
+	if df is None:
+		#layout = BIDSLayout(base, validate=False, derivatives=True)
+		layout = BIDSLayout(base,validate=False)
+		try:
+			df = layout.as_data_frame()
+		except AttributeError:
+			df = layout.to_df()
 
 	# Not crashing if the run field is not present
 	try:
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import numbers
+import os
+import threading
+import nibabel as nib
+import numpy as np
+from collections import OrderedDict
+from os import path
+
+from samri.report.cache import file_hash
+
+BACKGROUND_CACHE_DIR = path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'samri', 'backgrounds')
+# Maximal number of background slices kept in memory.
+BACKGROUND_CACHE_ENTRIES = 512
+
+_SLICES = OrderedDict()
+# Only the most recently used background volume is kept in memory, as it is typically shared by all slices of a figure series.
+_VOLUME = {}
+_LOCK = threading.RLock()
+
+def background_key(bg_image, cut_coord,
+	dimming=0.,
+	black_bg=False,
+	):
+	"""Return a key identifying a coronal background slice by the contents of the background image, by the cut coordinate, and by the parameters which determine its intensity range."""
+	parameters = [
+		file_hash(bg_image),
+		round(float(cut_coord), 6),
+		dimming,
+		bool(black_bg),
+		]
+	return hashlib.sha1(json.dumps(parameters).encode('utf-8')).hexdigest()
+
+def _background_volume(bg_image):
+	"""Return the background image reordered to a diagonal affine (as done by nilearn before drawing), as well as its finite value range."""
+	from nilearn.image import reorder_img
+
+	stat = os.stat(bg_image)
+	volume_key = (bg_image, stat.st_mtime_ns, stat.st_size)
+	with _LOCK:
+		if _VOLUME.get('key') != volume_key:
+			img = nib.load(bg_image)
+			img = nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+			img = reorder_img(img, resample='continuous')
+			data = np.asanyarray(img.dataobj)
+			_VOLUME.clear()
+			_VOLUME.update({
+				'key':volume_key,
+				'img':img,
+				'range':(float(np.nanmin(data)), float(np.nanmax(data))),
+				})
+		return _VOLUME['img'], _VOLUME['range']
+
+def _intensity_range(value_range, dimming, black_bg):
+	"""Return the display range of a background, as computed by `nilearn.plotting.plot_anat()` for the whole image."""
+	if not dimming:
+		return None, None
+	vmin, vmax = value_range
+	vmean = .5*(vmin + vmax)
+	ptp = .5*(vmax - vmin)
+	if black_bg:
+		if not isinstance(dimming, numbers.Number):
+			dimming = .8
+		vmax = vmean + (1 + dimming)*ptp
+	else:
+		if not isinstance(dimming, numbers.Number):
+			dimming = .6
+		vmin = .5*(2 - dimming)*vmean - (1 + dimming)*ptp
+	return vmin, vmax
+
+def _compute_slice(bg_image, cut_coord, dimming, black_bg):
+	img, value_range = _background_volume(bg_image)
+	vmin, vmax = _intensity_range(value_range, dimming, black_bg)
+	index = int(np.round(np.linalg.inv(img.affine).dot([0, cut_coord, 0, 1])[1]))
+	data = np.asanyarray(img.dataobj)
+	if index < 0 or index >= data.shape[1]:
+		# Cuts outside of the image are left to nilearn, which draws nothing for them.
+		return img, vmin, vmax
+	# A slab of three slices ensures the cut is rounded to the same slice as in the full image.
+	start = max(index-1, 0)
+	affine = img.affine.copy()
+	affine[:3,3] = img.affine.dot([0, start, 0, 1])[:3]
+	slab = np.array(data[:, start:index+2], copy=True)
+	return nib.Nifti1Image(slab, affine), vmin, vmax
+
+def background_slice(bg_image, cut_coord,
+	dimming=0.,
+	black_bg=False,
+	cache=False,
+	):
+	"""
+	Return the part of a background image needed to draw one coronal slice, together with the intensity range which `nilearn.plotting.plot_anat()` would compute for the whole image.
+	Slices are kept in memory, and optionally on disk, so that figure series over many overlays only resample and draw the background once per cut.
+
+	Parameters
+	----------
+
+	bg_image : str
+		Path to a 3D NIfTI background image.
+	cut_coord : float
+		Coronal cut coordinate, in mm.
+	dimming : float or str, optional
+		Dimming factor, as accepted by the `dim` parameter of `nilearn.plotting.plot_anat()`.
+	black_bg : bool, optional
+		Whether the background will be drawn on black, which determines how it is dimmed.
+	cache : bool or str, optional
+		Whether to additionally store slices on disk, or path to the cache directory (by default `samri.plotting.backgrounds.BACKGROUND_CACHE_DIR`).
+		Entries are keyed by the content of the background image, and are thus never stale.
+
+	Returns
+	-------
+
+	img : nibabel.nifti1.Nifti1Image
+		Slab of the reordered background image, containing the cut.
+	vmin : float or None
+	vmax : float or None
+	"""
+
+	bg_image = path.abspath(path.expanduser(bg_image))
+	key = background_key(bg_image, cut_coord, dimming=dimming, black_bg=black_bg)
+	with _LOCK:
+		try:
+			entry = _SLICES.pop(key)
+		except KeyError:
+			pass
+		else:
+			_SLICES[key] = entry
+			return entry
+
+	entry = None
+	if cache:
+		if cache is True:
+			cache = BACKGROUND_CACHE_DIR
+		cache = path.abspath(path.expanduser(cache))
+		os.makedirs(cache, exist_ok=True)
+		cache_file = path.join(cache, key+'.npz')
+		try:
+			with np.load(cache_file) as stored:
+				vmin, vmax = [None if np.isnan(i) else float(i) for i in stored['range']]
+				entry = (nib.Nifti1Image(stored['data'], stored['affine']), vmin, vmax)
+		except (IOError, ValueError, KeyError):
+			pass
+	if entry is None:
+		entry = _compute_slice(bg_image, cut_coord, dimming, black_bg)
+		if cache:
+			img, vmin, vmax = entry
+			temp_file = '{}.{}.tmp.npz'.format(cache_file[:-len('.npz')], os.getpid())
+			np.savez(temp_file,
+				data=np.asanyarray(img.dataobj),
+				affine=img.affine,
+				range=[np.nan if i is None else i for i in (vmin, vmax)],
+				)
+			os.replace(temp_file, cache_file)
+
+	with _LOCK:
+		_SLICES[key] = entry
+		while len(_SLICES) > BACKGROUND_CACHE_ENTRIES:
+			_SLICES.popitem(last=False)
+	return entry
+
+def plot_background(bg_image, cut_coord, axes,
+	dimming=0.,
+	black_bg=False,
+	cmap='binary',
+	cache=False,
+	**kwargs
+	):
+	"""
+	Draw a coronal background slice via `nilearn.plotting.plot_anat()`, from the slice cache of `samri.plotting.backgrounds.background_slice()`.
+	The resulting display is equivalent to plotting the whole background image, and overlays and contours can be added to it as usual.
+
+	Parameters
+	----------
+
+	bg_image : str
+		Path to a 3D NIfTI background image.
+	cut_coord : float
+		Coronal cut coordinate, in mm.
+	axes : matplotlib.axes.Axes
+		Axes in which to draw the slice.
+	dimming : float or str, optional
+		Dimming factor, as accepted by the `dim` parameter of `nilearn.plotting.plot_anat()`.
+	black_bg : bool, optional
+		Whether to draw the background on black.
+	cmap : str, optional
+		Colormap with which to draw the background.
+	cache : bool or str, optional
+		Whether to additionally store slices on disk, or path to the cache directory.
+	**kwargs
+		Further keyword arguments passed to `nilearn.plotting.plot_anat()`.
+
+	Returns
+	-------
+
+	nilearn.plotting.displays.YSlicer
+	"""
+
+	img, vmin, vmax = background_slice(bg_image, cut_coord,
+		dimming=dimming,
+		black_bg=black_bg,
+		cache=cache,
+		)
+	import nilearn.plotting
+	return nilearn.plotting.plot_anat(img,
+		axes=axes,
+		display_mode='y',
+		cut_coords=[cut_coord],
+		black_bg=black_bg,
+		dim=0,
+		vmin=vmin,
+		vmax=vmax,
+		cmap=cmap,
+		**kwargs
+		)
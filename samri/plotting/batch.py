@@ -0,0 +1,88 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+# Data shared by all renders of a batch (e.g. loaded template images), as returned by the batch initializer.
+_STATE = {}
+
+def worker_state():
+	"""Return the dictionary returned by the initializer of the currently running `samri.plotting.batch.render_batch()` call."""
+	return _STATE
+
+def _init_worker(state=None):
+	import matplotlib.pyplot as plt
+	plt.switch_backend('Agg')
+	if state is not None:
+		_STATE.clear()
+		_STATE.update(state)
+
+def _render(render, job):
+	import matplotlib.pyplot as plt
+	try:
+		return render(*job)
+	finally:
+		plt.close('all')
+
+def render_batch(render, jobs,
+	initializer=None,
+	initargs=(),
+	n_jobs=False,
+	n_jobs_percentage=0.8,
+	):
+	"""
+	Render a batch of figures in a pool of headless (matplotlib 'Agg' backend) worker processes, and return the render return values in job order.
+	The initializer is run only once, in the calling process, and its return value is available to all renders via `samri.plotting.batch.worker_state()`.
+	Where processes are forked, workers share the initialized data (e.g. a loaded template) with the calling process, rather than receiving copies of it.
+
+	Parameters
+	----------
+
+	render : callable
+		Function which draws and saves one figure; it needs to be picklable (i.e. defined at module level).
+		Figures are closed after each call.
+	jobs : list of tuple
+		Positional arguments of each `render` call.
+	initializer : callable, optional
+		Function returning a dictionary of data shared by all renders.
+	initargs : tuple, optional
+		Positional arguments of `initializer`.
+	n_jobs : int, optional
+		Number of worker processes, defaults to a fraction of the CPU count given by `n_jobs_percentage`.
+		If 1, figures are rendered in the calling process.
+	n_jobs_percentage : float, optional
+		Fraction of the CPU count to use as number of workers, if `n_jobs` is not specified.
+
+	Returns
+	-------
+
+	list
+		Return values of `render`, in the order of `jobs`.
+	"""
+
+	jobs = list(jobs)
+	if not jobs:
+		return []
+	state = initializer(*initargs) if initializer else {}
+	if not n_jobs:
+		n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
+	n_jobs = min(n_jobs, len(jobs))
+
+	if n_jobs == 1:
+		_STATE.clear()
+		_STATE.update(state)
+		try:
+			return [_render(render, job) for job in jobs]
+		finally:
+			_STATE.clear()
+
+	if 'fork' in mp.get_all_start_methods():
+		_STATE.clear()
+		_STATE.update(state)
+		executor = ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('fork'), initializer=_init_worker)
+	else:
+		executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,))
+	try:
+		futures = [executor.submit(_render, render, job) for job in jobs]
+		return [future.result() for future in futures]
+	finally:
+		executor.shutdown(wait=True)
+		_STATE.clear()
@@ -0,0 +1,206 @@
+import atexit
+import io
+import os
+import re
+import subprocess
+import threading
+from multiprocessing.connection import Connection
+from os import path
+
+BLENDER_SCRIPT = path.join(path.dirname(path.abspath(__file__)),'blender_visualization.py')
+# Seconds to wait for Blender to load the template, and to render one job.
+BLENDER_START_TIMEOUT = 300
+BLENDER_RENDER_TIMEOUT = 1800
+
+_SERVERS = {}
+_LOCK = threading.Lock()
+
+def blender_commands():
+	"""Return the Blender commands available on the PATH, which may be suffixed with a version string, from the most recent to the oldest."""
+	command_paths = list(set(os.getenv('PATH', '').split(':')))
+	blender_candidates = []
+	for command_path in command_paths:
+		try:
+			for available_command in os.listdir(command_path):
+				blender_candidate = re.match(r'^blender[-,0-9+\.]*$',available_command)
+				if blender_candidate:
+					blender_candidates.append(blender_candidate.string)
+		except (FileNotFoundError, NotADirectoryError):
+			pass
+	return sorted(set(blender_candidates), reverse=True)
+
+class BlenderRenderServer(object):
+	"""
+	Headless Blender process which loads the template mesh and sets up the scene once, and then renders feature meshes on request.
+	Jobs and rendered images are exchanged over a pair of pipes, so that no files are written to shared locations.
+
+	Parameters
+	----------
+
+	template_mesh : str
+		A path to a .obj file containing the template mesh.
+	commands : list of str, optional
+		Blender commands to try, in order; by default all Blender commands on the PATH (as returned by `samri.plotting.blender.blender_commands()`).
+	start_timeout : float, optional
+		Seconds to wait for Blender to set up the scene.
+	render_timeout : float, optional
+		Seconds to wait for a single render.
+
+	Examples
+	--------
+
+	>>> with BlenderRenderServer('/usr/share/mouse-brain-templates/ambmc2dsurqec_15micron_masked.obj') as server:
+	...	img = server.render(['/tmp/a_pos_mesh.obj'], ['#ff0000'])
+	"""
+
+	def __init__(self, template_mesh,
+		commands=None,
+		start_timeout=BLENDER_START_TIMEOUT,
+		render_timeout=BLENDER_RENDER_TIMEOUT,
+		):
+		self.template_mesh = path.abspath(path.expanduser(template_mesh))
+		self.commands = commands
+		self.start_timeout = start_timeout
+		self.render_timeout = render_timeout
+		self.process = None
+		self._jobs = None
+		self._results = None
+		self._lock = threading.Lock()
+
+	def alive(self):
+		"""Whether the Blender process is running."""
+		return self.process is not None and self.process.poll() is None
+
+	def start(self):
+		"""Start Blender, trying each available command from the most recent to the oldest, and wait until the template is loaded."""
+		if self.alive():
+			return
+		self.close()
+		commands = self.commands
+		if commands is None:
+			commands = blender_commands()
+		for command in commands:
+			job_read, job_write = os.pipe()
+			result_read, result_write = os.pipe()
+			cli = [command, '-b', '-P', BLENDER_SCRIPT, '--',
+				'--serve', str(job_read), str(result_write),
+				'-t', self.template_mesh,
+				]
+			try:
+				process = subprocess.Popen(cli,
+					pass_fds=(job_read, result_write),
+					stdin=subprocess.DEVNULL,
+					stdout=subprocess.DEVNULL,
+					)
+			except OSError:
+				for fd in (job_read, job_write, result_read, result_write):
+					os.close(fd)
+				continue
+			# Only the Blender process keeps its ends of the pipes open, so that we see EOF if it exits.
+			os.close(job_read)
+			os.close(result_write)
+			self.process = process
+			self._jobs = Connection(job_write, readable=False)
+			self._results = Connection(result_read, writable=False)
+			try:
+				if self._results.poll(self.start_timeout) and self._results.recv().get('ready'):
+					return
+			except (EOFError, OSError):
+				pass
+			self.close()
+		raise RuntimeError('Could not start a Blender render server for template `{}`. Tried the following commands: {}'.format(self.template_mesh, ', '.join(commands) or 'none found on the PATH'))
+
+	def render(self, stat_map_paths, stat_map_colors,
+		camera_location=None,
+		camera_rotation=None,
+		):
+		"""
+		Render feature meshes together with the template mesh.
+
+		Parameters
+		----------
+
+		stat_map_paths : list of str
+			Paths to .obj files containing the feature meshes.
+		stat_map_colors : list of str
+			Hex colors, one for each feature mesh.
+		camera_location : tuple, optional
+			Camera location, by default the coronal view of `samri.plotting.blender_visualization`.
+		camera_rotation : tuple, optional
+			Camera rotation in Euler angles (radians).
+
+		Returns
+		-------
+
+		numpy.ndarray
+			RGBA image, as read by `matplotlib.pyplot.imread()`.
+		"""
+		import matplotlib.pyplot as plt
+
+		if len(stat_map_paths) != len(stat_map_colors):
+			raise ValueError('The `stat_map_paths` and `stat_map_colors` parameters must be of equal length.')
+		job = {
+			'stat_map_paths':[path.abspath(path.expanduser(i)) for i in stat_map_paths],
+			'stat_map_colors':list(stat_map_colors),
+			'camera_location':camera_location,
+			'camera_rotation':camera_rotation,
+			}
+		with self._lock:
+			self.start()
+			try:
+				self._jobs.send(job)
+				if not self._results.poll(self.render_timeout):
+					raise RuntimeError('Blender did not finish rendering within {} seconds.'.format(self.render_timeout))
+				result = self._results.recv()
+			except (EOFError, OSError, RuntimeError):
+				# The process state is unknown, the next job starts a new one.
+				self.close()
+				raise
+		if 'error' in result:
+			raise RuntimeError('Blender could not render `{}`: {}'.format(', '.join(job['stat_map_paths']), result['error']))
+		return plt.imread(io.BytesIO(result['png']), format='png')
+
+	def close(self):
+		"""Ask Blender to exit, and terminate it if it does not."""
+		if self._jobs is not None:
+			try:
+				self._jobs.send(None)
+			except OSError:
+				pass
+			self._jobs.close()
+			self._jobs = None
+		if self._results is not None:
+			self._results.close()
+			self._results = None
+		if self.process is not None:
+			try:
+				self.process.wait(timeout=10)
+			except subprocess.TimeoutExpired:
+				self.process.kill()
+				self.process.wait()
+			self.process = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def render_server(template_mesh):
+	"""Return a persistent `samri.plotting.blender.BlenderRenderServer` for a template mesh, which is shared by all calls in this process and closed at exit."""
+	template_mesh = path.abspath(path.expanduser(template_mesh))
+	with _LOCK:
+		try:
+			server = _SERVERS[template_mesh]
+		except KeyError:
+			server = _SERVERS[template_mesh] = BlenderRenderServer(template_mesh)
+	return server
+
+@atexit.register
+def _close_servers():
+	with _LOCK:
+		servers = list(_SERVERS.values())
+		_SERVERS.clear()
+	for server in servers:
+		server.close()
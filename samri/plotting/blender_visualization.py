@@ -24,6 +24,7 @@ parser.add_argument('--output_path','-o',type=str,default="")
 parser.add_argument('--stat_map_path','-s',action='append',type=str)
 parser.add_argument('--stat_map_color','-c',action='append',type=str)#Should be a list
 parser.add_argument('--filename','-n',type=str)
+parser.add_argument('--serve',nargs=2,type=int,metavar=('JOB_FD','RESULT_FD'),help='Keep the scene loaded and render jobs received over these pipe file descriptors, see `samri.plotting.blender`.')
 
 
 args = parser.parse_args(argv)
@@ -45,10 +46,15 @@ def hex_to_rgb(value):
 
 
 color=[]
-for c in args.stat_map_color:
+for c in args.stat_map_color or []:
 	print(c)
 	color.append(hex_to_rgb(c))
 
+# Rotation of the template and feature meshes, and default camera pose.
+MESH_ROTATION = (1.8326, 2.96706, 0.698132)
+CAMERA_LOCATION = (0,-25,0)
+CAMERA_ROTATION = (1.5708,-0,0)
+
 
 ##Function to deselect all objects
 def deselect():
@@ -79,15 +85,6 @@ Atlas = bpy.context.selected_objects[0]
 Atlas.data.use_auto_smooth = False
 
 
-#Import Gene data
-gene_data = []
-for stat_map in args.stat_map_path:
-	bpy.ops.import_scene.obj(filepath= stat_map)
-	importedMesh=bpy.context.selected_objects[0]
-	importedMesh.data.use_auto_smooth = False
-
-	gene_data.append(bpy.context.selected_objects[0])
-
 #Increase world brightness0
 bpy.data.worlds["World"].node_tree.nodes["Background"].inputs[0].default_value = (1, 1, 1, 1)
 
@@ -188,21 +185,6 @@ MatAtlas.node_tree.nodes["Principled BSDF"].inputs['Alpha'].default_value = 0.5
 # matNodes.links.new(outNode.inputs[0],GlassNode.outputs[0])
 
 
-#Prepare Materials for up to 2 meshes of the statistical maps
-MatGenes = []
-MatGenes.append(bpy.data.materials.new(name="gene_material_0"))
-MatGenes.append(bpy.data.materials.new(name="gene_material_1"))
-MatGenes.append(bpy.data.materials.new(name="gene_material_2"))
-
-i = 0
-for col in color:
-	MatGenes[i].use_nodes=True
-	MatGenes[i].node_tree.nodes["Principled BSDF"].inputs['Base Color'].default_value  = (col[0],col[1],col[2],1)
-	MatGenes[i].node_tree.nodes["Principled BSDF"].inputs['Metallic'].default_value = 1
-	MatGenes[i].node_tree.nodes["Principled BSDF"].inputs['Clearcoat'].default_value = 1
-
-	i = i+1
-
 #Apply colours
 if Atlas.data.materials:
 	# assign to 1st material slot
@@ -211,19 +193,41 @@ else:
 	# no slots
 	Atlas.data.materials.append(MatAtlas)
 
-i = 0
-for stat_map in args.stat_map_path:
-	if gene_data[i].data.materials:
-
-		# assign to 1st material slot
-		gene_data[i].data.materials[0] = MatGenes[i]
-
-	else:
-		# no slots
-		gene_data[i].data.materials.append(MatGenes[i])
-
-	i += 1
-
+#Import Gene data, and prepare one material per mesh of the statistical maps
+def add_features(stat_map_paths, colors):
+	gene_data = []
+	MatGenes = []
+	for i, (stat_map, col) in enumerate(zip(stat_map_paths, colors)):
+		deselect()
+		bpy.ops.import_scene.obj(filepath= stat_map)
+		importedMesh=bpy.context.selected_objects[0]
+		importedMesh.data.use_auto_smooth = False
+		gene_data.append(importedMesh)
+
+		MatGene = bpy.data.materials.new(name="gene_material_{}".format(i))
+		MatGene.use_nodes=True
+		MatGene.node_tree.nodes["Principled BSDF"].inputs['Base Color'].default_value  = (col[0],col[1],col[2],1)
+		MatGene.node_tree.nodes["Principled BSDF"].inputs['Metallic'].default_value = 1
+		MatGene.node_tree.nodes["Principled BSDF"].inputs['Clearcoat'].default_value = 1
+		MatGenes.append(MatGene)
+
+		if importedMesh.data.materials:
+			# assign to 1st material slot
+			importedMesh.data.materials[0] = MatGene
+		else:
+			# no slots
+			importedMesh.data.materials.append(MatGene)
+	return gene_data, MatGenes
+
+#Remove imported Gene data and their materials, leaving the template scene as it was
+def remove_features(gene_data, MatGenes):
+	for Gene in gene_data:
+		mesh = Gene.data
+		bpy.data.objects.remove(Gene, do_unlink=True)
+		if mesh.users == 0:
+			bpy.data.meshes.remove(mesh)
+	for MatGene in MatGenes:
+		bpy.data.materials.remove(MatGene)
 
 #Try to rotate camera around the brain and render different angles.
 
@@ -238,9 +242,6 @@ bpy.data.scenes["Scene"].camera = Camera
 #bpy.data.scenes["Scene"].render.filepath = path + "/Pic1"
 #bpy.ops.render.render( write_still=True )
 
-Atlas.select_set(True)
-for Gene in gene_data:
-	Gene.select_set(True)
 #bpy.ops.transform.rotate(value=1.21921, axis=(-0.00457997, 0.716912, -0.697148), constraint_axis=(False, False, False), constraint_orientation='GLOBAL', mirror=False, proportional='DISABLED', proportional_edit_falloff='SMOOTH', proportional_size=1)
 
 
@@ -283,7 +284,7 @@ def take_pic_Loc(file_name,loc):
 	bpy.ops.render.render( write_still=True )
 
 #render and save image
-def take_pic(file_name):
+def take_pic(file_name, directory=path):
 	deselect()
 	Camera.select_set(True)
 	#bpy.ops.transform.rotate(value=-3.14, constraint_axis=(True, False, False), constraint_orientation='LOCAL', mirror=False, proportional='DISABLED', proportional_edit_falloff='SMOOTH', proportional_size=1)
@@ -304,31 +305,69 @@ def take_pic(file_name):
 	bpy.context.scene.render.resolution_y = 5250
 	bpy.context.scene.render.resolution_percentage = 50
 
-	bpy.data.scenes["Scene"].render.filepath = path + "/" + file_name
+	bpy.data.scenes["Scene"].render.filepath = directory + "/" + file_name
 	bpy.ops.render.render( write_still=True )
 
 
 #Rotate mesh to view
-deselect()
-Atlas.select_set(True)
-for Gene in gene_data:
-	Gene.select_set(True)
-
-Atlas.rotation_euler[0] = 1.8326
-Atlas.rotation_euler[1] = 2.96706
-Atlas.rotation_euler[2] = 0.698132
-
-for Gene in gene_data:
-	Gene.rotation_euler[0] = 1.8326
-	Gene.rotation_euler[1] = 2.96706
-	Gene.rotation_euler[2] = 0.698132
-
-Camera.location = (0,-25,0)
-Camera.rotation_euler[0] = 1.5708
-Camera.rotation_euler[1] = -0
-Camera.rotation_euler[2] = 0
-Camera.scale[0]= 1
-Camera.scale[1]= 1
-Camera.scale[2]= 1
-
-take_pic(args.filename)
+def pose(gene_data, camera_location=CAMERA_LOCATION, camera_rotation=CAMERA_ROTATION):
+	deselect()
+	Atlas.select_set(True)
+	for Gene in gene_data:
+		Gene.select_set(True)
+
+	Atlas.rotation_euler = MESH_ROTATION
+	for Gene in gene_data:
+		Gene.rotation_euler = MESH_ROTATION
+
+	Camera.location = camera_location
+	Camera.rotation_euler = camera_rotation
+	Camera.scale[0]= 1
+	Camera.scale[1]= 1
+	Camera.scale[2]= 1
+
+## Render jobs sent by `samri.plotting.blender.BlenderRenderServer` for as long as the job pipe is open.
+## Each job is a dictionary with the feature mesh paths, their hex colors, and optionally the camera pose, and is answered with the PNG data.
+def serve(job_fd, result_fd):
+	import shutil
+	import tempfile
+	from multiprocessing.connection import Connection
+
+	jobs = Connection(job_fd, writable=False)
+	results = Connection(result_fd, readable=False)
+	render_dir = tempfile.mkdtemp(prefix='samri_blender_')
+	results.send({'ready':True})
+	try:
+		while True:
+			try:
+				job = jobs.recv()
+			except EOFError:
+				break
+			if job is None:
+				break
+			gene_data, MatGenes = [], []
+			try:
+				gene_data, MatGenes = add_features(job['stat_map_paths'], [hex_to_rgb(c) for c in job['stat_map_colors']])
+				pose(gene_data,
+					camera_location=job.get('camera_location') or CAMERA_LOCATION,
+					camera_rotation=job.get('camera_rotation') or CAMERA_ROTATION,
+					)
+				take_pic('render.png', directory=render_dir)
+				render_path = os.path.join(render_dir, 'render.png')
+				with open(render_path, 'rb') as render_file:
+					png = render_file.read()
+				os.remove(render_path)
+				results.send({'png':png})
+			except Exception as e:
+				results.send({'error':'{}: {}'.format(type(e).__name__, e)})
+			finally:
+				remove_features(gene_data, MatGenes)
+	finally:
+		shutil.rmtree(render_dir, ignore_errors=True)
+
+if args.serve:
+	serve(*args.serve)
+else:
+	gene_data, MatGenes = add_features(args.stat_map_path, color)
+	pose(gene_data)
+	take_pic(args.filename)
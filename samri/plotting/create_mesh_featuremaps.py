@@ -1,13 +1,20 @@
 import sys
 from glob import glob
-import skimage
-from skimage import measure
+import hashlib
+import json
 import nibabel
 import numpy
 import os
+import struct
+import tempfile
 from math import floor
 import argparse
 
+from samri.report.cache import file_hash
+
+MESH_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'samri', 'meshes')
+MESH_FORMATS = ('obj', 'ply', 'glb')
+
 def f(i, j, k, affine):
 	"""
 	Returns affine transformed coordinates (i,j,k) -> (x,y,z) Use to set correct coordinates and size for the mesh.
@@ -30,10 +37,30 @@ def f(i, j, k, affine):
 	abc = affine[:3, 3]
 	return M.dot([i, j, k]) + abc
 
+def apply_affine(verts, affine):
+	"""
+	Return affine transformed coordinates of all vertices, computed as one matrix multiplication.
+
+	Parameters
+	-----------
+	verts : array
+		Nx3 array of voxel coordinates.
+	affine : array
+		4x4 matrix containing affine transformation information of Nifti-Image.
+
+	Returns
+	--------
+	array
+		Nx3 array of affine transformed coordinates.
+	"""
+
+	return numpy.asarray(verts).dot(affine[:3, :3].T) + affine[:3, 3]
+
 #Writes an .obj file for the output of marching cube algorithm. Specify affine if needed in mesh. One = True for faces indexing starting at 1 as opposed to 0. Necessary for Blender/SurfIce
 def write_obj(name,verts,faces,normals,values,affine=None,one=False):
 	"""
 	Write a .obj file for the output of marching cube algorithm.
+	All lines of each element type are formatted in bulk.
 
 	Parameters
 	-----------
@@ -52,24 +79,153 @@ def write_obj(name,verts,faces,normals,values,affine=None,one=False):
 
 	"""
 	if (one) : faces=faces+1
-	thefile = open(name,'w')
 	if affine is not None:
-		for item in verts:
-			transformed = f(item[0],item[1],item[2],affine)
-			thefile.write("v {0} {1} {2}\n".format(transformed[0],transformed[1],transformed[2]))
-	else :
-		for item in verts:
-			thefile.write("v {0} {1} {2}\n".format(item[0],item[1],item[2]))
-	for item in normals:
-		thefile.write("vn {0} {1} {2}\n".format(item[0],item[1],item[2]))
-	for item in faces:
-		thefile.write("f {0}//{0} {1}//{1} {2}//{2}\n".format(item[0],item[1],item[2]))
-	thefile.close()
+		verts = apply_affine(verts, affine)
+	with open(name,'w') as thefile:
+		numpy.savetxt(thefile, verts, fmt='v %.9g %.9g %.9g')
+		numpy.savetxt(thefile, normals, fmt='vn %.9g %.9g %.9g')
+		numpy.savetxt(thefile, numpy.repeat(faces, 2, axis=1), fmt='f %d//%d %d//%d %d//%d')
+
+def write_ply(name,verts,faces,normals,values=None,affine=None):
+	"""
+	Write a binary (little endian) .ply file for the output of marching cube algorithm.
+
+	Parameters
+	-----------
+	name : str
+		Output file name.
+	verts : array
+		Spatial coordinates for vertices as returned by skimage.measure.marching_cubes().
+	faces : array
+		List of faces, referencing indices of verts as returned by skimage.measure.marching_cubes().
+	normals : array
+		Normal direction of each vertex as returned by skimage.measure.marching_cubes().
+	values : array, optional
+		Unused, accepted for signature compatibility with `write_obj()`.
+	affine : array,optional
+		If given, vertices coordinates are affine transformed to create mesh with correct origin and size.
+
+	"""
+	if affine is not None:
+		verts = apply_affine(verts, affine)
+	vertex_data = numpy.empty(len(verts), dtype=[('position', '<f4', 3), ('normal', '<f4', 3)])
+	vertex_data['position'] = verts
+	vertex_data['normal'] = normals
+	face_data = numpy.empty(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+	face_data['count'] = 3
+	face_data['indices'] = faces
+	header = '\n'.join([
+		'ply',
+		'format binary_little_endian 1.0',
+		'element vertex {}'.format(len(verts)),
+		'property float x',
+		'property float y',
+		'property float z',
+		'property float nx',
+		'property float ny',
+		'property float nz',
+		'element face {}'.format(len(faces)),
+		'property list uchar int vertex_indices',
+		'end_header',
+		])+'\n'
+	with open(name,'wb') as thefile:
+		thefile.write(header.encode('ascii'))
+		thefile.write(vertex_data.tobytes())
+		thefile.write(face_data.tobytes())
+
+def write_glb(name,verts,faces,normals,values=None,affine=None):
+	"""
+	Write a binary glTF (.glb) file for the output of marching cube algorithm.
+
+	Parameters
+	-----------
+	name : str
+		Output file name.
+	verts : array
+		Spatial coordinates for vertices as returned by skimage.measure.marching_cubes().
+	faces : array
+		List of faces, referencing indices of verts as returned by skimage.measure.marching_cubes().
+	normals : array
+		Normal direction of each vertex as returned by skimage.measure.marching_cubes().
+	values : array, optional
+		Unused, accepted for signature compatibility with `write_obj()`.
+	affine : array,optional
+		If given, vertices coordinates are affine transformed to create mesh with correct origin and size.
+
+	"""
+	if affine is not None:
+		verts = apply_affine(verts, affine)
+	positions = numpy.ascontiguousarray(verts, dtype='<f4')
+	normals = numpy.ascontiguousarray(normals, dtype='<f4')
+	indices = numpy.ascontiguousarray(faces, dtype='<u4')
+	buffers = [positions.tobytes(), normals.tobytes(), indices.tobytes()]
+	offsets = numpy.cumsum([0] + [len(i) for i in buffers])
+	gltf = {
+		'asset':{'version':'2.0', 'generator':'SAMRI'},
+		'scene':0,
+		'scenes':[{'nodes':[0]}],
+		'nodes':[{'mesh':0}],
+		'meshes':[{'primitives':[{'attributes':{'POSITION':0, 'NORMAL':1}, 'indices':2}]}],
+		'buffers':[{'byteLength':int(offsets[-1])}],
+		'bufferViews':[
+			{'buffer':0, 'byteOffset':int(offsets[0]), 'byteLength':len(buffers[0]), 'target':34962},
+			{'buffer':0, 'byteOffset':int(offsets[1]), 'byteLength':len(buffers[1]), 'target':34962},
+			{'buffer':0, 'byteOffset':int(offsets[2]), 'byteLength':len(buffers[2]), 'target':34963},
+			],
+		'accessors':[
+			{'bufferView':0, 'componentType':5126, 'count':len(positions), 'type':'VEC3',
+				'min':positions.min(axis=0).tolist() if len(positions) else [0,0,0],
+				'max':positions.max(axis=0).tolist() if len(positions) else [0,0,0],
+				},
+			{'bufferView':1, 'componentType':5126, 'count':len(normals), 'type':'VEC3'},
+			{'bufferView':2, 'componentType':5125, 'count':indices.size, 'type':'SCALAR'},
+			],
+		}
+	json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+	json_chunk += b' '*(-len(json_chunk) % 4)
+	bin_chunk = b''.join(buffers)
+	bin_chunk += b'\x00'*(-len(bin_chunk) % 4)
+	length = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+	with open(name,'wb') as thefile:
+		thefile.write(struct.pack('<4sII', b'glTF', 2, length))
+		thefile.write(struct.pack('<I4s', len(json_chunk), b'JSON'))
+		thefile.write(json_chunk)
+		thefile.write(struct.pack('<I4s', len(bin_chunk), b'BIN\x00'))
+		thefile.write(bin_chunk)
+
+def mesh_key(stat_map, threshold, sign,
+	one=True,
+	):
+	"""Return a key identifying the mesh of a statistical map by the content of the map, by the iso-surface threshold, by the sign of the cluster ('pos' or 'neg'), and by the face indexing convention."""
+	parameters = [
+		file_hash(stat_map),
+		float(threshold),
+		sign,
+		bool(one),
+		]
+	return hashlib.sha1(json.dumps(parameters).encode('utf-8')).hexdigest()
+
+def _write_mesh(output_path, img_data, threshold, affine, file_format, one):
+	from skimage import measure
+
+	#run marching cube
+	verts, faces, normals, values = measure.marching_cubes(img_data,threshold)
+	# Write via a temporary file, so that concurrent readers of the cache never see a partial mesh.
+	temp_path = '{}.{}.tmp'.format(output_path, os.getpid())
+	if file_format == 'obj':
+		write_obj(temp_path,verts,faces,normals,values,affine=affine,one=one)
+	elif file_format == 'ply':
+		write_ply(temp_path,verts,faces,normals,values,affine=affine)
+	else:
+		write_glb(temp_path,verts,faces,normals,values,affine=affine)
+	os.replace(temp_path, output_path)
 
 def create_mesh(stat_map,threshold,
 	one=True,
 	positive_only=False,
-	negative_only=False
+	negative_only=False,
+	file_format='obj',
+	cache=False,
 	):
 	"""
 	Runs Marching Cube algorithm for iso-surface extraction of 3D Volume data at a given threshold.
@@ -88,16 +244,48 @@ def create_mesh(stat_map,threshold,
 		for a positive cluster and one for a negative cluster, using -threshold as iso-surface level.
 	negative_only: bool, optional
 		Create Mesh only for negative cluster.
+	file_format: {'obj', 'ply', 'glb'}, optional
+		Mesh file format; 'ply' and 'glb' files are binary.
+	cache: bool or str, optional
+		Whether to store meshes in a persistent cache, or path to the cache directory (by default `samri.plotting.create_mesh_featuremaps.MESH_CACHE_DIR`).
+		Meshes are keyed via `mesh_key()`, and cached meshes are returned without running the marching cubes algorithm.
+		If false, meshes are written to the temporary directory, and are to be deleted by the caller.
 
 	Returns
 	--------
 	output_path: str
-		path to .obj file
+		path to mesh file
 	output_path_neg: str or none
-		path to .obj file generated from the negative cluster. None if no .obj file is generated.
+		path to mesh file generated from the negative cluster. None if no mesh file is generated.
 
 	"""
+	if file_format not in MESH_FORMATS:
+		raise ValueError("The `file_format` parameter must be one of: "+", ".join(MESH_FORMATS)+".")
 	##TODO: stat_map also possibly already a Nifit1Image, adjust
+	stat_map = os.path.abspath(os.path.expanduser(stat_map))
+	if cache:
+		if cache is True:
+			cache = MESH_CACHE_DIR
+		path = os.path.abspath(os.path.expanduser(cache))
+		os.makedirs(path, exist_ok=True)
+	else:
+		path = tempfile.gettempdir()
+
+	def mesh_path(sign):
+		return os.path.join(path, '{}_{}_mesh.{}'.format(mesh_key(stat_map, threshold, sign, one=one), sign, file_format))
+
+	# The meshes which a map yields are recorded, so that cached meshes are found without reading the map.
+	if cache:
+		manifest = os.path.join(path, hashlib.sha1(json.dumps([file_hash(stat_map), float(threshold), positive_only, negative_only, bool(one), file_format]).encode('utf-8')).hexdigest()+'.json')
+		try:
+			with open(manifest, 'r') as f:
+				signs = json.load(f)
+			output_paths = [mesh_path(i) if i else None for i in signs]
+			if all(os.path.isfile(i) for i in output_paths if i):
+				return tuple(output_paths)
+		except (IOError, ValueError):
+			pass
+
 	img= nibabel.load(stat_map)
 	img_data = img.get_fdata()
 	if numpy.max(numpy.isinf(img_data)):
@@ -111,30 +299,34 @@ def create_mesh(stat_map,threshold,
 	if (numpy.max(img_data)<= 0) or negative_only:
 		img_data = numpy.absolute(img_data)
 		neg = True
-	#run marching cube
-	verts, faces, normals, values = measure.marching_cubes(img_data,threshold)
-
-	#save mesh as .obj
-	filename_prefix = hash(str(verts)) + hash(str(faces)) + hash(str(normals)) + hash(str(values))
-	filename_prefix = str(abs(filename_prefix))
-
-	path = '/tmp/'
-	output_file = filename_prefix + '_pos_mesh.obj'
-	if neg: output_file = filename_prefix + '_neg_mesh.obj'
-	output_path = os.path.join(path,output_file)
-	write_obj(output_path,verts,faces,normals,values,affine = img.affine,one=one)
 
+	signs = ['neg' if neg else 'pos']
 	#create mesh for negative clusters if present
 	if numpy.min(img_data) < 0 and positive_only == False and neg == False:
-		img_data[img_data > 0] = 0
-		img_data = numpy.absolute(img_data)
-		verts, faces, normals, values = measure.marching_cubes(img_data,threshold)
-		output_file_neg = filename_prefix + "neg_mesh.obj"
-		output_path_neg = os.path.join(path,output_file_neg)
-		write_obj(output_path_neg,verts,faces,normals,values,affine = img.affine,one=one)
+		signs.append('neg')
 	else:
-		output_path_neg = None
+		signs.append(None)
+
+	output_paths = []
+	for ix, sign in enumerate(signs):
+		if sign is None:
+			output_paths.append(None)
+			continue
+		output_path = mesh_path(sign)
+		if not (cache and os.path.isfile(output_path)):
+			if ix == 1:
+				img_data[img_data > 0] = 0
+				img_data = numpy.absolute(img_data)
+			_write_mesh(output_path, img_data, threshold, img.affine, file_format, one)
+		output_paths.append(output_path)
+
+	if cache:
+		temp_manifest = '{}.{}.tmp'.format(manifest, os.getpid())
+		with open(temp_manifest, 'w') as f:
+			json.dump(signs, f)
+		os.replace(temp_manifest, manifest)
 
+	output_path,output_path_neg = output_paths
 	return output_path,output_path_neg
 
 
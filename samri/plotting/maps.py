@@ -6,7 +6,6 @@ from os import path
 import subprocess
 import sys
 import io
-import math
 import os
 import getpass
 
@@ -22,8 +21,13 @@ from matplotlib.text import Text
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 from samri.fetch.local import roi_from_atlaslabel
+from samri.plotting.backgrounds import plot_background
+from samri.plotting.batch import render_batch, worker_state
+from samri.plotting.blender import BlenderRenderServer, render_server
+from samri.plotting.overlays import overlay_summary, subthreshold_margins
 from samri.plotting.utilities import QUALITATIVE_COLORSET
 from samri.utilities import collapse
+from samri.report.extraction import roi_index
 from samri.report.roi import from_img_threshold
 
 COLORS_PLUS = plt.cm.autumn(np.linspace(0., 1, 128))
@@ -605,6 +609,8 @@ def _create_3Dplot(stat_maps,
 	vmin=None,
 	vmax=None,
 	cmap=None,
+	mesh_cache=True,
+	persistent_renderer=True,
 	):
 
 	"""Internal function to create the 3D plot.
@@ -622,23 +628,12 @@ def _create_3Dplot(stat_maps,
 		min for colorbar range.
 	vmax : int
 		max for colorbar range.
+	mesh_cache : bool or str, optional
+		Whether to keep the feature meshes in a persistent cache, or path to the cache directory, as accepted by `samri.plotting.create_mesh_featuremaps.create_mesh()`.
+	persistent_renderer : bool, optional
+		Whether to render via a Blender process which is kept running for subsequent plots with the same template (see `samri.plotting.blender.render_server()`), rather than via a process started for this plot only.
 	"""
 
-	# First we need to determine the blender command, as this might be suffixed with a version string, here goes:
-	import re
-	command_paths = os.getenv('PATH').split(':')
-	command_paths = list(set(command_paths))
-	blender_candidates = []
-	for command_path in command_paths:
-		try:
-			for available_command in os.listdir(command_path):
-				blender_candidate = re.match('^blender[-,0-9+\.]*$',available_command)
-				if blender_candidate:
-					blender_candidates.append(blender_candidate.string)
-		except FileNotFoundError:
-			pass
-	blender_candidates = sorted(blender_candidates, reverse=True)
-
 	# The following imports a lot of extra functions, and is only required for this function.
 	from samri.plotting.create_mesh_featuremaps import create_mesh
 
@@ -647,7 +642,7 @@ def _create_3Dplot(stat_maps,
 
 	obj_paths = []
 	for stat_map in stat_maps:
-		obj_paths.extend(create_mesh(stat_map,threshold,one=True,positive_only=positive_only,negative_only=negative_only))
+		obj_paths.extend(create_mesh(stat_map,threshold,one=True,positive_only=positive_only,negative_only=negative_only,cache=mesh_cache))
 
 	##Find matching color of used threshold in colorbar, needed to determine color for blender
 	if (positive_only or negative_only):
@@ -683,40 +678,23 @@ def _create_3Dplot(stat_maps,
 
 	col_plus = mcolors.to_hex([col_plus[0],col_plus[1],col_plus[2]])
 	col_minus = mcolors.to_hex([col_minus[0],col_minus[1],col_minus[2]])
-	script_loc = os.path.join(os.path.dirname(os.path.abspath(__file__)),'blender_visualization.py')
-	cli_arguments = ['-b', '-P', script_loc,'--','-t',template_mesh]
-
+	mesh_paths = []
+	mesh_colors = []
 	for path in obj_paths:
 		if not path is None:
-			cli_arguments.append('-s')
-			cli_arguments.append(path)
+			mesh_paths.append(path)
 			if "neg_mesh" in path:
-				cli_arguments.append('-c')
-				cli_arguments.append(col_minus)
+				mesh_colors.append(col_minus)
 			if "pos_mesh" in path:
-				cli_arguments.append('-c'),
-				cli_arguments.append(col_plus)
+				mesh_colors.append(col_plus)
 
-	s = ""
-	for path in obj_paths:
-		if not path is None:
-			s = os.path.splitext(os.path.basename(path))[0].split('_')[0]
-	filename_3Dplot = "3Dplot_{}.png".format(s)
-	cli_arguments.append('-n')
-	cli_arguments.append(filename_3Dplot)
-
-	# Python script cannot be run directly, need to start blender in background via command line, then run script.
-	# Further the blender executable may be versioned, and we cycle from the most recent to the oldest:
-	for blender_candidate in blender_candidates:
-		cli = [blender_candidate] + cli_arguments
-		try:
-			subprocess.run(cli,check=True,stdout=open(os.devnull,'wb'))
-			break
-		except:
-			pass
-
-	path_3Dplot = "/tmp/{}".format(filename_3Dplot)
-	mesh = plt.imread(path_3Dplot)
+	# Python script cannot be run directly, need to start blender in background via command line, which then renders via the script.
+	# Starting Blender and loading the template takes longer than most renders, so by default a persistent render server is reused.
+	if persistent_renderer:
+		mesh = render_server(template_mesh).render(mesh_paths, mesh_colors)
+	else:
+		with BlenderRenderServer(template_mesh) as server:
+			mesh = server.render(mesh_paths, mesh_colors)
 
 	#assure best fit into existing plot, trim img data matrix
 	dims = np.shape(mesh)
@@ -734,12 +712,11 @@ def _create_3Dplot(stat_maps,
 	mesh_trimmed = mesh[bbox[0][0] : bbox[0][1] ,bbox[1][0] : bbox[1][1] , :]
 
 	#delete temp files:
-	for path in obj_paths:
-		if not path is None:
-			if os.path.exists(path):
-				os.remove(path)
-	if os.path.exists(path_3Dplot):
-		os.remove(path_3Dplot)
+	if not mesh_cache:
+		for path in obj_paths:
+			if not path is None:
+				if os.path.exists(path):
+					os.remove(path)
 
 	return mesh_trimmed
 
@@ -829,6 +806,8 @@ def stat3D(stat_maps,
 	threshold_mesh=None,
 	template_mesh='/usr/share/mouse-brain-templates/ambmc2dsurqec_15micron_masked.obj',
 	contour_colors=['tab:pink'],
+	mesh_cache=True,
+	persistent_renderer=True,
 	):
 
 	"""Same plotting options as stat(), but with an additional 3D plot and a 2x2 layout of plots.
@@ -863,6 +842,12 @@ def stat3D(stat_maps,
 		if True, only negative values are displayed.
 	threshold_mesh : int, optional
 		Threshold given for iso-surface extraction of the feature map for 3D plotting. If none is given, same threshold is used as for the 2D plots.
+	mesh_cache : bool or str, optional
+		Whether to keep the feature meshes in a persistent cache (keyed by map content, threshold, and sign), or path to the cache directory.
+		Re-rendering a map at the same threshold then reuses its mesh, rather than re-running the marching cubes algorithm.
+	persistent_renderer : bool, optional
+		Whether to keep the Blender process, with the template mesh loaded, running for subsequent calls with the same `template_mesh`.
+		If False, Blender is started for this plot only.
 
 	Notes
 	-----
@@ -905,7 +890,7 @@ def stat3D(stat_maps,
 	if threshold_mesh is None:
 		threshold_mesh = threshold
 
-	plot_3D = _create_3Dplot(stat_maps,template_mesh=template_mesh,threshold=threshold_mesh,cmap=cmap,positive_only=positive_only,negative_only=negative_only,vmin=vmin,vmax=vmax)
+	plot_3D = _create_3Dplot(stat_maps,template_mesh=template_mesh,threshold=threshold_mesh,cmap=cmap,positive_only=positive_only,negative_only=negative_only,vmin=vmin,vmax=vmax,mesh_cache=mesh_cache,persistent_renderer=persistent_renderer)
 
 	fh = _plots_overlay(display,plot_3D)
 	if save_as:
@@ -947,13 +932,16 @@ def atlas_label(atlas,
 	Parameters
 	----------
 
+	anat : str or nibabel.nifti1.Nifti1Image, optional
+		Path to the anatomical background image, or the loaded image.
 	display_mode : {‘ortho’, ‘tiled’, ‘x’, ‘y’, ‘z’, ‘yx’, ‘xz’, ‘yz’}
 		Which slides to display, parameter passed to `nilearn.plotting.plt_roi()`
 	"""
 
 	from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 
-	anat = path.abspath(path.expanduser(anat))
+	if isinstance(anat, str):
+		anat = path.abspath(path.expanduser(anat))
 
 	if label_names:
 		roi = roi_from_atlaslabel(atlas, mapping=mapping, label_names=label_names, **kwargs)
@@ -1001,6 +989,7 @@ def atlas_label(atlas,
 
 def contour_slices(bg_image, file_template,
 	auto_figsize=False,
+	background_cache=False,
 	invert=False,
 	alpha=[0.9],
 	colors=['r','g','b'],
@@ -1032,6 +1021,9 @@ def contour_slices(bg_image, file_template,
 		To create multiple overlays, this template will iteratively be substituted with each of the substitution dictionaries in the `substitutions` parameter.
 	auto_figsize : boolean, optional
 		Whether to automatically determine the size of the figure.
+	background_cache : bool or str, optional
+		Whether to store the background slices on disk (in addition to memory), or path to the cache directory, as accepted by `samri.plotting.backgrounds.background_slice()`.
+		Background slices of 3D images are only resampled once per cut coordinate, and are reused across figures.
 	invert : boolean, optional
 		Whether to automatically invert data matrix values (useful if the image consists of negative values, e.g. when dealing with negative contrast agent CBV scans).
 	alpha : list, optional
@@ -1100,6 +1092,7 @@ def contour_slices(bg_image, file_template,
 
 	bg_image = path.abspath(path.expanduser(bg_image))
 	bg_img = nib.load(bg_image)
+	cached_background = bg_img.header['dim'][0] <= 3
 	if bg_img.header['dim'][0] > 3:
 		bg_data = bg_img.get_data()
 		ndim = 0
@@ -1121,38 +1114,24 @@ def contour_slices(bg_image, file_template,
 		filename = file_template.format(**substitution)
 		filename = path.abspath(path.expanduser(filename))
 		img = nib.load(filename)
-		data = img.get_data()
+		data_shape = img.shape
+		#we should only be looking at the percentile of the entire data matrix, rather than just the active slice
+		projection, image_levels = overlay_summary(filename,
+			percentiles=levels_percentile,
+			invert=invert,
+			)
+		levels.extend(image_levels)
+		if invert:
+			data = -img.get_data()
 		if img.header['dim'][0] > 3:
 			img = collapse(img)
 		if invert:
-			data = -data
 			img = nib.nifti1.Nifti1Image(data, img.affine, img.header)
-		#we should only be looking at the percentile of the entire data matrix, rather than just the active slice
-		for level_percentile in levels_percentile:
-			level = np.percentile(data,level_percentile)
-			levels.append(level)
 		slice_row = img.affine[1]
-		subthreshold_start_slices = 0
-		while True:
-			for i in np.arange(data.shape[1]):
-				my_slice = data[:,i,:]
-				if my_slice.max() < min(levels):
-					subthreshold_start_slices += 1
-				else:
-					break
-			break
-		subthreshold_end_slices = 0
-		while True:
-			for i in np.arange(data.shape[1])[::-1]:
-				my_slice = data[:,i,:]
-				if my_slice.max() < min(levels):
-					subthreshold_end_slices += 1
-				else:
-					break
-			break
+		subthreshold_start_slices, subthreshold_end_slices = subthreshold_margins(projection, min(levels))
 		slice_thickness = (slice_row[0]**2+slice_row[1]**2+slice_row[2]**2)**(1/2)
 		best_guess_negative = abs(min(slice_row[0:3])) > abs(max(slice_row[0:3]))
-		slices_number = data.shape[list(slice_row).index(max(slice_row))]
+		slices_number = data_shape[list(slice_row).index(max(slice_row))]
 		img_min_slice = slice_row[3] + subthreshold_start_slices*slice_thickness
 		img_max_slice = slice_row[3] + (slices_number-subthreshold_end_slices)*slice_thickness
 		bounds.extend([img_min_slice,img_max_slice])
@@ -1206,15 +1185,24 @@ def contour_slices(bg_image, file_template,
 		flat_axes = list(ax.flatten())
 		for ix, ax_i in enumerate(flat_axes):
 			try:
-				display = nilearn.plotting.plot_anat(bg_img,
-					axes=ax_i,
-					display_mode='y',
-					cut_coords=[cut_coords[ix]],
-					annotate=False,
-					black_bg=black_bg,
-					dim=dimming,
-					cmap=anatomical_cmap,
-					)
+				if cached_background:
+					display = plot_background(bg_image, cut_coords[ix], ax_i,
+						dimming=dimming,
+						black_bg=black_bg,
+						cmap=anatomical_cmap,
+						cache=background_cache,
+						annotate=False,
+						)
+				else:
+					display = nilearn.plotting.plot_anat(bg_img,
+						axes=ax_i,
+						display_mode='y',
+						cut_coords=[cut_coords[ix]],
+						annotate=False,
+						black_bg=black_bg,
+						dim=dimming,
+						cmap=anatomical_cmap,
+						)
 			except IndexError:
 				ax_i.axis('off')
 			else:
@@ -1260,6 +1248,21 @@ def contour_slices(bg_image, file_template,
 			)
 		plt.close()
 
+def _atlas_labels_state(atlas, template):
+	atlas = path.abspath(path.expanduser(atlas))
+	template = nib.load(path.abspath(path.expanduser(template)))
+	# The template is decoded once, and shared by all figures.
+	template = nib.Nifti1Image(np.asanyarray(template.dataobj), template.affine, template.header)
+	return {'index':roi_index(atlas), 'template':template}
+
+def _atlas_labels_figure(label_values, out_file, display_mode):
+	state = worker_state()
+	index = state['index']
+	roi = nib.Nifti1Image(index.mask(label_values), index.affine)
+	atlas_label(roi, anat=state['template'], display_mode=display_mode)
+	plt.savefig(out_file)
+	return out_file
+
 def atlas_labels(
 	atlas='/usr/share/mouse-brain-templates/dsurqec_40micron_labels.nii',
 	mapping='/usr/share/mouse-brain-templates/dsurqe_labels.csv',
@@ -1269,9 +1272,12 @@ def atlas_labels(
 	label_column_l='left label',
 	label_column_r='right label',
 	file_format='png',
+	n_jobs=False,
+	n_jobs_percentage=0.8,
 	):
 	"""
 	Plot individual images for all of the labels in an atlas.
+	The label masks are precomputed from a single pass over the atlas, and the figures are rendered in parallel via `samri.plotting.batch.render_batch()`.
 
 	Parameters
 	----------
@@ -1292,6 +1298,16 @@ def atlas_labels(
 		A name of a column present in the `mapping` file, which contains the integer which is used to denote the right lateralized structure in the `atlas` file.
 	file_format : {'png', 'pdf'}, optional
 		The format as which the image files should be saved.
+	n_jobs : int, optional
+		Number of figures to render in parallel, defaults to a fraction of the CPU count given by `n_jobs_percentage`.
+	n_jobs_percentage : float, optional
+		Fraction of the CPU count to use as number of parallel renders, if `n_jobs` is not specified.
+
+	Returns
+	-------
+
+	list
+		Paths of the written image files.
 	"""
 
 	user = getpass.getuser()
@@ -1306,23 +1322,32 @@ def atlas_labels(
 	else:
 		mapping_df = mapping
 
+	jobs = []
 	for index, row in mapping_df.iterrows():
 		structure = row[structure_column]
 		left_label = row[label_column_l]
 		right_label = row[label_column_r]
+		# Structures are matched as by `samri.fetch.local.roi_from_atlaslabel()`, i.e. including all structures containing the name.
+		matches = mapping_df[mapping_df[structure_column].str.contains(structure)]
+		left_values = matches[label_column_l].values.tolist()
+		right_values = matches[label_column_r].values.tolist()
 		if left_label == right_label:
 			structure_filename = structure.replace(" ", "_")
-			atlas_label(atlas, mapping=mapping, label_names=[structure], display_mode='ortho')
-			plt.savefig('{}/{}.{}'.format(target_dir,structure_filename,file_format))
+			jobs.append((left_values+right_values, '{}/{}.{}'.format(target_dir,structure_filename,file_format), 'ortho'))
 		else:
 			structure_filename = structure.replace(" ", "_")
 			structure_filename = structure.replace("/", "_")
 			structure_filename_l = '{}_l'.format(structure_filename)
-			atlas_label(atlas, mapping=mapping, label_names=[structure], laterality='left', display_mode='ortho')
-			plt.savefig('{}/{}.{}'.format(target_dir,structure_filename_l,file_format))
+			jobs.append((left_values, '{}/{}.{}'.format(target_dir,structure_filename_l,file_format), 'ortho'))
 			structure_filename_r = '{}_r'.format(structure_filename)
-			atlas_label(atlas, mapping=mapping, label_names=[structure], laterality='right', display_mode='ortho')
-			plt.savefig('{}/{}.{}'.format(target_dir,structure_filename_r,file_format))
+			jobs.append((right_values, '{}/{}.{}'.format(target_dir,structure_filename_r,file_format), 'ortho'))
+
+	return render_batch(_atlas_labels_figure, jobs,
+		initializer=_atlas_labels_state,
+		initargs=(atlas, template),
+		n_jobs=n_jobs,
+		n_jobs_percentage=n_jobs_percentage,
+		)
 
 def slices(heatmap_image,
 	bg_image='/usr/share/mouse-brain-templates/dsurqec_40micron_masked.nii',
@@ -1331,6 +1356,7 @@ def slices(heatmap_image,
 	heatmap_alpha=1.0,
 	contour_threshold=3,
 	auto_figsize=False,
+	background_cache=False,
 	invert=False,
 	contour_alpha=0.9,
 	contour_color='g',
@@ -1373,6 +1399,9 @@ def slices(heatmap_image,
 		Value at which to threshold the contour_image.
 	auto_figsize : boolean, optional
 		Whether to automatically determine the size of the figure.
+	background_cache : bool or str, optional
+		Whether to store the background slices on disk (in addition to memory), or path to the cache directory, as accepted by `samri.plotting.backgrounds.background_slice()`.
+		Background slices of 3D images are only resampled once per cut coordinate, and are reused across figures.
 	invert : boolean, optional
 		Whether to automatically invert data matrix values (useful if the image consists of negative values, e.g. when dealing with negative contrast agent CBV scans).
 	contour_alpha : float, optional
@@ -1436,13 +1465,15 @@ def slices(heatmap_image,
 
 	bg_image = path.abspath(path.expanduser(bg_image))
 	bg_img = nib.load(bg_image)
+	cached_background = bg_img.header['dim'][0] <= 3
 	if bg_img.header['dim'][0] > 3:
 		bg_img = collapse(bg_img)
 
 	slice_order_is_reversed = 0
 	heatmap_image = path.abspath(path.expanduser(heatmap_image))
 	heatmap_img = nib.load(heatmap_image)
-	heatmap_data = heatmap_img.get_data()
+	heatmap_shape = heatmap_img.shape
+	heatmap_projection, _ = overlay_summary(heatmap_image)
 	if heatmap_img.header['dim'][0] > 3:
 		img = collapse(heatmap_img)
 	if contour_image:
@@ -1456,27 +1487,12 @@ def slices(heatmap_image,
 
 	#we should only be looking at the percentile of the entire data matrix, rather than just the active slice
 	slice_row = heatmap_img.affine[1]
-	subthreshold_start_slices = 0
-	while True:
-		for i in np.arange(heatmap_data.shape[1]):
-			my_slice = heatmap_data[:,i,:]
-			if math.isnan(my_slice.max()) or my_slice.max() < heatmap_threshold:
-				subthreshold_start_slices += 1
-			else:
-				break
-		break
-	subthreshold_end_slices = 0
-	while True:
-		for i in np.arange(heatmap_data.shape[1])[::-1]:
-			my_slice = heatmap_data[:,i,:]
-			if math.isnan(my_slice.max()) or my_slice.max() < heatmap_threshold:
-				subthreshold_end_slices += 1
-			else:
-				break
-		break
+	subthreshold_start_slices, subthreshold_end_slices = subthreshold_margins(heatmap_projection, heatmap_threshold,
+		nan_subthreshold=True,
+		)
 	slice_thickness = (slice_row[0]**2+slice_row[1]**2+slice_row[2]**2)**(1/2)
 	best_guess_negative = abs(min(slice_row[0:3])) > abs(max(slice_row[0:3]))
-	slices_number = heatmap_data.shape[list(slice_row).index(max(slice_row))]
+	slices_number = heatmap_shape[list(slice_row).index(max(slice_row))]
 	skip_start = skip_start*slice_spacing/slice_thickness
 	skip_end = skip_end*slice_spacing/slice_thickness
 	img_min_slice = slice_row[3] + (subthreshold_start_slices+skip_start)*slice_thickness
@@ -1550,15 +1566,24 @@ def slices(heatmap_image,
 		vmax = 0
 	for ix, ax_i in enumerate(flat_axes):
 		try:
-			display = nilearn.plotting.plot_anat(bg_img,
-				axes=ax_i,
-				display_mode='y',
-				cut_coords=[cut_coords[ix]],
-				annotate=False,
-				black_bg=black_bg,
-				dim=dimming,
-				cmap=anatomical_cmap,
-				)
+			if cached_background:
+				display = plot_background(bg_image, cut_coords[ix], ax_i,
+					dimming=dimming,
+					black_bg=black_bg,
+					cmap=anatomical_cmap,
+					cache=background_cache,
+					annotate=False,
+					)
+			else:
+				display = nilearn.plotting.plot_anat(bg_img,
+					axes=ax_i,
+					display_mode='y',
+					cut_coords=[cut_coords[ix]],
+					annotate=False,
+					black_bg=black_bg,
+					dim=dimming,
+					cmap=anatomical_cmap,
+					)
 		except IndexError:
 			ax_i.axis('off')
 		else:
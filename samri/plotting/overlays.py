@@ -0,0 +1,107 @@
+import os
+import threading
+import nibabel as nib
+import numpy as np
+from collections import OrderedDict
+from os import path
+
+# Maximal number of overlay summaries kept in memory.
+OVERLAY_CACHE_ENTRIES = 256
+
+_SUMMARIES = OrderedDict()
+_LOCK = threading.Lock()
+
+def overlay_summary(img_path,
+	percentiles=(),
+	axis=1,
+	invert=False,
+	):
+	"""
+	Return the maximum projection of an overlay onto one axis, and percentiles of all its values, computed in a single pass over the data.
+	Summaries are memoized per file (identified by path, modification time and size), so that repeated renders of the same overlay do not read it again.
+
+	Parameters
+	----------
+
+	img_path : str
+		Path to a NIfTI file.
+	percentiles : list, optional
+		Percentiles (between 0 and 100) of all values to compute.
+		All percentiles are computed from one partial sort (via `numpy.percentile()`); as with `numpy.percentile()`, they are NaN if the data contains NaN values.
+	axis : int, optional
+		Axis onto which to project, all other axes (including time, for 4D images) are reduced.
+	invert : bool, optional
+		Whether to summarize the negated data.
+
+	Returns
+	-------
+
+	projection : numpy.ndarray
+		Maximum of each slice along `axis`; NaN for slices containing NaN values.
+	levels : list
+		Values at the requested percentiles.
+	"""
+
+	img_path = path.abspath(path.expanduser(img_path))
+	stat = os.stat(img_path)
+	key = (img_path, stat.st_mtime_ns, stat.st_size, tuple(percentiles), axis, bool(invert))
+	with _LOCK:
+		try:
+			summary = _SUMMARIES.pop(key)
+		except KeyError:
+			pass
+		else:
+			_SUMMARIES[key] = summary
+			return summary
+
+	data = np.asanyarray(nib.load(img_path).dataobj)
+	if invert:
+		data = -data
+	reduced_axes = tuple(i for i in range(data.ndim) if i != axis)
+	projection = np.max(data, axis=reduced_axes)
+	if len(percentiles):
+		levels = [float(i) for i in np.percentile(data, percentiles)]
+	else:
+		levels = []
+	projection.flags.writeable = False
+	summary = (projection, levels)
+
+	with _LOCK:
+		_SUMMARIES[key] = summary
+		while len(_SUMMARIES) > OVERLAY_CACHE_ENTRIES:
+			_SUMMARIES.popitem(last=False)
+	return summary
+
+def subthreshold_margins(projection, threshold,
+	nan_subthreshold=False,
+	):
+	"""
+	Return the number of leading and trailing slices whose maximum is below a threshold.
+
+	Parameters
+	----------
+
+	projection : numpy.ndarray
+		Maximum of each slice, as returned by `samri.plotting.overlays.overlay_summary()`.
+	threshold : float
+		Threshold value.
+	nan_subthreshold : bool, optional
+		Whether slices with a NaN maximum count as subthreshold (otherwise they count as suprathreshold).
+
+	Returns
+	-------
+
+	start : int
+		Number of leading subthreshold slices.
+	end : int
+		Number of trailing subthreshold slices.
+		If all slices are subthreshold, both values equal the number of slices.
+	"""
+
+	with np.errstate(invalid='ignore'):
+		subthreshold = projection < threshold
+	if nan_subthreshold:
+		subthreshold |= np.isnan(projection)
+	if subthreshold.all():
+		return len(subthreshold), len(subthreshold)
+	return int(np.argmin(subthreshold)), int(np.argmin(subthreshold[::-1]))
@@ -0,0 +1,29 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+
+def test_plot_background(tmp_path):
+	import nilearn.plotting
+	from samri.plotting.backgrounds import plot_background
+
+	affine = np.diag([0.2,0.2,0.3,1.])
+	affine[:3,3] = [-5,-7,-3]
+	bg_image = str(tmp_path/'bg.nii.gz')
+	nib.save(nib.Nifti1Image(np.random.RandomState(0).rand(20,30,10).astype(np.float32), affine), bg_image)
+
+	for dimming, black_bg in [(0,False),(0.5,True)]:
+		for cut in [-7.0, -3.01, -1.2]:
+			fig, (full_ax, cached_ax) = plt.subplots(1,2)
+			full = nilearn.plotting.plot_anat(bg_image, axes=full_ax, display_mode='y', cut_coords=[cut], annotate=False, black_bg=black_bg, dim=dimming, cmap='binary')
+			cached = plot_background(bg_image, cut, cached_ax, dimming=dimming, black_bg=black_bg, cmap='binary', cache=str(tmp_path/'cache'), annotate=False)
+			full_images = list(full.axes.values())[0].ax.images
+			cached_images = list(cached.axes.values())[0].ax.images
+			assert len(full_images) == len(cached_images)
+			for full_image, cached_image in zip(full_images, cached_images):
+				assert np.array_equal(full_image.get_array(), cached_image.get_array())
+				assert full_image.get_extent() == cached_image.get_extent()
+				assert full_image.get_clim() == cached_image.get_clim()
+			plt.close('all')
+	assert len(list((tmp_path/'cache').iterdir())) == 6
@@ -0,0 +1,27 @@
+import numpy as np
+
+def _state(size):
+	return {'data':np.arange(size)}
+
+def _figure(scale, out_file):
+	import matplotlib.pyplot as plt
+	from samri.plotting.batch import worker_state
+	data = worker_state()['data']
+	plt.plot(data, data*scale)
+	plt.savefig(out_file)
+	return float(data.sum()*scale)
+
+def test_render_batch(tmp_path):
+	from os import path
+	from samri.plotting.batch import render_batch, worker_state
+
+	for n_jobs in [1,3]:
+		jobs = [(scale, str(tmp_path/'{}_{}.png'.format(n_jobs, scale))) for scale in range(4)]
+		results = render_batch(_figure, jobs,
+			initializer=_state,
+			initargs=(5,),
+			n_jobs=n_jobs,
+			)
+		assert results == [10.*scale for scale in range(4)]
+		assert all(path.isfile(out_file) for _, out_file in jobs)
+		assert worker_state() == {}
@@ -0,0 +1,68 @@
+import os
+import stat
+import sys
+import numpy as np
+import pytest
+
+FAKE_BLENDER = '''#!{executable}
+# Answers render jobs as `blender_visualization.py --serve` does, drawing one pixel per feature mesh.
+import io
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from multiprocessing.connection import Connection
+
+argv = sys.argv[sys.argv.index('--serve')+1:]
+jobs = Connection(int(argv[0]), writable=False)
+results = Connection(int(argv[1]), readable=False)
+results.send({{'ready':True}})
+while True:
+	try:
+		job = jobs.recv()
+	except EOFError:
+		break
+	if job is None:
+		break
+	if 'fail' in job['stat_map_paths'][0]:
+		results.send({{'error':'ValueError: no mesh'}})
+		continue
+	img = np.zeros((4,5,4))
+	img[:,:,3] = len(job['stat_map_paths'])/4.
+	png = io.BytesIO()
+	plt.imsave(png, img, format='png')
+	results.send({{'png':png.getvalue()}})
+'''
+
+def _fake_blender(tmp_path):
+	command = str(tmp_path/'blender-fake')
+	with open(command, 'w') as command_file:
+		command_file.write(FAKE_BLENDER.format(executable=sys.executable))
+	os.chmod(command, os.stat(command).st_mode | stat.S_IEXEC)
+	return command
+
+def test_render_server(tmp_path):
+	from samri.plotting.blender import BlenderRenderServer
+
+	server = BlenderRenderServer(str(tmp_path/'template.obj'), commands=[str(tmp_path/'missing'), _fake_blender(tmp_path)])
+	with server:
+		process = server.process
+		img = server.render(['a_pos_mesh.obj','a_neg_mesh.obj'], ['#ff0000','#0000ff'])
+		assert img.shape == (4,5,4)
+		assert np.allclose(img[...,3], 0.5, atol=0.01)
+		with pytest.raises(RuntimeError):
+			server.render(['fail_pos_mesh.obj'], ['#ff0000'])
+		# Jobs are rendered by the same process, also after a failed one.
+		img = server.render(['a_pos_mesh.obj'], ['#ff0000'])
+		assert np.allclose(img[...,3], 0.25, atol=0.01)
+		assert server.process is process
+	assert process.poll() == 0
+	assert not server.alive()
+
+def test_render_server_unavailable(tmp_path):
+	from samri.plotting.blender import BlenderRenderServer
+
+	server = BlenderRenderServer(str(tmp_path/'template.obj'), commands=[str(tmp_path/'missing')])
+	with pytest.raises(RuntimeError):
+		server.render(['a_pos_mesh.obj'], ['#ff0000'])
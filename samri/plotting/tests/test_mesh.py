@@ -0,0 +1,52 @@
+import json
+import struct
+import numpy as np
+
+def _mesh():
+	verts = np.array([[0.,0.,0.],[1.,0.,0.],[0.,1.,0.],[0.,0.,1.]])
+	faces = np.array([[0,1,2],[0,1,3],[0,2,3],[1,2,3]])
+	normals = -verts + 0.25
+	affine = np.diag([0.2,0.3,0.4,1.])
+	affine[:3,3] = [1.,-2.,3.]
+	return verts, faces, normals, affine
+
+def test_write_obj(tmp_path):
+	from samri.plotting.create_mesh_featuremaps import f, write_obj
+
+	verts, faces, normals, affine = _mesh()
+	obj = str(tmp_path/'mesh.obj')
+	write_obj(obj, verts, faces, normals, None, affine=affine, one=True)
+	with open(obj) as mesh_file:
+		lines = mesh_file.read().splitlines()
+	assert len(lines) == len(verts) + len(normals) + len(faces)
+	written_verts = np.array([[float(i) for i in line.split()[1:]] for line in lines if line.startswith('v ')])
+	assert np.allclose(written_verts, [f(i[0],i[1],i[2],affine) for i in verts])
+	assert lines[-1] == 'f 2//2 3//3 4//4'
+
+def test_write_binary(tmp_path):
+	from samri.plotting.create_mesh_featuremaps import apply_affine, write_glb, write_ply
+
+	verts, faces, normals, affine = _mesh()
+	ply = str(tmp_path/'mesh.ply')
+	write_ply(ply, verts, faces, normals, affine=affine)
+	with open(ply, 'rb') as mesh_file:
+		content = mesh_file.read()
+	header, body = content.split(b'end_header\n')
+	assert b'element vertex 4' in header and b'element face 4' in header
+	vertex_data = np.frombuffer(body[:4*6*4], dtype='<f4').reshape(4,6)
+	assert np.allclose(vertex_data[:,:3], apply_affine(verts, affine))
+	face_data = np.frombuffer(body[4*6*4:], dtype=[('count','u1'),('indices','<i4',3)])
+	assert np.array_equal(face_data['indices'], faces)
+
+	glb = str(tmp_path/'mesh.glb')
+	write_glb(glb, verts, faces, normals, affine=affine)
+	with open(glb, 'rb') as mesh_file:
+		content = mesh_file.read()
+	magic, version, length = struct.unpack('<4sII', content[:12])
+	assert (magic, version, length) == (b'glTF', 2, len(content))
+	json_length, _ = struct.unpack('<I4s', content[12:20])
+	gltf = json.loads(content[20:20+json_length])
+	assert gltf['accessors'][0]['count'] == 4
+	assert gltf['accessors'][2]['count'] == faces.size
+	binary = content[20+json_length+8:]
+	assert np.allclose(np.frombuffer(binary[:4*3*4], dtype='<f4').reshape(4,3), apply_affine(verts, affine))
@@ -0,0 +1,35 @@
+import nibabel as nib
+import numpy as np
+
+def _loop_margins(data, threshold, nan_subthreshold):
+	"""Reference implementation, as previously used in `samri.plotting.maps.slices()`."""
+	margins = []
+	for order in [np.arange(data.shape[1]), np.arange(data.shape[1])[::-1]]:
+		count = 0
+		for i in order:
+			my_slice = data[:,i,:]
+			if (nan_subthreshold and np.isnan(my_slice.max())) or my_slice.max() < threshold:
+				count += 1
+			else:
+				break
+		margins.append(count)
+	return tuple(margins)
+
+def test_overlay_summary(tmp_path):
+	from samri.plotting.overlays import overlay_summary, subthreshold_margins
+
+	rng = np.random.RandomState(0)
+	data = np.zeros((6,12,5,3))
+	data[:,3:9] = rng.normal(size=(6,6,5,3))*4
+	data[2,10,1,0] = np.nan
+	img_path = str(tmp_path/'overlay.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.eye(4)), img_path)
+
+	for invert in [False, True]:
+		projection, levels = overlay_summary(img_path, percentiles=[80,95], invert=invert)
+		reference = -data if invert else data
+		assert np.allclose(levels, np.percentile(reference, [80,95]), equal_nan=True)
+		for nan_subthreshold in [False, True]:
+			for threshold in [-1, 2, 100]:
+				assert subthreshold_margins(projection, threshold, nan_subthreshold=nan_subthreshold) == _loop_margins(reference, threshold, nan_subthreshold)
+		assert overlay_summary(img_path, percentiles=[80,95], invert=invert) is overlay_summary(img_path, percentiles=[80,95], invert=invert)
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import threading
+import nibabel as nib
+import numpy as np
+from collections import OrderedDict
+from os import path
+
+# Default memory ceiling of the shared cache, in megabytes.
+CACHE_LIMIT_MB = float(os.environ.get('SAMRI_CACHE_MB', 2048))
+# Content hashes are memoized per (path, modification time, size).
+_FILE_HASHES = {}
+_FILE_HASHES_LOCK = threading.Lock()
+
+class ImageCache(object):
+	"""
+	Size-bounded least-recently-used cache of decoded NIfTI voxel arrays.
+
+	Entries are keyed by absolute path, modification time, file size and requested dtype, so that files rewritten on disk are transparently reloaded.
+	Cached arrays are flagged read-only, since they are shared between all callers.
+
+	Parameters
+	----------
+
+	limit_mb : float, optional
+		Maximum memory (in megabytes) occupied by the cached arrays.
+		Arrays larger than this value are returned, but never stored.
+	"""
+
+	def __init__(self, limit_mb=CACHE_LIMIT_MB):
+		self.limit = int(limit_mb*1024**2)
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.RLock()
+
+	def key(self, img_path, dtype=None):
+		img_path = path.abspath(path.expanduser(img_path))
+		stat = os.stat(img_path)
+		if dtype is not None:
+			dtype = np.dtype(dtype).str
+		return (img_path, stat.st_mtime_ns, stat.st_size, dtype)
+
+	def get(self, img_path, dtype=None):
+		"""
+		Return the decoded data, affine, header and image class of a NIfTI file, loading it only if it is not already cached.
+
+		Parameters
+		----------
+
+		img_path : str
+			Path to a NIfTI file.
+		dtype : str or numpy.dtype, optional
+			Data type to which to cast the voxel array.
+			If `None`, the data type resulting from applying the header scaling to the on-disk values is used.
+
+		Returns
+		-------
+
+		data : numpy.ndarray
+		affine : numpy.ndarray
+		header : nibabel.nifti1.Nifti1Header
+		img_class : type
+		"""
+		key = self.key(img_path, dtype)
+		with self._lock:
+			try:
+				entry = self._entries.pop(key)
+			except KeyError:
+				self.misses += 1
+			else:
+				self._entries[key] = entry
+				self.hits += 1
+				return entry
+		img = nib.load(key[0])
+		data = np.asanyarray(img.dataobj)
+		if dtype is not None:
+			data = data.astype(dtype, copy=False)
+		data.flags.writeable = False
+		entry = (data, img.affine, img.header, img.__class__)
+		if data.nbytes > self.limit:
+			return entry
+		with self._lock:
+			if key not in self._entries:
+				self._entries[key] = entry
+				self.size += data.nbytes
+				self._shrink()
+		return entry
+
+	def _shrink(self):
+		while self.size > self.limit and self._entries:
+			_, (data, _, _, _) = self._entries.popitem(last=False)
+			self.size -= data.nbytes
+
+	def resize(self, limit_mb):
+		"""Set a new memory ceiling (in megabytes), evicting the least recently used entries if needed."""
+		with self._lock:
+			self.limit = int(limit_mb*1024**2)
+			self._shrink()
+
+	def clear(self):
+		"""Drop all entries and reset the hit and miss counters."""
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+			self.hits = 0
+			self.misses = 0
+
+	def info(self):
+		"""Return a dictionary summarizing the cache usage."""
+		with self._lock:
+			return {
+				'hits':self.hits,
+				'misses':self.misses,
+				'entries':len(self._entries),
+				'size_mb':self.size/1024.**2,
+				'limit_mb':self.limit/1024.**2,
+				}
+
+# Process-wide instance shared by all `samri.report` functions.
+image_cache = ImageCache()
+
+def load_data(img_path,
+	dtype=None,
+	):
+	"""
+	Return the (read-only) decoded voxel array of a NIfTI file via the process-wide `samri.report.cache.image_cache`.
+
+	Parameters
+	----------
+
+	img_path : str
+		Path to a NIfTI file.
+	dtype : str or numpy.dtype, optional
+		Data type to which to cast the voxel array.
+	"""
+	data, _, _, _ = image_cache.get(img_path, dtype)
+	return data
+
+def load(img_path,
+	dtype=None,
+	):
+	"""
+	Drop-in replacement for `nibabel.load()`, returning an in-memory image whose data array is served from the process-wide `samri.report.cache.image_cache`.
+
+	Parameters
+	----------
+
+	img_path : str
+		Path to a NIfTI file.
+	dtype : str or numpy.dtype, optional
+		Data type to which to cast the voxel array.
+
+	Returns
+	-------
+
+	nibabel.nifti1.Nifti1Image
+		Image object (of the same class as the on-disk image), with a private header copy, and a read-only data array.
+	"""
+	data, affine, header, img_class = image_cache.get(img_path, dtype)
+	return img_class(data, affine, header)
+
+def cache_info():
+	"""Return hit and miss counts, number of entries, as well as current and maximum size (in megabytes) of the process-wide image cache."""
+	return image_cache.info()
+
+def clear_cache():
+	"""Empty the process-wide image cache."""
+	image_cache.clear()
+
+def set_cache_limit(limit_mb):
+	"""Set the memory ceiling (in megabytes) of the process-wide image cache."""
+	image_cache.resize(limit_mb)
+
+def file_hash(file_path,
+	block_size=2**20,
+	):
+	"""
+	Return the SHA-1 hex digest of the contents of a file.
+	Digests are memoized for the lifetime of the process, keyed by absolute path, modification time and file size, so that each file is only read once.
+
+	Parameters
+	----------
+
+	file_path : str
+		Path to a file.
+	block_size : int, optional
+		Number of bytes to read at a time.
+	"""
+	file_path = path.abspath(path.expanduser(file_path))
+	stat = os.stat(file_path)
+	key = (file_path, stat.st_mtime_ns, stat.st_size)
+	with _FILE_HASHES_LOCK:
+		try:
+			return _FILE_HASHES[key]
+		except KeyError:
+			pass
+	digest = hashlib.sha1()
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			digest.update(block)
+	digest = digest.hexdigest()
+	with _FILE_HASHES_LOCK:
+		_FILE_HASHES[key] = digest
+	return digest
@@ -0,0 +1,145 @@
+import multiprocessing as mp
+import nibabel as nib
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os import path
+
+BACKENDS = ('threading', 'multiprocessing', 'loky')
+
+def available_memory():
+	"""Return the currently available physical memory, in bytes."""
+	try:
+		with open('/proc/meminfo') as meminfo:
+			for line in meminfo:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])*1024
+	except IOError:
+		pass
+	return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+
+def estimate_memory(img_path,
+	substitution={},
+	factor=2.,
+	):
+	"""
+	Estimate the memory (in bytes) needed to process a NIfTI file, based only on its header.
+
+	Parameters
+	----------
+
+	img_path : str
+		Path to a NIfTI file, may contain format fields present as keys in the `substitution` dictionary.
+	substitution : dict, optional
+		A dictionary containing formatting strings as keys and strings as values.
+	factor : float, optional
+		Multiple of the decoded image size to account for working copies created during processing.
+
+	Returns
+	-------
+
+	int
+		Estimated memory in bytes, 0 if the file does not exist.
+	"""
+
+	if substitution:
+		img_path = img_path.format(**substitution)
+	img_path = path.abspath(path.expanduser(img_path))
+	try:
+		img = nib.load(img_path)
+	except (FileNotFoundError, nib.filebasedimages.ImageFileError):
+		return 0
+	dtype = img.get_data_dtype()
+	slope, inter = img.header.get_slope_inter()
+	# Scaled data is decoded as float64.
+	if (slope is not None and slope != 1) or (inter is not None and inter != 0):
+		dtype = np.dtype(np.float64)
+	return int(np.prod(img.shape, dtype=np.int64)*dtype.itemsize*factor)
+
+def _executor(backend, n_jobs):
+	if backend == 'threading':
+		return ThreadPoolExecutor(max_workers=n_jobs)
+	elif backend == 'multiprocessing':
+		return ProcessPoolExecutor(max_workers=n_jobs)
+	elif backend == 'loky':
+		from joblib.externals.loky import get_reusable_executor
+		return get_reusable_executor(max_workers=n_jobs)
+	raise ValueError("The `backend` parameter must be one of: "+", ".join(BACKENDS)+".")
+
+def parallel_map(function, *iterables,
+	backend='threading',
+	n_jobs=False,
+	n_jobs_percentage=0.8,
+	memory_estimates=None,
+	memory_budget=None,
+	):
+	"""
+	Apply a function to the elements of one or more iterables in parallel, and return the results in input order.
+	If memory estimates are given, jobs are only started while the sum of the estimates of running jobs remains within the memory budget (at least one job is always run).
+
+	Parameters
+	----------
+
+	function : callable
+		Function to apply; for the 'multiprocessing' and 'loky' backends it needs to be picklable (i.e. defined at module level).
+	*iterables
+		Iterables providing the positional arguments of each function call.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend.
+		Threads are best suited to I/O- and NumPy-bound jobs, processes to jobs which hold the GIL.
+	n_jobs : int, optional
+		Number of workers, defaults to a fraction of the CPU count given by `n_jobs_percentage`.
+	n_jobs_percentage : float, optional
+		Fraction of the CPU count to use as number of workers, if `n_jobs` is not specified.
+	memory_estimates : list of int, optional
+		Estimated memory requirement (in bytes) of each job, e.g. as computed by `samri.report.execution.estimate_memory()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which running jobs may occupy.
+		If `None`, 80% of the currently available memory is used; if `False`, memory admission control is disabled.
+
+	Returns
+	-------
+
+	list
+		Function return values, in the order of the input iterables.
+	"""
+
+	args = list(zip(*iterables))
+	if not args:
+		return []
+	if not n_jobs:
+		n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
+	n_jobs = min(n_jobs, len(args))
+	if memory_estimates is None or memory_budget is False:
+		memory_estimates = [0]*len(args)
+		budget = float('inf')
+	elif memory_budget is None:
+		budget = 0.8*available_memory()
+	else:
+		budget = memory_budget*1024**3
+
+	results = [None]*len(args)
+	pending = list(range(len(args)))[::-1]
+	running = {}
+	used = 0
+	executor = _executor(backend, n_jobs)
+	try:
+		while pending or running:
+			while pending and len(running) < n_jobs:
+				ix = pending[-1]
+				if running and used + memory_estimates[ix] > budget:
+					break
+				pending.pop()
+				future = executor.submit(function, *args[ix])
+				running[future] = ix
+				used += memory_estimates[ix]
+			done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+			for future in done:
+				ix = running.pop(future)
+				used -= memory_estimates[ix]
+				results[ix] = future.result()
+	finally:
+		# Reusable loky executors are kept alive for subsequent calls.
+		if backend != 'loky':
+			executor.shutdown(wait=True)
+	return results
@@ -0,0 +1,317 @@
+import numpy as np
+import pandas as pd
+from os import path
+from samri.report import cache
+from samri.report.execution import estimate_memory, parallel_map
+
+class ROIIndex(object):
+	"""
+	Flat voxel indices of a set of Regions of Interest (ROIs), precomputed once, so that any number of images on the same grid can be reduced for all ROIs in one pass.
+	Instances should be created via `samri.report.extraction.roi_index()`.
+
+	Attributes
+	----------
+
+	indices : numpy.ndarray
+		Flat (C-order) voxel indices of all ROIs, concatenated in ROI order.
+	counts : numpy.ndarray
+		Number of voxels in each ROI.
+	features : list
+		Identifier of each ROI (atlas label value, or mask path/position).
+	shape : tuple
+		Shape of the 3D grid on which the indices are defined.
+	affine : numpy.ndarray
+		Affine of the 3D grid on which the indices are defined.
+	filename : str or None
+		Path of the source file, if the index was created from a single file.
+	"""
+
+	def __init__(self, indices, counts, features, shape, affine,
+		filename=None,
+		):
+		self.indices = indices
+		self.counts = counts
+		self.features = features
+		self.shape = tuple(shape)
+		self.affine = affine
+		self.filename = filename
+		self.segments = np.repeat(np.arange(len(counts)), counts)
+		self._grids = {}
+
+	def __len__(self):
+		return len(self.counts)
+
+	def matches(self, img):
+		"""Whether the 3D grid of `img` is identical to the grid of the index."""
+		return tuple(img.shape[:3]) == self.shape and np.allclose(img.affine, self.affine)
+
+	def mask(self, features):
+		"""Return the union of the ROIs with the given features as a binary 3D `numpy.ndarray` on the grid of the index, without reading the source image again."""
+		starts = np.cumsum(self.counts) - self.counts
+		data = np.zeros(int(np.prod(self.shape)), dtype=np.uint8)
+		for ix in np.flatnonzero(np.isin(self.features, features)):
+			data[self.indices[starts[ix]:starts[ix]+self.counts[ix]]] = 1
+		return data.reshape(self.shape)
+
+	def resampled(self, shape, affine):
+		"""
+		Return the index resampled onto another 3D grid via nearest-neighbour interpolation.
+		The resampled index is computed once per grid, and reused for all further images on that grid.
+		"""
+		import nibabel as nib
+		from nibabel import processing
+
+		shape = tuple(shape[:3])
+		affine = np.asarray(affine, dtype=np.float64)
+		key = (shape, affine.tobytes())
+		try:
+			return self._grids[key]
+		except KeyError:
+			pass
+		size = int(np.prod(self.shape))
+		starts = np.cumsum(self.counts) - self.counts
+		if len(np.unique(self.indices)) == len(self.indices):
+			# Disjoint ROIs are resampled together, as a single label image.
+			rois = [np.arange(len(self))]
+		else:
+			rois = [[ix] for ix in range(len(self))]
+		indices = []
+		segments = []
+		for roi in rois:
+			labels = np.zeros(size, dtype=np.int32)
+			for ix in roi:
+				labels[self.indices[starts[ix]:starts[ix]+self.counts[ix]]] = ix + 1
+			labels = processing.resample_from_to(nib.Nifti1Image(labels.reshape(self.shape), self.affine), (shape, affine), order=0)
+			labels = np.rint(np.asanyarray(labels.dataobj)).astype(np.int64).ravel()
+			roi_indices = np.flatnonzero(labels)
+			indices.append(roi_indices)
+			segments.append(labels[roi_indices] - 1)
+		indices = np.concatenate(indices)
+		segments = np.concatenate(segments)
+		order = np.argsort(segments, kind='stable')
+		index = ROIIndex(indices[order], np.bincount(segments, minlength=len(self)), self.features, shape, affine,
+			filename=self.filename,
+			)
+		return self._grids.setdefault(key, index)
+
+def _load_roi(roi):
+	filename = None
+	if isinstance(roi, str):
+		roi = path.abspath(path.expanduser(roi))
+		filename = roi
+		roi = cache.load(roi)
+	elif roi.get_filename():
+		filename = path.abspath(roi.get_filename())
+	return roi, filename
+
+def roi_index(rois,
+	labels=None,
+	null_label=0.,
+	):
+	"""
+	Precompute the flat voxel indices of a label atlas or of a stack of binary ROI masks.
+
+	Parameters
+	----------
+
+	rois : str or nibabel.nifti1.Nifti1Image or list
+		A single label atlas (or binary mask), given as a path or image object, or a list of binary masks on the same grid.
+		Masks in a list may overlap.
+	labels : list, optional
+		Atlas labels to index; if unspecified, all labels present in the atlas are indexed.
+		This parameter is ignored if `rois` is a list.
+	null_label : float, optional
+		Atlas value to exclude a priori.
+
+	Returns
+	-------
+
+	samri.report.extraction.ROIIndex
+	"""
+
+	if isinstance(rois, (list, tuple)):
+		ref_img, _ = _load_roi(rois[0])
+		indices = []
+		counts = []
+		features = []
+		for ix, roi in enumerate(rois):
+			roi_img, filename = _load_roi(roi)
+			if tuple(roi_img.shape[:3]) != tuple(ref_img.shape[:3]) or not np.allclose(roi_img.affine, ref_img.affine):
+				from nibabel import processing
+				roi_img = processing.resample_from_to(roi_img, ref_img, order=0)
+			roi_indices = np.flatnonzero(np.asanyarray(roi_img.dataobj))
+			indices.append(roi_indices)
+			counts.append(len(roi_indices))
+			features.append(filename if filename else ix)
+		indices = np.concatenate(indices)
+		counts = np.array(counts)
+		filename = None
+		if len(features) == 1 and isinstance(features[0], str):
+			filename = features[0]
+		return ROIIndex(indices, counts, features, ref_img.shape[:3], ref_img.affine,
+			filename=filename,
+			)
+
+	atlas_img, filename = _load_roi(rois)
+	atlas = np.asanyarray(atlas_img.dataobj).ravel()
+	selection = atlas != null_label
+	if labels is not None:
+		selection &= np.isin(atlas, labels)
+	indices = np.flatnonzero(selection)
+	order = np.argsort(atlas[indices], kind='stable')
+	indices = indices[order]
+	features, counts = np.unique(atlas[indices], return_counts=True)
+	return ROIIndex(indices, counts, list(features), atlas_img.shape[:3], atlas_img.affine,
+		filename=filename,
+		)
+
+def roi_stats(img, index,
+	exclude_zero=False,
+	zero_threshold=0.1,
+	):
+	"""
+	Return the mean, median, count, and standard deviation of the non-NaN values of an image within all ROIs of an index.
+	All ROIs are reduced in a single sorted-segment pass over the indexed voxels.
+
+	Parameters
+	----------
+
+	img : str or nibabel.nifti1.Nifti1Image
+		Path to NIfTI file or image object from which the ROI values are to be extracted.
+		For 4D images, values from all volumes are pooled.
+	index : samri.report.extraction.ROIIndex
+		Precomputed ROI index, as returned by `samri.report.extraction.roi_index()`.
+		If the image is on another grid, the index is resampled onto it via `samri.report.extraction.ROIIndex.resampled()`.
+	exclude_zero : bool, optional
+		Whether to filter out zero values.
+	zero_threshold : float, optional
+		Absolute value below which values are to be considered zero.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+		Pandas DataFrame object containing a row for each ROI and columns named 'feature', 'Mean', 'Median', 'Count', and 'Standard Deviation'.
+	"""
+
+	if isinstance(img, str):
+		img = cache.load(path.abspath(path.expanduser(img)))
+	if not index.matches(img):
+		# The ROIs are resampled onto the image grid (rather than the image onto the ROI grid), which leaves the image values unchanged.
+		index = index.resampled(img.shape, img.affine)
+	data = np.asanyarray(img.dataobj)
+	data = data.reshape((np.prod(index.shape),-1))
+
+	values = data[index.indices]
+	segments = np.repeat(index.segments, values.shape[1])
+	values = values.ravel()
+	valid = ~np.isnan(values)
+	if exclude_zero:
+		valid &= np.abs(values) >= zero_threshold
+	values = values[valid].astype(np.float64)
+	segments = segments[valid]
+
+	n = len(index)
+	counts = np.bincount(segments, minlength=n)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means = np.bincount(segments, weights=values, minlength=n)/counts
+		deviations = (values - means[segments])**2
+		stds = np.sqrt(np.bincount(segments, weights=deviations, minlength=n)/counts)
+
+	# Segments are contiguous, so sorting by segment and then value yields per-ROI sorted runs.
+	values = values[np.lexsort((values, segments))]
+	starts = np.cumsum(counts) - counts
+	medians = np.full(n, np.nan)
+	populated = counts > 0
+	lower = starts[populated] + (counts[populated]-1)//2
+	upper = starts[populated] + counts[populated]//2
+	medians[populated] = (values[lower] + values[upper])/2.
+
+	df = pd.DataFrame({
+		'feature':index.features,
+		'Mean':means,
+		'Median':medians,
+		'Count':counts,
+		'Standard Deviation':stds,
+		})
+	return df
+
+def df_roi_stats(df, rois,
+	labels=None,
+	null_label=0.,
+	exclude_zero=False,
+	zero_threshold=0.1,
+	path_column='path',
+	save_as='',
+	n_jobs=False,
+	n_jobs_percentage=0.8,
+	backend='threading',
+	memory_budget=None,
+	):
+	"""
+	Create a long-format `pandas.DataFrame` (optionally saveable as `.csv`), containing the per-ROI mean, median, count, and standard deviation for all files specified by the path column of an input DataFrame.
+	This function is a Pandas DataFrame based iteration wrapper of `samri.report.extraction.roi_stats()`, which indexes the ROIs only once.
+
+	Parameters
+	----------
+
+	df : pandas.DataFrame
+		A BIDS-Information Pandas DataFrame which includes a column named according to `path_column`.
+	rois : str or nibabel.nifti1.Nifti1Image or list or samri.report.extraction.ROIIndex
+		Label atlas, list of binary masks, or precomputed ROI index.
+	labels : list, optional
+		Atlas labels to index; if unspecified, all labels present in the atlas are indexed.
+	null_label : float, optional
+		Atlas value to exclude a priori.
+	exclude_zero : bool, optional
+		Whether to filter out zero values.
+	zero_threshold : float, optional
+		Absolute value below which values are to be considered zero.
+	path_column : str, optional
+		Column name which identifies the path of the data to analyze.
+	save_as : str, optional
+		Path to which to save the Pandas DataFrame.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
+
+	Returns
+	-------
+
+	pandas.DataFrame
+		Pandas DataFrame object containing a row for each (input row, ROI) pair, with all input columns, as well as columns named 'feature', 'Mean', 'Median', 'Count', and 'Standard Deviation'.
+	"""
+
+	if not isinstance(rois, ROIIndex):
+		rois = roi_index(rois, labels=labels, null_label=null_label)
+
+	in_files = df[path_column].tolist()
+	iter_length = len(in_files)
+
+	iter_data = parallel_map(roi_stats,
+		in_files,
+		[rois]*iter_length,
+		[exclude_zero]*iter_length,
+		[zero_threshold]*iter_length,
+		backend=backend,
+		n_jobs=n_jobs,
+		n_jobs_percentage=n_jobs_percentage,
+		memory_estimates=[estimate_memory(i) for i in in_files],
+		memory_budget=memory_budget,
+		)
+
+	dfs = []
+	for (_, row), stats in zip(df.iterrows(), iter_data):
+		for column in df.columns:
+			stats[column] = row[column]
+		dfs.append(stats)
+	df = pd.concat(dfs, ignore_index=True)
+
+	if save_as:
+		save_as = path.abspath(path.expanduser(save_as))
+		if save_as.lower().endswith('.csv'):
+			df.to_csv(save_as)
+		else:
+			raise ValueError("Please specify an output path ending in any one of "+",".join((".csv",))+".")
+	return df
@@ -1,11 +1,103 @@
 import hashlib
+import json
 import multiprocessing as mp
 import nibabel as nib
+import os
 import pandas as pd
+import shutil
+import tempfile
 from os import path
-from joblib import Parallel, delayed
 
 from nipype.interfaces import ants, fsl
+from samri.report.cache import file_hash
+from samri.report.execution import estimate_memory, parallel_map
+from samri.report.similarity import similarity
+
+SIMILARITY_CACHE_DIR = path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'samri', 'similarity')
+
+def _cache_dirs(cache):
+	if cache is True:
+		cache = SIMILARITY_CACHE_DIR
+	cache = path.abspath(path.expanduser(cache))
+	means_dir = path.join(cache, 'means')
+	scores_dir = path.join(cache, 'scores')
+	for cache_dir in [means_dir, scores_dir]:
+		os.makedirs(cache_dir, exist_ok=True)
+	return means_dir, scores_dir
+
+def _temporal_mean(image_path, out_file):
+	"""Write the temporal mean of a 4D image, via a temporary file, so that concurrent readers never see a partial image."""
+	temp_dir = tempfile.mkdtemp(dir=path.dirname(out_file))
+	try:
+		temporal_mean = fsl.MeanImage()
+		temporal_mean.inputs.in_file = image_path
+		temporal_mean.inputs.out_file = path.join(temp_dir, path.basename(out_file))
+		temporal_mean_res = temporal_mean.run()
+		os.replace(temporal_mean_res.outputs.out_file, out_file)
+	finally:
+		shutil.rmtree(temp_dir, ignore_errors=True)
+	return out_file
+
+ENGINES = ('ants', 'numpy')
+
+def similarity_key(image_path, reference,
+	mask='',
+	metric='MI',
+	radius_or_number_of_bins=8,
+	sampling_strategy='None',
+	sampling_percentage=0.3,
+	engine='ants',
+	random_state=0,
+	):
+	"""Return a key identifying a similarity computation by the contents of all input files, by the metric parameters, and by the computation engine."""
+	parameters = [
+		file_hash(image_path),
+		file_hash(reference),
+		file_hash(mask) if mask else '',
+		metric,
+		radius_or_number_of_bins,
+		sampling_strategy,
+		sampling_percentage,
+		]
+	# Keys of the (original) ANTs engine are kept engine-agnostic, so that existing cache entries remain valid.
+	if engine != 'ants':
+		parameters.extend([engine, random_state])
+	return hashlib.sha1(json.dumps(parameters).encode('utf-8')).hexdigest()
+
+def _ants_similarity(image_path, reference, mask, metric, radius_or_number_of_bins, sampling_strategy, sampling_percentage, means_dir):
+	img = nib.load(image_path)
+	if img.header['dim'][0] > 3:
+		merged_image_path = path.join(means_dir, file_hash(image_path)+'.nii.gz')
+		if not path.isfile(merged_image_path):
+			_temporal_mean(image_path, merged_image_path)
+		image_path = merged_image_path
+
+	sim = ants.MeasureImageSimilarity()
+	sim.inputs.dimension = 3
+	sim.inputs.metric = metric
+	sim.inputs.fixed_image = reference
+	sim.inputs.moving_image = image_path
+	sim.inputs.metric_weight = 1.0
+	sim.inputs.radius_or_number_of_bins = radius_or_number_of_bins
+	sim.inputs.sampling_strategy = sampling_strategy
+	sim.inputs.sampling_percentage = sampling_percentage
+	if mask:
+		sim.inputs.fixed_image_mask = mask
+	sim_res = sim.run()
+	return sim_res.outputs.similarity
+
+def _numpy_similarity(image_path, reference, mask, metric, radius_or_number_of_bins, sampling_strategy, sampling_percentage, means_dir,
+	random_state=0,
+	):
+	# The temporal mean is computed in memory, so `means_dir` is not needed.
+	return similarity(reference, image_path,
+		metric=metric,
+		radius_or_number_of_bins=radius_or_number_of_bins,
+		sampling_strategy=sampling_strategy,
+		sampling_percentage=sampling_percentage,
+		mask=mask,
+		random_state=random_state,
+		)
 
 def measure_sim(image_path, reference,
 	substitutions=False,
@@ -14,6 +106,10 @@ def measure_sim(image_path, reference,
 	radius_or_number_of_bins=8,
 	sampling_strategy='None',
 	sampling_percentage=0.3,
+	cache=True,
+	engine='ants',
+	validate=False,
+	random_state=0,
 	):
 	"""Return a similarity metric score for two 3d images
 
@@ -30,8 +126,22 @@ def measure_sim(image_path, reference,
 		Path to mask which selects a subregionfor which to compute the similarity.
 	metric : {'CC', 'MI', 'Mattes', 'MeanSquares', 'Demons', 'GC'}
 		Similarity metric, as accepted by `nipype.interfaces.ants.registration.MeasureImageSimilarity` (which wraps the ANTs command `MeasureImageSimilarity`).
+		The 'numpy' engine supports all metrics except 'Demons'.
+	cache : bool or str, optional
+		Whether to cache temporal mean images and similarity scores, or path to the cache directory (by default `samri.report.registration.SIMILARITY_CACHE_DIR`).
+		Cache entries are keyed by the contents of the input files and by the metric parameters, and are thus never stale.
+	engine : {'ants', 'numpy'}, optional
+		Whether to compute the similarity via the ANTs `MeasureImageSimilarity` command, or in-process via `samri.report.similarity.similarity()`.
+	validate : bool, optional
+		Whether to additionally compute the ANTs score if `engine` is 'numpy', and record it under the 'similarity_ants' key.
+	random_state : int, optional
+		Seed for the 'Random' sampling strategy of the 'numpy' engine, which is part of the cache key.
+		If None, the sampled points differ between calls, and the score is not cached.
 	"""
 
+	if engine not in ENGINES:
+		raise ValueError("The `engine` parameter must be one of: "+", ".join(ENGINES)+".")
+
 	if substitutions:
 		image_path = image_path.format(**substitutions)
 	image_path = path.abspath(path.expanduser(image_path))
@@ -47,33 +157,48 @@ def measure_sim(image_path, reference,
 		file_data["session"] = substitutions["session"]
 		file_data["acquisition"] = substitutions["acquisition"]
 
-	img = nib.load(image_path)
-	if img.header['dim'][0] > 3:
-		image_name = path.basename(file_data["path"])
-		merged_image_name = "merged_"+image_name
-		merged_image_path = path.join("/tmp",merged_image_name)
-		if not path.isfile(merged_image_path):
-			temporal_mean = fsl.MeanImage()
-			temporal_mean.inputs.in_file = image_path
-			temporal_mean.inputs.out_file = merged_image_path
-			temporal_mean_res = temporal_mean.run()
-			image_path = temporal_mean_res.outputs.out_file
-		else:
-			image_path = merged_image_path
-
-	sim = ants.MeasureImageSimilarity()
-	sim.inputs.dimension = 3
-	sim.inputs.metric = metric
-	sim.inputs.fixed_image = reference
-	sim.inputs.moving_image = image_path
-	sim.inputs.metric_weight = 1.0
-	sim.inputs.radius_or_number_of_bins = radius_or_number_of_bins
-	sim.inputs.sampling_strategy = sampling_strategy
-	sim.inputs.sampling_percentage = sampling_percentage
-	if mask:
-		sim.inputs.fixed_image_mask = mask
-	sim_res = sim.run()
-	file_data["similarity"] = sim_res.outputs.similarity
+	engines = [engine]
+	if validate and engine != 'ants':
+		engines.append('ants')
+	if cache:
+		means_dir, scores_dir = _cache_dirs(cache)
+	else:
+		means_dir = tempfile.mkdtemp()
+	try:
+		for current_engine in engines:
+			field = 'similarity' if current_engine == engine else 'similarity_'+current_engine
+			reproducible = current_engine == 'ants' or sampling_strategy != 'Random' or random_state is not None
+			if cache and reproducible:
+				key = similarity_key(image_path, reference,
+					mask=mask,
+					metric=metric,
+					radius_or_number_of_bins=radius_or_number_of_bins,
+					sampling_strategy=sampling_strategy,
+					sampling_percentage=sampling_percentage,
+					engine=current_engine,
+					random_state=random_state,
+					)
+				score_file = path.join(scores_dir, key+'.json')
+				try:
+					with open(score_file, 'r') as f:
+						file_data[field] = json.load(f)['similarity']
+					continue
+				except (IOError, ValueError, KeyError):
+					pass
+			if current_engine == 'ants':
+				file_data[field] = _ants_similarity(image_path, reference, mask, metric, radius_or_number_of_bins, sampling_strategy, sampling_percentage, means_dir)
+			else:
+				file_data[field] = _numpy_similarity(image_path, reference, mask, metric, radius_or_number_of_bins, sampling_strategy, sampling_percentage, means_dir,
+					random_state=random_state,
+					)
+			if cache and reproducible:
+				temp_file = '{}.{}.tmp'.format(score_file, os.getpid())
+				with open(temp_file, 'w') as f:
+					json.dump({'similarity':file_data[field]}, f)
+				os.replace(temp_file, score_file)
+	finally:
+		if not cache:
+			shutil.rmtree(means_dir, ignore_errors=True)
 
 	return file_data
 
@@ -84,14 +209,22 @@ def iter_measure_sim(file_template, reference, substitutions,
 	sampling_percentage=0.3,
 	save_as="",
 	mask="",
+	backend='threading',
+	memory_budget=None,
+	cache=True,
+	engine='ants',
+	validate=False,
+	random_state=0,
 	):
 	"""Create a `pandas.DataFrame` (optionally saveable as `.csv`), containing the similarity scores and BIDS identifier fields for images from a BIDS directory.
+	Scores already present in the similarity cache (see `samri.report.registration.measure_sim()`) are not recomputed.
+	With `engine='numpy'` scores are computed in-process, and with `validate=True` the ANTs scores are additionally recorded in a 'similarity_ants' column, and their difference in a 'similarity_difference' column.
 	"""
 
 	reference = path.abspath(path.expanduser(reference))
 
-	n_jobs = mp.cpu_count()-2
-	similarity_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(measure_sim),
+	n_jobs = max(mp.cpu_count()-2,1)
+	similarity_data = parallel_map(measure_sim,
 		[file_template]*len(substitutions),
 		[reference]*len(substitutions),
 		substitutions,
@@ -100,10 +233,20 @@ def iter_measure_sim(file_template, reference, substitutions,
 		[radius_or_number_of_bins]*len(substitutions),
 		[sampling_strategy]*len(substitutions),
 		[sampling_percentage]*len(substitutions),
-		))
+		[cache]*len(substitutions),
+		[engine]*len(substitutions),
+		[validate]*len(substitutions),
+		[random_state]*len(substitutions),
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(file_template, i) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 
 	df = pd.DataFrame.from_dict(similarity_data)
 	df.dropna(axis=0, how='any', inplace=True) #some rows will be empty
+	if 'similarity_ants' in df.columns:
+		df['similarity_difference'] = df['similarity'] - df['similarity_ants']
 
 	if save_as:
 		save_as = path.abspath(path.expanduser(save_as))
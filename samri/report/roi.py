@@ -1,12 +1,14 @@
 import nibabel as nib
 import numpy as np
 import os
+from functools import lru_cache
 from os import path
 
 from nilearn.input_data import NiftiMasker
 from scipy.io import loadmat
+from samri.report.execution import estimate_memory, parallel_map
+from samri.report.extraction import roi_index
 from samri.report.utilities import roi_df, pattern_df
-from joblib import Parallel, delayed
 
 import statsmodels.formula.api as smf
 import multiprocessing as mp
@@ -118,6 +120,8 @@ def ts_multi(img_paths,
 	top_voxel='',
 	save_as='ts_multi.csv',
 	metric='median',
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Create a `.csv` file containing filenames on the first column and per-scan timecourse average or median values on subsequent columns.
@@ -135,19 +139,26 @@ def ts_multi(img_paths,
 		Note that this file *needs* to be in the exact same affine space as the mask file.
 	metric : str, optional
 		Either "median" or "mean", specifying which metric for the ROI estimation to select.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 	"""
-	# Imports are needed for usage as nipype nodes.
 
 	n_jobs_abs = mp.cpu_count()-4
 	n_jobs_rel = round(mp.cpu_count()/2)
 	n_jobs = max([n_jobs_abs,n_jobs_rel,1])
 
-	ts_list = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(ts),
+	ts_list = parallel_map(ts,
 		img_paths,
 		[mask]*len(img_paths),
 		[False]*len(img_paths),
 		[top_voxel]*len(img_paths),
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(i) for i in img_paths],
+		memory_budget=memory_budget,
+		)
 	if metric == 'mean':
 		ts_list = [i[0] for i in ts_list]
 	elif metric == 'median':
@@ -232,6 +243,8 @@ def per_session(substitutions, roi_mask,
 	feature=[],
 	atlas='',
 	mapping='',
+	backend='threading',
+	memory_budget=None,
 	):
 
 	"""
@@ -246,17 +259,22 @@ def per_session(substitutions, roi_mask,
 		roi_mask = path.abspath(path.expanduser(roi_mask))
 		roi_mask = nib.load(roi_mask)
 
-	masker = NiftiMasker(mask_img=roi_mask)
+	# The ROI voxels are indexed only once for all substitutions.
+	masker = roi_index([roi_mask])
 
-	n_jobs = mp.cpu_count()-2
-	dfs = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(roi_df),
+	n_jobs = max(mp.cpu_count()-2,1)
+	dfs = parallel_map(roi_df,
 		[filename_template]*len(substitutions),
 		[masker]*len(substitutions),
 		substitutions,
 		feature*len(substitutions),
 		[atlas]*len(substitutions),
 		[mapping]*len(substitutions),
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(filename_template, i) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 	df = pd.concat(dfs)
 
 	return df
@@ -276,6 +294,32 @@ def mean(img_path, mask_path):
 		masker = NiftiMasker(mask_img=mask)
 		roi_df(img_path,masker)
 
+@lru_cache(maxsize=8)
+def _cached_atlas_index(atlas_filename, mtime, null_label, grid):
+	atlas = nib.load(atlas_filename)
+	if grid:
+		from nibabel import processing
+		shape, affine = grid
+		atlas = processing.resample_from_to(atlas, (shape, np.array(affine)), order=0)
+	return roi_index(atlas, null_label=null_label)
+
+def _atlas_index(atlas_filename, null_label,
+	grid=None,
+	):
+	"""Return the (cached) ROI index of an atlas file, optionally resampled to a `(shape, affine)` grid.
+	"""
+	mtime = os.stat(atlas_filename).st_mtime_ns
+	if grid:
+		grid = (tuple(grid[0]), tuple(map(tuple, grid[1])))
+	return _cached_atlas_index(atlas_filename, mtime, null_label, grid)
+
+def _zero_fraction_exceeded(values, exact_zero_threshold):
+	if not exact_zero_threshold:
+		return False
+	if len(values) == 0:
+		return True
+	return exact_zero_threshold <= np.count_nonzero(values == 0.0)/float(len(values))
+
 def atlasassignment(data_path='~/ni_data/ofM.dr/bids/l2/anova/anova_zfstat.nii.gz',
 	null_label=0.0,
 	value_label='values',
@@ -283,14 +327,18 @@ def atlasassignment(data_path='~/ni_data/ofM.dr/bids/l2/anova/anova_zfstat.nii.g
 	lateralized=False,
 	save_as='',
 	exact_zero_threshold=0.34,
+	atlas='/usr/share/mouse-brain-templates/dsurqec_40micron_labels.nii',
+	mapping='/usr/share/mouse-brain-templates/dsurqe_labels.csv',
+	resample_atlas=False,
 	):
 	"""
 	Create CSV file containing a tabular summary of mean image intensity per DSURQE region of interest.
 
 	Parameters
 	----------
-	data_path : str
+	data_path : str or list of str
 		Path to data file, the values of which are to be indexed according to the DSURQEC atlas.
+		If a list of paths is given, the atlas is indexed only once, and the per-file tables are concatenated, with the file path recorded in a 'path' column.
 	null_label : float, optional
 		Values of the atlas which to exclude a priori.
 	value_label : string, options
@@ -298,9 +346,17 @@ def atlasassignment(data_path='~/ni_data/ofM.dr/bids/l2/anova/anova_zfstat.nii.g
 	verbose : bool, optional
 		Whether to print output regarding the processing (activates warnings if the data is reformatted, as well as reports for each value).
 	lateralized : bool , optional
-		Whether to differentiate between left and right labels (currently unimplemented).
+		Whether to differentiate between left and right labels.
 	save_as : str, optional
 		Path under which to save the atlas assignment file.
+	exact_zero_threshold : float, optional
+		Fraction of exact zero values above which a structure is considered not covered by the data, and excluded from the output.
+	atlas : str, optional
+		Path to the atlas file.
+	mapping : str or pandas.DataFrame, optional
+		Path to the CSV file (or corresponding DataFrame) mapping the atlas labels to structure names.
+	resample_atlas : bool, optional
+		Whether, if data and atlas are not on the same grid, the atlas should be resampled to the data grid (once per distinct grid), rather than the data to the atlas grid (once per file).
 
 	Returns
 	-------
@@ -308,40 +364,87 @@ def atlasassignment(data_path='~/ni_data/ofM.dr/bids/l2/anova/anova_zfstat.nii.g
 		Pandas Dataframe with columns including 'Structure', and 'right values', 'left values', or simply 'values'.
 	"""
 
+	atlas_filename = path.abspath(path.expanduser(atlas))
+	if isinstance(mapping, str):
+		mapping = path.abspath(path.expanduser(mapping))
+		mapping = pd.read_csv(mapping)
+
+	if isinstance(data_path, (list, tuple)):
+		results = []
+		for i in data_path:
+			result = atlasassignment(i,
+				null_label=null_label,
+				value_label=value_label,
+				verbose=verbose,
+				lateralized=lateralized,
+				exact_zero_threshold=exact_zero_threshold,
+				atlas=atlas_filename,
+				mapping=mapping,
+				resample_atlas=resample_atlas,
+				)
+			result['path'] = path.abspath(path.expanduser(i))
+			results.append(result)
+		results = pd.concat(results, ignore_index=True)
+	else:
+		data_path = path.abspath(path.expanduser(data_path))
+		data = nib.load(data_path)
+		index = _atlas_index(atlas_filename, null_label)
+		if not index.matches(data):
+			if verbose:
+				print(data.affine,'\n',index.affine)
+				print(np.shape(data),'\n',index.shape)
+				print('The affines of these atlas and data file are not identical. In order to perform this sensitive operation we need to know that there is perfect correspondence between the voxels of input data and atlas. Attempting to recast affines.')
+			if resample_atlas:
+				index = _atlas_index(atlas_filename, null_label,
+					grid=(data.shape[:3], data.affine),
+					)
+			else:
+				from nibabel import processing
+				data = processing.resample_from_to(data, (index.shape, index.affine), order=0)
+			if verbose:
+				print(data.affine,'\n',index.affine)
+				print(np.shape(data),'\n',index.shape)
+		data = np.asanyarray(data.dataobj).ravel()
+		results = _atlasassignment_table(data, index, mapping,
+			value_label=value_label,
+			lateralized=lateralized,
+			exact_zero_threshold=exact_zero_threshold,
+			)
+
+	if save_as:
+		save_path = path.dirname(save_as)
+		if save_path and not path.exists(save_path):
+			os.makedirs(save_path)
+		results.to_csv(save_as)
+	return results
+
+def _atlasassignment_table(data, index, mapping,
+	value_label='values',
+	lateralized=False,
+	exact_zero_threshold=0.34,
+	):
+	"""Assign the values of a flattened data array (on the grid of the atlas `index`) to the structures in `mapping`, in one pass over all atlas labels.
+	"""
+
 	from copy import deepcopy
 
-	atlas_filename = '/usr/share/mouse-brain-templates/dsurqec_40micron_labels.nii'
-	mapping = '/usr/share/mouse-brain-templates/dsurqe_labels.csv'
-	atlas_filename = path.abspath(path.expanduser(atlas_filename))
-	mapping = path.abspath(path.expanduser(mapping))
-	data_path = path.abspath(path.expanduser(data_path))
+	# Single pass: gather the values of all labels, ordered by label, then by voxel position.
+	boundaries = np.cumsum(index.counts)[:-1]
+	positions = dict(zip(index.features, np.split(index.indices, boundaries)))
+	values = dict(zip(index.features, np.split(data[index.indices], boundaries)))
+	empty = np.array([], dtype=data.dtype)
+
+	def label_values(labels):
+		labels = list(dict.fromkeys(labels))
+		if len(labels) == 1:
+			return values.get(labels[0], empty)
+		label_positions = np.concatenate([positions.get(i, empty.astype(int)) for i in labels])
+		label_values = np.concatenate([values.get(i, empty) for i in labels])
+		return label_values[np.argsort(label_positions, kind='stable')]
+
+	def to_string(label_values):
+		return ', '.join([str(i) for i in list(label_values)])
 
-	data = nib.load(data_path)
-	atlas = nib.load(atlas_filename)
-	voxels_ratio = 1
-	if not np.array_equal(data.affine,atlas.affine):
-		voxels_data = np.prod(np.shape(data))
-		voxels_atlas = np.prod(np.shape(atlas))
-		voxels_ratio = np.min([np.floor(voxels_atlas / voxels_data),1])
-		if verbose:
-			print(data.affine,'\n',atlas.affine)
-			print(np.shape(data),'\n',np.shape(atlas))
-			print('The affines of these atlas and data file are not identical. In order to perform this sensitive operation we need to know that there is perfect correspondence between the voxels of input data and atlas. Attempting to recast affines.')
-		from nibabel import processing
-		data = processing.resample_from_to(data, atlas, order=0)
-		if verbose:
-			print(data.affine,'\n',atlas.affine)
-			print(np.shape(data),'\n',np.shape(atlas))
-		reshaped = True
-	else:
-		reshaped = False
-	mapping = pd.read_csv(mapping)
-	atlas = atlas.get_data().flatten()
-	data = data.get_data().flatten()
-	nonull_map = atlas != null_label
-	atlas = atlas[nonull_map]
-	data = data[nonull_map]
-	structures = mapping['Structure'].unique()
 	results = deepcopy(mapping)
 	results[value_label] = ''
 	if lateralized:
@@ -351,65 +454,34 @@ def atlasassignment(data_path='~/ni_data/ofM.dr/bids/l2/anova/anova_zfstat.nii.g
 		results_right = deepcopy(results_left)
 		results_right['Side'] = 'right'
 		results_left['Side'] = 'left'
-	for structure in structures:
-		right_label = mapping[mapping['Structure'] == structure]['right label'].item()
-		left_label = mapping[mapping['Structure'] == structure]['left label'].item()
+	for structure, right_label, left_label in mapping[['Structure', 'right label', 'left label']].itertuples(index=False):
 		if lateralized:
 			if right_label == left_label:
-				mask = atlas == right_label
-				values = data[mask]
-				if voxels_ratio != 1:
-					values = values[::voxels_ratio]
-				if exact_zero_threshold:
-					val_number = len(values)
-					zeroes = len(values[values==0.0])
-					if exact_zero_threshold <= zeroes/float(val_number):
-						continue
-				values = ', '.join([str(i) for i in list(values)])
-				results_medial.loc[results['Structure'] == structure, value_label] = values
+				medial_values = label_values([right_label])
+				if _zero_fraction_exceeded(medial_values, exact_zero_threshold):
+					continue
+				results_medial.loc[results_medial['Structure'] == structure, value_label] = to_string(medial_values)
 			else:
-				right_mask = atlas == right_label
-				left_mask = atlas == left_label
-				right_values = data[right_mask]
-				left_values = data[left_mask]
-				if voxels_ratio != 1:
-					right_values = right_values[::voxels_ratio]
-					left_values = left_values[::voxels_ratio]
-				if exact_zero_threshold:
-					val_number = len(right_values) + len(left_values)
-					zeroes = len(right_values[right_values==0.0]) + len(right_values[right_values==0.0])
-					if exact_zero_threshold <= zeroes/float(val_number):
-						continue
-				right_values = ', '.join([str(i) for i in list(right_values)])
-				left_values = ', '.join([str(i) for i in list(left_values)])
-				results_right.loc[results['Structure'] == structure, value_label] = right_values
-				results_left.loc[results['Structure'] == structure, value_label] = left_values
-		else:
-			labels = [right_label, left_label]
-			mask = np.isin(atlas, labels)
-			values = data[mask]
-			if voxels_ratio != 1:
-				values = values[::voxels_ratio]
-			if exact_zero_threshold:
-				val_number = len(values)
-				zeroes = len(values[values==0.0])
-				if exact_zero_threshold <= zeroes/float(val_number):
+				right_values = label_values([right_label])
+				left_values = label_values([left_label])
+				if _zero_fraction_exceeded(np.concatenate([right_values, left_values]), exact_zero_threshold):
 					continue
-			values = list(values)
-			values = ', '.join([str(i) for i in values])
-			results.loc[results['Structure'] == structure, value_label] = values
+				results_right.loc[results_right['Structure'] == structure, value_label] = to_string(right_values)
+				results_left.loc[results_left['Structure'] == structure, value_label] = to_string(left_values)
+		else:
+			structure_values = label_values([right_label, left_label])
+			if _zero_fraction_exceeded(structure_values, exact_zero_threshold):
+				continue
+			results.loc[results['Structure'] == structure, value_label] = to_string(structure_values)
 	if lateralized:
 		results = pd.concat([results_left, results_medial, results_right], ignore_index=True)
 	results = results.loc[results[value_label] != '']
-	if save_as:
-		save_path = path.dirname(save_as)
-		if save_path and not path.exists(save_path):
-			os.makedirs(save_path)
-		results.to_csv(save_as)
 	return results
 
 def analytic_pattern_per_session(substitutions, analytic_pattern,
 	t_file_template="~/ni_data/ofM.dr/l1/{l1_dir}/sub-{subject}/ses-{session}/sub-{subject}_ses-{session}_task-{scan}_tstat.nii.gz",
+	backend='threading',
+	memory_budget=None,
 	):
 	"""Return a Pandas DataFrame (organized in long-format) containing the per-subject per-session scores of an analytic pattern.
 
@@ -423,18 +495,26 @@ def analytic_pattern_per_session(substitutions, analytic_pattern,
 		Commonly this file is unthresholded.
 	t_file_template : str, optional
 		A formattable string containing as format fields keys present in the dictionaries passed to the `substitutions` variable.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 	"""
 
 	if isinstance(analytic_pattern,str):
 		analytic_pattern = path.abspath(path.expanduser(analytic_pattern))
 	pattern = nib.load(analytic_pattern)
 
-	n_jobs = mp.cpu_count()-2
-	dfs = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(pattern_df),
+	n_jobs = max(mp.cpu_count()-2,1)
+	dfs = parallel_map(pattern_df,
 		[t_file_template]*len(substitutions),
 		[pattern]*len(substitutions),
 		substitutions,
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(t_file_template, i) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 	df = pd.concat(dfs)
 
 	return df
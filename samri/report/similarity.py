@@ -0,0 +1,226 @@
+import numpy as np
+from os import path
+from samri.report import cache
+
+METRICS = ('CC', 'MI', 'Mattes', 'MeanSquares', 'GC')
+SAMPLING_STRATEGIES = ('None', 'Regular', 'Random')
+
+def _load_volume(img):
+	"""Return a 3D image object, averaging 4D images over time."""
+	if isinstance(img, str):
+		img = cache.load(path.abspath(path.expanduser(img)))
+	if len(img.shape) > 3:
+		import nibabel as nib
+		data = np.asanyarray(img.dataobj).reshape(img.shape[:3]+(-1,)).mean(axis=-1)
+		img = nib.Nifti1Image(data, img.affine)
+	return img
+
+def _cubic_bspline(x):
+	x = np.abs(x)
+	return np.where(x < 1, (4. - 6.*x**2 + 3.*x**3)/6., np.where(x < 2, (2. - x)**3/6., 0.))
+
+def _mutual_information(joint):
+	"""Return the mutual information of a (not necessarily normalized) joint histogram."""
+	joint = joint/joint.sum()
+	fixed_pdf = joint.sum(axis=1)
+	moving_pdf = joint.sum(axis=0)
+	nonzero = joint > 1e-16
+	outer = np.outer(fixed_pdf, moving_pdf)
+	return np.sum(joint[nonzero]*np.log(joint[nonzero]/outer[nonzero]))
+
+def mattes(fixed, moving,
+	bins=32,
+	):
+	"""
+	Negative Mattes mutual information of two sets of corresponding samples, following the ITK v4 implementation: fixed values are binned with a zero-order, and moving values with a cubic B-spline Parzen window, with two padding bins at either end of the histogram.
+	"""
+	padding = 2
+	joint = np.zeros((bins, bins))
+	fixed_bin_size = max(fixed.max() - fixed.min(), np.finfo(float).tiny)/(bins - 2*padding)
+	moving_bin_size = max(moving.max() - moving.min(), np.finfo(float).tiny)/(bins - 2*padding)
+	fixed_index = np.floor((fixed - fixed.min())/fixed_bin_size + padding).astype(int)
+	fixed_index = np.clip(fixed_index, padding, bins - padding - 1)
+	moving_term = (moving - moving.min())/moving_bin_size + padding
+	moving_index = np.clip(np.floor(moving_term).astype(int), padding, bins - padding - 1)
+	for offset in (-1, 0, 1, 2):
+		index = moving_index + offset
+		np.add.at(joint, (fixed_index, index), _cubic_bspline(index - moving_term))
+	return -_mutual_information(joint)
+
+def joint_histogram_mi(fixed, moving,
+	bins=32,
+	variance=1.5,
+	):
+	"""
+	Negative mutual information of two sets of corresponding samples, based on a Gaussian-smoothed joint histogram of the intensities normalized to [0,1] (as in the ITK v4 `JointHistogramMutualInformation` metric).
+	"""
+	from scipy import ndimage
+
+	fixed = (fixed - fixed.min())/max(fixed.max() - fixed.min(), np.finfo(float).tiny)
+	moving = (moving - moving.min())/max(moving.max() - moving.min(), np.finfo(float).tiny)
+	joint, _, _ = np.histogram2d(fixed, moving, bins=bins, range=[[0,1],[0,1]])
+	joint = ndimage.gaussian_filter(joint, np.sqrt(variance), mode='constant')
+	return -_mutual_information(joint)
+
+def mean_squares(fixed, moving):
+	"""Mean squared intensity difference of two sets of corresponding samples."""
+	return np.mean((fixed - moving)**2)
+
+def global_correlation(fixed, moving):
+	"""Negative squared Pearson correlation of two sets of corresponding samples (as in the ITK v4 `Correlation` metric)."""
+	fixed = fixed - fixed.mean()
+	moving = moving - moving.mean()
+	denominator = np.sum(fixed**2)*np.sum(moving**2)
+	if denominator <= 0:
+		return 0.
+	return -np.sum(fixed*moving)**2/denominator
+
+def neighborhood_cc(fixed, moving, points,
+	radius=4,
+	):
+	"""
+	Negative mean local squared correlation of two 3D arrays, computed in cubic windows of a given radius around each sampled point (as in the ITK v4 `ANTSNeighborhoodCorrelation` metric).
+
+	Parameters
+	----------
+
+	fixed, moving : numpy.ndarray
+		3D arrays on the same grid.
+	points : numpy.ndarray
+		Flat indices of the sampled points.
+	radius : int, optional
+		Window radius, in voxels.
+	"""
+	from scipy import ndimage
+
+	size = 2*int(radius) + 1
+	n = float(size**3)
+	def local_sum(data):
+		return ndimage.uniform_filter(data, size=size, mode='nearest').ravel()[points]*n
+	sum_f = local_sum(fixed)
+	sum_m = local_sum(moving)
+	s_ff = local_sum(fixed*fixed) - sum_f**2/n
+	s_mm = local_sum(moving*moving) - sum_m**2/n
+	s_fm = local_sum(fixed*moving) - sum_f*sum_m/n
+	denominator = s_ff*s_mm
+	valid = denominator > 1e-5
+	cc = np.zeros(len(points))
+	cc[valid] = s_fm[valid]**2/denominator[valid]
+	return -cc.mean()
+
+def sample_points(shape,
+	mask=None,
+	sampling_strategy='None',
+	sampling_percentage=0.3,
+	random_state=None,
+	):
+	"""
+	Return the flat indices of the points at which a metric is evaluated.
+
+	Parameters
+	----------
+
+	shape : tuple
+		Shape of the fixed image grid.
+	mask : numpy.ndarray, optional
+		Fixed image mask; only nonzero voxels are sampled.
+	sampling_strategy : {'None', 'Regular', 'Random'}
+		Whether to use all points, every n-th point (given the sampling percentage), or a random subset of points.
+	sampling_percentage : float, optional
+		Fraction of points to sample for the 'Regular' and 'Random' strategies.
+	random_state : int or numpy.random.Generator, optional
+		Seed or generator for the 'Random' strategy.
+	"""
+	if mask is None:
+		points = np.arange(np.prod(shape))
+	else:
+		points = np.flatnonzero(mask)
+	if sampling_strategy == 'None':
+		return points
+	elif sampling_strategy == 'Regular':
+		step = max(int(round(1./sampling_percentage)), 1)
+		return points[::step]
+	elif sampling_strategy == 'Random':
+		rng = np.random.default_rng(random_state)
+		n = max(int(round(len(points)*sampling_percentage)), 1)
+		return np.sort(rng.choice(points, size=n, replace=False))
+	raise ValueError("The `sampling_strategy` parameter must be one of: "+", ".join(SAMPLING_STRATEGIES)+".")
+
+def similarity(fixed, moving,
+	metric='MI',
+	radius_or_number_of_bins=8,
+	sampling_strategy='None',
+	sampling_percentage=0.3,
+	mask='',
+	random_state=None,
+	):
+	"""
+	Compute an image similarity metric in-process, with the same parameters and sign conventions as the ANTs `MeasureImageSimilarity` command.
+
+	Parameters
+	----------
+
+	fixed : str or nibabel.nifti1.Nifti1Image
+		Fixed image, 4D images are averaged over time.
+	moving : str or nibabel.nifti1.Nifti1Image
+		Moving image, 4D images are averaged over time.
+		If its grid differs from that of the fixed image, it is linearly resampled to it.
+	metric : {'CC', 'MI', 'Mattes', 'MeanSquares', 'GC'}
+		Similarity metric.
+	radius_or_number_of_bins : int, optional
+		Window radius for 'CC', or number of histogram bins for 'MI' and 'Mattes'.
+	sampling_strategy : {'None', 'Regular', 'Random'}
+		Point sampling strategy, see `samri.report.similarity.sample_points()`.
+	sampling_percentage : float, optional
+		Fraction of points to sample for the 'Regular' and 'Random' strategies.
+	mask : str or nibabel.nifti1.Nifti1Image, optional
+		Fixed image mask.
+	random_state : int or numpy.random.Generator, optional
+		Seed or generator for the 'Random' sampling strategy.
+
+	Returns
+	-------
+
+	float
+		Metric value; lower values indicate more similar images for all metrics.
+
+	Notes
+	-----
+	The histogram-based metrics reproduce the ITK binning and Parzen windowing, but not its floating point accumulation order, so small differences with respect to ANTs are expected.
+	Use `samri.report.registration.measure_sim(..., engine='numpy', validate=True)` to cross-check against ANTs.
+	"""
+
+	if metric not in METRICS:
+		raise ValueError("The `metric` parameter must be one of: "+", ".join(METRICS)+".")
+	fixed_img = _load_volume(fixed)
+	moving_img = _load_volume(moving)
+	if tuple(moving_img.shape) != tuple(fixed_img.shape) or not np.allclose(moving_img.affine, fixed_img.affine):
+		from nibabel import processing
+		moving_img = processing.resample_from_to(moving_img, fixed_img, order=1)
+	fixed_data = np.asanyarray(fixed_img.dataobj).astype(np.float64)
+	moving_data = np.asanyarray(moving_img.dataobj).astype(np.float64)
+	mask_data = None
+	if mask:
+		mask_img = _load_volume(mask)
+		if tuple(mask_img.shape) != tuple(fixed_img.shape) or not np.allclose(mask_img.affine, fixed_img.affine):
+			from nibabel import processing
+			mask_img = processing.resample_from_to(mask_img, fixed_img, order=0)
+		mask_data = np.asanyarray(mask_img.dataobj) != 0
+
+	points = sample_points(fixed_data.shape,
+		mask=mask_data,
+		sampling_strategy=sampling_strategy,
+		sampling_percentage=sampling_percentage,
+		random_state=random_state,
+		)
+	if metric == 'CC':
+		return float(neighborhood_cc(fixed_data, moving_data, points, radius=radius_or_number_of_bins))
+	fixed_values = fixed_data.ravel()[points]
+	moving_values = moving_data.ravel()[points]
+	if metric == 'MI':
+		return float(joint_histogram_mi(fixed_values, moving_values, bins=radius_or_number_of_bins))
+	elif metric == 'Mattes':
+		return float(mattes(fixed_values, moving_values, bins=radius_or_number_of_bins))
+	elif metric == 'MeanSquares':
+		return float(mean_squares(fixed_values, moving_values))
+	return float(global_correlation(fixed_values, moving_values))
@@ -1,13 +1,14 @@
 import nibabel as nib
 import numpy as np
 import pandas as pd
-import scipy.stats as sps
 import multiprocessing as mp
 from os import path
 from copy import deepcopy
-from joblib import Parallel, delayed
 from nilearn.input_data import NiftiMasker
 from samri.utilities import collapse
+from samri.report import cache
+from samri.report.execution import estimate_memory, parallel_map
+from samri.report.extraction import roi_index
 from samri.report.utilities import roi_data
 
 try:
@@ -23,6 +24,8 @@ def df_threshold_volume(df,
 	save_as='',
 	n_jobs=False,
 	n_jobs_percentage=0.8,
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Return a `pandas.DataFrame` (optionally saveable as `.csv`), containing the total volume of brain space exceeding a value.
@@ -46,6 +49,10 @@ def df_threshold_volume(df,
 	threshold_is_percentile : bool, optional
 		Whether `threshold` is to be interpreted not literally, but as a percentile of the data matrix.
 		This is useful for making sure that the volume estimation is not susceptible to the absolute value range, but only the value distribution.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -76,17 +83,20 @@ def df_threshold_volume(df,
 		inverted_data_mask = [True]*iter_length
 	else:
 		inverted_data_mask = [False]*iter_length
-	# This is an easy jop CPU-wise, but not memory-wise.
-	if not n_jobs:
-		n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	iter_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(threshold_volume),
+	# This is an easy job CPU-wise, but not memory-wise, so concurrency is also bounded by the memory estimates.
+	iter_data = parallel_map(threshold_volume,
 		in_files,
 		[None]*iter_length,
 		[masker]*iter_length,
 		thresholds,
 		[threshold_is_percentile]*iter_length,
 		inverted_data_mask,
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		n_jobs_percentage=n_jobs_percentage,
+		memory_estimates=[estimate_memory(i) for i in in_files],
+		memory_budget=memory_budget,
+		)
 	df['Thresholded Volume'] = iter_data
 
 	if save_as:
@@ -103,6 +113,8 @@ def iter_threshold_volume(file_template, substitutions,
 	threshold_is_percentile=True,
 	invert_data=False,
 	save_as='',
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Return a `pandas.DataFrame` (optionally saveable as `.csv`), containing the total volume of brain space exceeding a value.
@@ -125,6 +137,10 @@ def iter_threshold_volume(file_template, substitutions,
 		This is useful for making sure that the volume estimation is not susceptible to the absolute value range, but only the value distribution.
 	save_as : str, optional
 		Path to which to save the Pandas DataFrame.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -133,14 +149,18 @@ def iter_threshold_volume(file_template, substitutions,
 		Pandas DataFrame object containing a row for each analyzed file and columns named 'Mean', 'Median', and (provided the respective key is present in the `sustitutions` variable) 'subject', 'session', 'task', and 'acquisition'.
 	"""
 
-	n_jobs = mp.cpu_count()-2
-	iter_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(threshold_volume),
+	n_jobs = max(mp.cpu_count()-2,1)
+	iter_data = parallel_map(threshold_volume,
 		[file_template]*len(substitutions),
 		substitutions,
 		[mask_path]*len(substitutions),
 		[threshold]*len(substitutions),
 		[threshold_is_percentile]*len(substitutions),
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(file_template, i) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 
 	df_items = [
 		('Volume', [i[1] for i in iter_data]),
@@ -195,7 +215,7 @@ def threshold_volume(in_file,
 		in_file = in_file.format(**substitution)
 	in_file = path.abspath(path.expanduser(in_file))
 	try:
-		img = nib.load(in_file)
+		img = cache.load(in_file)
 	except FileNotFoundError:
 		return float('NaN')
 
@@ -253,7 +273,7 @@ def significant_signal(data_path,
 		data_path = data_path.format(**substitution)
 	data_path = path.abspath(path.expanduser(data_path))
 	try:
-		img = nib.load(data_path)
+		img = cache.load(data_path)
 	except FileNotFoundError:
 		return float('NaN'), float('NaN')
 	if mask_path:
@@ -288,6 +308,8 @@ def iter_significant_signal(file_template, substitutions,
 	mask_path='',
 	save_as='',
 	exclude_ones=False,
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Create a `pandas.DataFrame` (optionally saveable as `.csv`), containing the means and medians of a number of p-value maps specified by a file template supporting substitution and a substitution list of dictionaries.
@@ -304,6 +326,10 @@ def iter_significant_signal(file_template, substitutions,
 		Path to a mask in the same coordinate space as the p-value maps.
 	save_as : str, optional
 		Path to which to save the Pandas DataFrame.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -312,13 +338,17 @@ def iter_significant_signal(file_template, substitutions,
 		Pandas DataFrame object containing a row for each analyzed file and columns named 'Mean', 'Median', and (provided the respective key is present in the `sustitutions` variable) 'subject', 'session', 'task', and 'acquisition'.
 	"""
 
-	n_jobs = mp.cpu_count()-2
-	iter_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(significant_signal),
+	n_jobs = max(mp.cpu_count()-2,1)
+	iter_data = parallel_map(significant_signal,
 		[file_template]*len(substitutions),
 		substitutions,
 		[mask_path]*len(substitutions),
 		[exclude_ones]*len(substitutions),
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[estimate_memory(file_template, i) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 
 	df_items = [
 		('Mean', [i[0] for i in iter_data]),
@@ -346,6 +376,8 @@ def df_significant_signal(df,
 	n_jobs_percentage=0.8,
 	column_string='Significance',
 	path_column='path',
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Create a `pandas.DataFrame` (optionally saveable as `.csv`), containing the means and medians of a number of p-value maps specified by a file template supporting substitution and a substitution list of dictionaries.
@@ -364,6 +396,10 @@ def df_significant_signal(df,
 		String to append after 'Mean' and 'Median' to construct the name of the mean and median columns.
 	path_column : str, optional
 		Column name which identifies the path of the data to analyze.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -378,15 +414,18 @@ def df_significant_signal(df,
 	in_files = df[path_column].tolist()
 	iter_length = len(in_files)
 
-	# This is an easy jop CPU-wise, but not memory-wise.
-	if not n_jobs:
-		n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	iter_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(significant_signal),
+	# This is an easy job CPU-wise, but not memory-wise, so concurrency is also bounded by the memory estimates.
+	iter_data = parallel_map(significant_signal,
 		in_files,
 		[None]*iter_length,
 		[mask_path]*iter_length,
 		[exclude_ones]*iter_length,
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		n_jobs_percentage=n_jobs_percentage,
+		memory_estimates=[estimate_memory(i) for i in in_files],
+		memory_budget=memory_budget,
+		)
 	df['Mean '+column_string] = [i[0] for i in iter_data]
 	df['Median '+column_string] = [i[1] for i in iter_data]
 
@@ -407,6 +446,8 @@ def df_roi_data(df,
 	exclude_zero=False,
 	path_column='path',
 	zero_threshold=0.1,
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Create a `pandas.DataFrame` (optionally saveable as `.csv`), containing new means and medians columns of the values located within a roi in the files specified by the path column of an input DataFrame.
@@ -429,6 +470,10 @@ def df_roi_data(df,
 		Column name which identifies the path of the data to analyze.
 		zero_threshold : float, optional
 		Absolute value below which values are to be considered zero.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -443,21 +488,24 @@ def df_roi_data(df,
 	in_files = df[path_column].tolist()
 	iter_length = len(in_files)
 
-	# Convert mask path to masker
+	# Index the mask voxels once for all files
 	if isinstance(mask_path, str):
 		mask_path = path.abspath(path.expanduser(mask_path))
-	mask = NiftiMasker(mask_img=mask_path)
+	mask = roi_index([mask_path])
 
-	# This is an easy jop CPU-wise, but not memory-wise.
-	if not n_jobs:
-		n_jobs = max(int(round(mp.cpu_count()*n_jobs_percentage)),2)
-	iter_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(roi_data),
+	# This is an easy job CPU-wise, but not memory-wise, so concurrency is also bounded by the memory estimates.
+	iter_data = parallel_map(roi_data,
 		in_files,
 		[mask]*iter_length,
 		[None]*iter_length,
 		[exclude_zero]*iter_length,
 		[zero_threshold]*iter_length,
-		))
+		backend=backend,
+		n_jobs=n_jobs,
+		n_jobs_percentage=n_jobs_percentage,
+		memory_estimates=[estimate_memory(i) for i in in_files],
+		memory_budget=memory_budget,
+		)
 	df['Mean '+column_string] = [i[0] for i in iter_data]
 	df['Median '+column_string] = [i[1] for i in iter_data]
 
@@ -469,10 +517,45 @@ def df_roi_data(df,
 			raise ValueError("Please specify an output path ending in any one of "+",".join((".csv",))+".")
 	return df
 
+def _volume_modes(data):
+	"""Return the smallest most frequent value of each column of a 2D (voxels × volumes) array.
+	"""
+	n_voxels, n_volumes = data.shape
+	if np.issubdtype(data.dtype, np.integer) or np.array_equal(data, np.round(data)):
+		# Integer-valued data: a single bincount over all volumes, with per-volume bin offsets.
+		# Offsets are computed in int64, as differences may not fit into the input dtype.
+		minimum = int(data.min())
+		span = int(data.max()) - minimum + 1
+		if span*n_volumes <= 2**26:
+			bins = data.astype(np.int64) - minimum + np.arange(n_volumes)*span
+			counts = np.bincount(bins.ravel(), minlength=span*n_volumes).reshape((n_volumes, span))
+			return np.argmax(counts, axis=1) + minimum
+	sorted_data = np.sort(data, axis=0)
+	new_run = np.ones(sorted_data.shape, dtype=bool)
+	new_run[1:] = sorted_data[1:] != sorted_data[:-1]
+	runs = np.cumsum(new_run, axis=0) - 1
+	counts = np.bincount((runs + np.arange(n_volumes)*n_voxels).ravel(), minlength=n_voxels*n_volumes)
+	mode_runs = np.argmax(counts.reshape((n_volumes, n_voxels)), axis=1)
+	first = np.argmax(runs == mode_runs, axis=0)
+	return sorted_data[first, np.arange(n_volumes)]
+
+def _chunk_memory(file_template, substitution, chunk_size):
+	"""Estimate the memory (in bytes) needed by `samri.report.snr.base_metrics()`, which holds at most `chunk_size` volumes at a time."""
+	estimate = estimate_memory(file_template, substitution)
+	try:
+		shape = nib.load(path.abspath(path.expanduser(file_template.format(**substitution)))).shape
+	except (FileNotFoundError, nib.filebasedimages.ImageFileError):
+		return estimate
+	if len(shape) > 3 and shape[3] > chunk_size:
+		estimate = estimate*chunk_size//shape[3]
+	return estimate
+
 def base_metrics(file_path,
 	substitution={},
+	chunk_size=16,
 	):
 	"""Return base metrics (mean, median, mode, standard deviation) at each 4th dimension point of a 4D NIfTI file.
+	The image is streamed in chunks of volumes, so that peak memory usage is bounded by `chunk_size` rather than by the length of the time series.
 
 	Parameters
 	----------
@@ -482,6 +565,8 @@ def base_metrics(file_path,
 		This string may contain format fields present as keys in the `substitution` dictionary.
 	substitution : dict, optional
 		A dictionary containing formatting strings as keys and strings as values.
+	chunk_size : int, optional
+		Number of volumes to read and reduce at a time.
 
 	Returns
 	-------
@@ -490,35 +575,42 @@ def base_metrics(file_path,
 		Pandas DataFrame object containing a row for each analyzed file and columns named 'Mean', 'Median', 'Mode', and 'Standard Deviation', and (provided the respective key is present in the `sustitution` variable) 'subject', 'session', 'task', and 'acquisition'.
 	"""
 
-
 	if substitution:
 		file_path = file_path.format(**substitution)
 	file_path = path.abspath(path.expanduser(file_path))
-	file_path = path.abspath(path.expanduser(file_path))
-	data = nib.load(file_path).get_data()
-	data = data.T
+	# Keeping the file open allows sequential chunked reads of compressed files without re-decompressing from the start.
+	img = nib.load(file_path, keep_file_open=True)
+	if len(img.shape) > 3:
+		n_volumes = img.shape[3]
+	else:
+		n_volumes = 1
 
 	stds = []
 	means = []
 	medians = []
 	modes = []
-	for i in data:
-		i_std = np.std(i)
-		stds.append(i_std)
-		i_mean = np.mean(i)
-		means.append(i_mean)
-		i_median = np.median(i)
-		medians.append(i_median)
-		i_mode,_ = sps.mode(i, axis=None)
-		modes.append(i_mode[0])
-
-	df_items = [
-		('Mean', means),
-		('Median', medians),
-		('Mode', modes),
-		('Standard Deviation', stds),
-		]
-	df = pd.DataFrame.from_items(df_items)
+	for start in range(0, n_volumes, chunk_size):
+		stop = min(start+chunk_size, n_volumes)
+		if len(img.shape) > 3:
+			data = np.asanyarray(img.dataobj[..., start:stop])
+		else:
+			data = np.asanyarray(img.dataobj)
+		data = data.reshape((-1, stop-start))
+		n_voxels = data.shape[0]
+		means.extend(np.mean(data, axis=0, dtype=np.float64))
+		stds.extend(np.std(data, axis=0, dtype=np.float64))
+		lower = (n_voxels-1)//2
+		upper = n_voxels//2
+		partitioned = np.partition(data, [lower, upper], axis=0)
+		medians.extend((partitioned[lower].astype(np.float64) + partitioned[upper])/2.)
+		modes.extend(_volume_modes(data))
+
+	df = pd.DataFrame({
+		'Mean':means,
+		'Median':medians,
+		'Mode':modes,
+		'Standard Deviation':stds,
+		})
 	for field in ['subject','session','task','acquisition']:
 		try:
 			df[field] = substitution[field]
@@ -528,6 +620,9 @@ def base_metrics(file_path,
 
 def iter_base_metrics(file_template, substitutions,
 	save_as='',
+	chunk_size=16,
+	backend='threading',
+	memory_budget=None,
 	):
 	"""
 	Create a `pandas.DataFrame` (optionally saveable as `.csv`), containing base metrics (mean, median, mode, standard deviation) at each 4th dimension point of a 4D NIfTI file.
@@ -542,6 +637,12 @@ def iter_base_metrics(file_template, substitutions,
 		A list of dictionaries countaining formatting strings as keys and strings as values.
 	save_as : str, optional
 		Path to which to save the Pandas DataFrame.
+	chunk_size : int, optional
+		Number of volumes to read and reduce at a time, per file.
+	backend : {'threading', 'multiprocessing', 'loky'}, optional
+		Execution backend, as accepted by `samri.report.execution.parallel_map()`.
+	memory_budget : float or bool, optional
+		Total memory (in GB) which concurrently processed files may occupy, as accepted by `samri.report.execution.parallel_map()`.
 
 	Returns
 	-------
@@ -550,11 +651,16 @@ def iter_base_metrics(file_template, substitutions,
 		Pandas DataFrame object containing a row for each analyzed file and columns named 'Mean', 'Median', 'Mode', and 'Standard Deviation', and (provided the respective key is present in the `sustitutions` variable) 'subject', 'session', 'task', and 'acquisition'.
 	"""
 
-	n_jobs = mp.cpu_count()-2
-	base_metrics_data = Parallel(n_jobs=n_jobs, verbose=0, backend="threading")(map(delayed(base_metrics),
+	n_jobs = max(mp.cpu_count()-2,1)
+	base_metrics_data = parallel_map(base_metrics,
 		[file_template]*len(substitutions),
 		substitutions,
-		))
+		[chunk_size]*len(substitutions),
+		backend=backend,
+		n_jobs=n_jobs,
+		memory_estimates=[_chunk_memory(file_template, i, chunk_size) for i in substitutions],
+		memory_budget=memory_budget,
+		)
 
 	df = pd.concat(base_metrics_data)
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+from os import path
+
+def _write_image(file_path, shape=(10,10,10), value=1.):
+	data = np.full(shape, value, dtype=np.float32)
+	nib.save(nib.Nifti1Image(data, np.eye(4)), file_path)
+	return str(file_path)
+
+def test_image_cache(tmp_path):
+	from samri.report.cache import ImageCache
+
+	image_cache = ImageCache(limit_mb=1)
+	img_path = _write_image(tmp_path/'img.nii.gz')
+
+	data, _, _, _ = image_cache.get(img_path)
+	assert not data.flags.writeable
+	data_, _, _, _ = image_cache.get(img_path)
+	assert data_ is data
+	assert image_cache.info()['hits'] == 1
+	assert image_cache.info()['misses'] == 1
+
+	data_, _, _, _ = image_cache.get(img_path, dtype='float64')
+	assert data_.dtype == np.float64
+	assert image_cache.info()['entries'] == 2
+
+def test_image_cache_eviction(tmp_path):
+	from samri.report.cache import ImageCache
+
+	# Each image is 64**3*4 bytes, i.e. 1 MB.
+	image_cache = ImageCache(limit_mb=2.5)
+	img_paths = [_write_image(tmp_path/'img{}.nii'.format(i), shape=(64,64,64)) for i in range(3)]
+	for img_path in img_paths:
+		image_cache.get(img_path)
+	assert image_cache.info()['entries'] == 2
+	image_cache.get(img_paths[0])
+	assert image_cache.info()['misses'] == 4
+
+def test_file_hash(tmp_path):
+	from samri.report.cache import file_hash
+	from samri.report.registration import similarity_key
+
+	img_path = _write_image(tmp_path/'img.nii.gz')
+	same_path = _write_image(tmp_path/'same.nii.gz')
+	other_path = _write_image(tmp_path/'other.nii.gz', value=2.)
+
+	assert file_hash(img_path) == file_hash(same_path)
+	assert file_hash(img_path) != file_hash(other_path)
+	assert similarity_key(img_path, other_path) == similarity_key(same_path, other_path)
+	assert similarity_key(img_path, other_path) != similarity_key(img_path, other_path, metric='CC')
+	assert similarity_key(img_path, other_path, engine='numpy') != similarity_key(img_path, other_path, engine='numpy', random_state=1)
+
+def test_measure_sim_random_state(tmp_path):
+	import os
+	from samri.report.registration import measure_sim
+
+	rng = np.random.default_rng(0)
+	img_path = str(tmp_path/'img.nii.gz')
+	reference = str(tmp_path/'reference.nii.gz')
+	data = rng.random((10,10,10)).astype(np.float32)
+	nib.save(nib.Nifti1Image(data, np.eye(4)), reference)
+	nib.save(nib.Nifti1Image(data + rng.normal(scale=0.3, size=data.shape).astype(np.float32), np.eye(4)), img_path)
+	cache = str(tmp_path/'cache')
+
+	scores = [measure_sim(img_path, reference, sampling_strategy='Random', sampling_percentage=0.2, engine='numpy', cache=cache, random_state=i)['similarity'] for i in (0,1)]
+	assert scores[0] != scores[1]
+	assert measure_sim(img_path, reference, sampling_strategy='Random', sampling_percentage=0.2, engine='numpy', cache=False, random_state=1)['similarity'] == scores[1]
+	assert len(os.listdir(path.join(cache, 'scores'))) == 2
+
+	# Unseeded samples are not reproducible, and thus not cached.
+	measure_sim(img_path, reference, sampling_strategy='Random', sampling_percentage=0.2, engine='numpy', cache=cache, random_state=None)
+	assert len(os.listdir(path.join(cache, 'scores'))) == 2
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+
+def _delayed_square(x, delay):
+	time.sleep(delay)
+	return x**2
+
+def test_parallel_map_order():
+	from samri.report.execution import parallel_map
+
+	values = list(range(8))
+	delays = [0.04, 0.0, 0.03, 0.0, 0.02, 0.0, 0.01, 0.0]
+	for backend in ['threading', 'multiprocessing', 'loky']:
+		results = parallel_map(_delayed_square, values, delays,
+			backend=backend,
+			n_jobs=4,
+			)
+		assert results == [i**2 for i in values]
+
+def test_parallel_map_memory_budget():
+	import threading
+	from samri.report.execution import parallel_map
+
+	lock = threading.Lock()
+	state = {'running':0, 'peak':0}
+	def job(x):
+		with lock:
+			state['running'] += 1
+			state['peak'] = max(state['peak'], state['running'])
+		time.sleep(0.02)
+		with lock:
+			state['running'] -= 1
+		return x
+
+	# Budget of 1 GB, jobs of 0.4 GB, hence at most two jobs may run concurrently.
+	results = parallel_map(job, range(10),
+		n_jobs=8,
+		memory_estimates=[0.4*1024**3]*10,
+		memory_budget=1,
+		)
+	assert results == list(range(10))
+	assert state['peak'] == 2
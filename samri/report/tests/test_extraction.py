@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+
+def test_roi_stats():
+	from samri.report.extraction import roi_index, roi_stats
+
+	rng = np.random.RandomState(0)
+	atlas = rng.randint(0, 4, size=(8,9,10)).astype(np.int16)
+	data = rng.normal(size=(8,9,10))
+	data[0,0,:] = np.nan
+	atlas_img = nib.Nifti1Image(atlas, np.eye(4))
+	data_img = nib.Nifti1Image(data, np.eye(4))
+
+	index = roi_index(atlas_img)
+	assert index.features == [1,2,3]
+	assert np.array_equal(index.mask([1,3]), np.isin(atlas, [1,3]))
+	df = roi_stats(data_img, index)
+	for label, row in zip(index.features, df.itertuples()):
+		values = data[atlas == label]
+		values = values[~np.isnan(values)]
+		assert row.Count == len(values)
+		assert np.isclose(row.Mean, np.mean(values))
+		assert np.isclose(row.Median, np.median(values))
+		assert np.isclose(row[5], np.std(values))
+
+	# Overlapping mask stack
+	masks = [nib.Nifti1Image((atlas >= i).astype(np.int16), np.eye(4)) for i in (1,2)]
+	index = roi_index(masks)
+	df = roi_stats(data_img, index, exclude_zero=True, zero_threshold=0.5)
+	values = data[atlas >= 2]
+	values = values[np.abs(values) >= 0.5]
+	assert np.isclose(df['Median'].values[1], np.median(values))
+
+def test_roi_stats_resampled():
+	from nibabel import processing
+	from samri.report.extraction import roi_index, roi_stats
+
+	rng = np.random.RandomState(1)
+	atlas = np.zeros((8,9,10), dtype=np.int16)
+	atlas[1:5,2:7,3:8] = 1
+	atlas[4:7,1:5,2:6] = 2
+	atlas_img = nib.Nifti1Image(atlas, np.eye(4))
+	affine = np.diag([2.,2.,2.,1.])
+	affine[:3,3] = 0.5
+	data = rng.normal(size=(4,5,5,3))
+	data_img = nib.Nifti1Image(data, affine)
+
+	def masked(mask):
+		mask = processing.resample_from_to(nib.Nifti1Image(mask.astype(np.int16), np.eye(4)), (data.shape[:3], affine), order=0)
+		return data[np.asanyarray(mask.dataobj) > 0].ravel()
+
+	# The image values are pooled over all volumes within the ROIs resampled onto the image grid.
+	index = roi_index(atlas_img)
+	df = roi_stats(data_img, index)
+	for label, row in zip(index.features, df.itertuples()):
+		values = masked(atlas == label)
+		assert row.Count == len(values)
+		assert np.isclose(row.Mean, np.mean(values))
+		assert np.isclose(row.Median, np.median(values))
+	assert index.resampled(data.shape, affine) is index.resampled(data.shape, affine)
+
+	# Overlapping masks are resampled separately.
+	masks = [nib.Nifti1Image((atlas >= i).astype(np.int16), np.eye(4)) for i in (1,2)]
+	df = roi_stats(data_img, roi_index(masks))
+	for i, row in zip((1,2), df.itertuples()):
+		assert np.isclose(row.Mean, np.mean(masked(atlas >= i)))
@@ -42,6 +42,84 @@ def test_atlasassignment(tmp_path):
 		save_as=f'{tmp_path}/samri_testing/pytest/atlasassignment_lateralized.csv',
 		)
 
+def _synthetic_atlas(tmp_path):
+	import nibabel as nib
+	import pandas as pd
+
+	atlas = np.zeros((6,4,2), dtype=np.int16)
+	atlas[:3,:2] = 1
+	atlas[3:,:2] = 2
+	atlas[:,2:,0] = 3
+	atlas[:,2:,1] = 4
+	atlas_path = str(tmp_path/'atlas.nii.gz')
+	nib.save(nib.Nifti1Image(atlas, np.eye(4)), atlas_path)
+	mapping = pd.DataFrame({
+		'Structure':['lateral', 'medial', 'absent'],
+		'right label':[1, 3, 5],
+		'left label':[2, 3, 6],
+		})
+	mapping_path = str(tmp_path/'mapping.csv')
+	mapping.to_csv(mapping_path, index=False)
+	return atlas, atlas_path, mapping_path
+
+def _values(data, mask):
+	return ', '.join([str(i) for i in data.ravel()[mask.ravel()]])
+
+def test_atlasassignment_synthetic(tmp_path):
+	import nibabel as nib
+	from samri.report.roi import atlasassignment
+
+	atlas, atlas_path, mapping_path = _synthetic_atlas(tmp_path)
+	data = np.arange(1, 49, dtype=np.float32).reshape(atlas.shape)
+	# The medial structure is mostly zero, and hence excluded at the default threshold.
+	data[atlas == 3] = 0
+	data[0,2,0] = 7
+	data_paths = []
+	for i in range(2):
+		data_path = str(tmp_path/'data{}.nii.gz'.format(i))
+		nib.save(nib.Nifti1Image(data*(i+1), np.eye(4)), data_path)
+		data_paths.append(data_path)
+
+	result = atlasassignment(data_paths[0], atlas=atlas_path, mapping=mapping_path)
+	assert list(result['Structure']) == ['lateral']
+	assert result['values'].item() == _values(data, (atlas == 1) | (atlas == 2))
+
+	result = atlasassignment(data_paths[0], atlas=atlas_path, mapping=mapping_path, exact_zero_threshold=0)
+	assert list(result['Structure']) == ['lateral', 'medial']
+	assert result.loc[result['Structure'] == 'medial', 'values'].item() == _values(data, atlas == 3)
+
+	result = atlasassignment(data_paths[0], atlas=atlas_path, mapping=mapping_path, lateralized=True)
+	assert list(zip(result['Structure'], result['Side'])) == [('lateral', 'left'), ('lateral', 'right')]
+	assert result.loc[result['Side'] == 'right', 'values'].item() == _values(data, atlas == 1)
+	assert result.loc[result['Side'] == 'left', 'values'].item() == _values(data, atlas == 2)
+
+	results = atlasassignment(data_paths, atlas=atlas_path, mapping=mapping_path, save_as=str(tmp_path/'out'/'assignment.csv'))
+	assert list(results['path']) == data_paths
+	for data_path, (_, row) in zip(data_paths, results.iterrows()):
+		single = atlasassignment(data_path, atlas=atlas_path, mapping=mapping_path)
+		assert row['values'] == single['values'].item()
+	assert (tmp_path/'out'/'assignment.csv').exists()
+
+def test_atlasassignment_resampled(tmp_path):
+	import nibabel as nib
+	from samri.report.roi import atlasassignment
+
+	atlas, atlas_path, mapping_path = _synthetic_atlas(tmp_path)
+	# Data on a grid of half the resolution, the voxel centers of which coincide with every second atlas voxel.
+	data = np.arange(1, 7, dtype=np.float32).reshape((3,2,1))
+	data_path = str(tmp_path/'data.nii.gz')
+	nib.save(nib.Nifti1Image(data, np.diag([2.,2.,2.,1.])), data_path)
+
+	result = atlasassignment(data_path, atlas=atlas_path, mapping=mapping_path, resample_atlas=True, exact_zero_threshold=0)
+	resampled_atlas = atlas[::2,::2,::2]
+	assert list(result['Structure']) == ['lateral', 'medial']
+	assert result.loc[result['Structure'] == 'lateral', 'values'].item() == _values(data, (resampled_atlas == 1) | (resampled_atlas == 2))
+	assert result.loc[result['Structure'] == 'medial', 'values'].item() == _values(data, resampled_atlas == 3)
+
+	# Resampling the data to the atlas grid assigns each atlas voxel a data value instead.
+	result = atlasassignment(data_path, atlas=atlas_path, mapping=mapping_path, exact_zero_threshold=0)
+	assert len(result.loc[result['Structure'] == 'lateral', 'values'].item().split(', ')) == np.count_nonzero((atlas == 1) | (atlas == 2))
+
 def test_erode():
 	from samri.report.roi import erode
 
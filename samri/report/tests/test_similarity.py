@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import nibabel as nib
+import numpy as np
+
+def _images(noise=0.1):
+	rng = np.random.default_rng(0)
+	data = rng.random((12,12,12))
+	fixed = nib.Nifti1Image(data, np.eye(4))
+	similar = nib.Nifti1Image(data + noise*rng.random(data.shape), np.eye(4))
+	dissimilar = nib.Nifti1Image(rng.random(data.shape), np.eye(4))
+	return fixed, similar, dissimilar
+
+def test_similarity_ordering():
+	from samri.report.similarity import similarity, METRICS
+
+	fixed, similar, dissimilar = _images()
+	for metric in METRICS:
+		radius_or_number_of_bins = 2 if metric == 'CC' else 16
+		similar_score = similarity(fixed, similar, metric=metric, radius_or_number_of_bins=radius_or_number_of_bins)
+		dissimilar_score = similarity(fixed, dissimilar, metric=metric, radius_or_number_of_bins=radius_or_number_of_bins)
+		assert similar_score < dissimilar_score, metric
+
+def test_similarity_identity():
+	from samri.report.similarity import similarity
+
+	fixed, _, _ = _images()
+	assert similarity(fixed, fixed, metric='MeanSquares') == 0
+	assert np.isclose(similarity(fixed, fixed, metric='GC'), -1)
+	assert np.isclose(similarity(fixed, fixed, metric='CC', radius_or_number_of_bins=2), -1)
+
+def test_similarity_sampling():
+	from samri.report.similarity import similarity
+
+	fixed, similar, _ = _images()
+	mask = nib.Nifti1Image((np.asanyarray(fixed.dataobj) > 0.5).astype(np.uint8), np.eye(4))
+	full = similarity(fixed, similar, metric='MeanSquares', mask=mask)
+	sampled = similarity(fixed, similar, metric='MeanSquares', mask=mask, sampling_strategy='Random', random_state=0)
+	assert np.isclose(full, sampled, rtol=0.2)
@@ -0,0 +1,47 @@
+import nibabel as nib
+import numpy as np
+
+def _per_volume_metrics(data):
+	"""Reference implementation, as previously used in `samri.report.snr.base_metrics()`."""
+	import scipy.stats as sps
+
+	metrics = {'Mean':[], 'Median':[], 'Mode':[], 'Standard Deviation':[]}
+	for i in data.T:
+		metrics['Mean'].append(np.mean(i))
+		metrics['Median'].append(np.median(i))
+		metrics['Mode'].append(sps.mode(i, axis=None)[0])
+		metrics['Standard Deviation'].append(np.std(i))
+	return metrics
+
+def test_base_metrics(tmp_path):
+	from samri.report.snr import base_metrics
+
+	rng = np.random.RandomState(0)
+	datasets = {
+		'int':rng.randint(-20, 40, size=(5,6,4,11)).astype(np.int16),
+		# Value range exceeding the int16 range of differences.
+		'int_wide':rng.choice(np.array([-30000, -29999, 0, 30000, 30001], dtype=np.int16), size=(5,6,4,11)),
+		'float':np.round(rng.normal(size=(5,6,4,11)), 1).astype(np.float32),
+		}
+	for name, data in datasets.items():
+		img_path = str(tmp_path/'{}.nii.gz'.format(name))
+		nib.save(nib.Nifti1Image(data, np.eye(4)), img_path)
+		reference = _per_volume_metrics(data)
+		for chunk_size in [3, 11, 16]:
+			df = base_metrics(img_path, chunk_size=chunk_size)
+			assert len(df) == data.shape[3]
+			for column in ['Mean', 'Median', 'Mode', 'Standard Deviation']:
+				assert np.allclose(df[column], reference[column], rtol=1e-5), (name, chunk_size, column)
+
+def test_iter_base_metrics(tmp_path):
+	from samri.report.snr import iter_base_metrics
+
+	data = np.random.RandomState(1).randint(0, 10, size=(4,4,3,7)).astype(np.int16)
+	for subject in ['a', 'b']:
+		nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path/'sub-{}.nii.gz'.format(subject)))
+	df = iter_base_metrics(str(tmp_path/'sub-{subject}.nii.gz'), [{'subject':'a'}, {'subject':'b'}],
+		chunk_size=2,
+		memory_budget=1,
+		)
+	assert len(df) == 14
+	assert list(df['subject'].unique()) == ['a', 'b']
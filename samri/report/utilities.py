@@ -6,6 +6,8 @@ from copy import deepcopy
 from joblib import Parallel, delayed
 from nilearn.input_data import NiftiMasker
 from os import path
+from samri.report import cache
+from samri.report.extraction import ROIIndex, roi_stats
 
 try: FileNotFoundError
 except NameError:
@@ -25,8 +27,8 @@ def roi_df(img_path, masker,
 
 	img_path : str
 		Path to NIfTI file from which the ROI is to be extracted.
-	masker : nilearn.NiftiMasker
-		Nilearn `nifti1.Nifti1Image` object to use for masking the desired ROI.
+	masker : nilearn.NiftiMasker or samri.report.extraction.ROIIndex
+		Nilearn `nifti1.Nifti1Image` object to use for masking the desired ROI, or a precomputed single-ROI index.
 	substitution : dict, optional
 		A dictionary with keys which include 'subject' and 'session'.
 	feature : list, optional
@@ -38,17 +40,21 @@ def roi_df(img_path, masker,
 		img_path = img_path.format(**substitution)
 	img_path = path.abspath(path.expanduser(img_path))
 	try:
-		img = nib.load(img_path)
+		img = cache.load(img_path)
 	except (FileNotFoundError, nib.py3k.FileNotFoundError):
 		return pd.DataFrame({})
 	else:
-		img = masker.fit_transform(img)
-		img = img.flatten()
-		mean = np.nanmean(img)
+		if isinstance(masker, ROIIndex):
+			mean = roi_stats(img, masker)['Mean'].values[0]
+			mask_path = masker.filename
+		else:
+			img = masker.fit_transform(img)
+			img = img.flatten()
+			mean = np.nanmean(img)
+			mask_path = masker.mask_img.get_filename()
 		subject_data['session'] = substitution['session']
 		subject_data['subject'] = substitution['subject']
 		subject_data['t'] = mean
-		mask_path = masker.mask_img.get_filename()
 		if mask_path:
 			feature = path.abspath(mask_path)
 		subject_data['feature'] = feature
@@ -70,8 +76,8 @@ def roi_data(img_path, masker,
 
 	img_path : str
 		Path to NIfTI file from which the ROI is to be extracted.
-	masker : nilearn.NiftiMasker
-		Nilearn `nifti1.Nifti1Image` object to use for masking the desired ROI.
+	masker : nilearn.NiftiMasker or samri.report.extraction.ROIIndex or str
+		Nilearn `nifti1.Nifti1Image` object to use for masking the desired ROI, a precomputed single-ROI index, or the path to a mask file.
 	exclude_zero : bool, optional
 		Whether to filter out zero values.
 	substitution : dict, optional
@@ -82,7 +88,13 @@ def roi_data(img_path, masker,
 	if substitution:
 		img_path = img_path.format(**substitution)
 	img_path = path.abspath(path.expanduser(img_path))
-	img = nib.load(img_path)
+	img = cache.load(img_path)
+	if isinstance(masker, ROIIndex):
+		stats = roi_stats(img, masker,
+			exclude_zero=exclude_zero,
+			zero_threshold=zero_threshold,
+			)
+		return stats['Mean'].values[0], stats['Median'].values[0]
 	try:
 		masked_data = masker.fit_transform(img)
 	except:
@@ -120,7 +132,7 @@ def pattern_df(img_path, pattern,
 		img_path = img_path.format(**substitution)
 	img_path = path.abspath(path.expanduser(img_path))
 	try:
-		img = nib.load(img_path)
+		img = cache.load(img_path)
 	except (FileNotFoundError, nib.py3k.FileNotFoundError):
 		return pd.DataFrame({}), pd.DataFrame({})
 	else: